@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import unittest
 
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from subprocess import CalledProcessError
 
-def eprint(msg):
-    print(msg, file=sys.stderr)
+# eprint writes each message at once, so that messages from concurrent fetches don't interleave
+from bootstrap_trace_utils import debug, eprint, log
 
 if sys.version_info[0] < 3 or (sys.version_info[0] == 3 and sys.version_info[1] < 11):
     eprint("This script requires python version 3.11 or greater")
@@ -15,22 +23,92 @@ if sys.version_info[0] < 3 or (sys.version_info[0] == 3 and sys.version_info[1]
 
 import tomllib  # requires Python >= 3.11
 
-with open("slm.toml", "rb") as f:
-    data = tomllib.load(f)
-DEPENDENCIES = data["dependencies"]
+import bootstrap_git_utils as bgu
+import bootstrap_pkg_utils as bpu
+import bootstrap_trace_utils as btu
+from bootstrap_file_utils import write_if_changed
 
+# the slm.toml project model, shared with bootstrap_conan_utils.py and the conan recipes
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "slm_builder", "conan_lbstanza_generator"))
+import slm_toml
+
+try:
+    PROJECT = slm_toml.load_slm_toml("slm.toml")
+except slm_toml.SlmTomlError as e:
+    eprint(f"slm bootstrap: {e}")
+    exit(1)
+PROJECT_NAME = PROJECT.name
+# dependency specifiers as tables, with legacy "org/repo|version" strings converted
+DEPENDENCIES = PROJECT.specifiers()
+
+# bootstrap's own lockfile: slm owns slm.lock, and deletes it on `slm clean`
+BOOTSTRAP_LOCK = os.path.join(os.getcwd(), "bootstrap.lock")
 SLM_DIR = os.path.join(os.getcwd(), ".slm")
 SLM_PKGS_DIR = os.path.join(SLM_DIR, "pkgs")
 SLM_DEPS_DIR = os.path.join(SLM_DIR, "deps")
 SLM_PKGCACHE_DIR = os.path.join(SLM_DIR, "pkg-cache")
+SLM_STATE = os.path.join(SLM_DIR, "bootstrap-state.json")
+
+# default number of dependencies to fetch concurrently, override with -j or SLM_JOBS
+DEFAULT_JOBS = 8
+
+class BootstrapError(Exception):
+    pass
+
+class BootstrapCancelled(BootstrapError):
+    pass
+
+# set when a fetch fails, to stop all of the other fetches
+CANCELLED = threading.Event()
+_running = set()
+_running_lock = threading.Lock()
+
+# resolves the conan dependencies of this bootstrap, each at most once
+_conan_resolver = None
+_conan_resolver_lock = threading.Lock()
 
 def error(msg):
-    print(msg, file=sys.stderr)
+    eprint(msg)
     sys.exit(1)
 
 def check_run (*args, **kwargs):
     kwargs["check"] = True
-    subprocess.run(*args, **kwargs)
+    with btu.TRACER.span(" ".join(args[0][:2]), args[0][0], args=" ".join(args[0])):
+        subprocess.run(*args, **kwargs)
+
+def check_run_quiet (args, **kwargs):
+    """
+    Run a command like check_run, but capture its output so that concurrently running
+    commands don't interleave.  The output is in the CalledProcessError if it fails.
+    The command is terminated if the bootstrap is cancelled.
+    """
+    if CANCELLED.is_set():
+        raise BootstrapCancelled()
+    with btu.TRACER.span(" ".join(args[:2]), args[0], args=" ".join(args)):
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, **kwargs)
+        with _running_lock:
+            _running.add(p)
+        try:
+            if CANCELLED.is_set():
+                p.terminate()
+            output, _ = p.communicate()
+        finally:
+            with _running_lock:
+                _running.discard(p)
+    if CANCELLED.is_set():
+        raise BootstrapCancelled()
+    if p.returncode != 0:
+        raise CalledProcessError(p.returncode, args, output)
+
+def cancel_running():
+    """Stop all running and future fetches"""
+    CANCELLED.set()
+    with _running_lock:
+        for p in _running:
+            p.terminate()
+    with _conan_resolver_lock:
+        if _conan_resolver is not None:
+            _conan_resolver.close()
 
 def version_to_tag(version):
     if version == "latest":
@@ -45,33 +123,152 @@ def package_to_url(package):
 
     return PROTOCOLS[os.environ.get("SLM_PROTOCOL")](package)
 
-def fetch_package_into(path, package, version):
+def check_cancelled():
+    if CANCELLED.is_set():
+        raise BootstrapCancelled()
+
+def conan_resolver():
+    """Returns the resolver shared by all of the conan dependencies of this bootstrap"""
+    global _conan_resolver
+    import bootstrap_conan_utils as bcu
+    with _conan_resolver_lock:
+        if _conan_resolver is None:
+            _conan_resolver = bcu.ConanResolver(metadata_cache=bcu.ConanMetadataCache.from_environment())
+        return _conan_resolver
+
+def is_conan_dependency(specifier):
+    return "pkg" in specifier and specifier.get("type") == "conan"
+
+def git_mirror_cache():
+    """Returns the shared git mirror cache, or None if SLM_GIT_MIRROR=0 disables it"""
+    if os.environ.get("SLM_GIT_MIRROR") == "0":
+        return None
+    import bootstrap_conan_utils as bcu
+    return bgu.GitMirrorCache(os.path.join(bcu.default_cache_directory(), "git"))
+
+def fetch_package_into(path, package, version, commit=None):
+    """Fetch a git dependency at a version, or at an exact commit if one is given, and return the commit"""
     rev = version_to_tag(version)
     url = package_to_url(package)
 
     try:
-        eprint(f"slm bootstrap: fetching {package} {version} into {path}")
-        check_run(["git", "clone", "--depth", "1", "--quiet", url, path])
-        check_run(["git", "fetch", "--tags", "--quiet"], cwd=path)
-        check_run(["git", "checkout", "--quiet", "--force", rev], cwd=path)
-    except CalledProcessError:
-        error(f"failed fetching package {package}")
-
-def download_conan_package_into(path, package, version, options):
+        if commit:
+            # fetch just the locked commit, without listing tags
+            log("info", f"slm bootstrap: fetching {package} {version} at locked commit {commit} into {path}")
+        else:
+            log("info", f"slm bootstrap: fetching {package} {version} into {path}")
+        return bgu.git_fetch_ref(path, url, commit or rev, run=check_run_quiet, mirror=git_mirror_cache(),
+                                 git_filter=os.environ.get("SLM_GIT_FILTER"))
+    except CalledProcessError as e:
+        raise BootstrapError(f"failed fetching package {package}: `{' '.join(e.cmd)}` failed:\n{e.output}")
+    except OSError as e:
+        # like git missing from the PATH
+        raise BootstrapError(f"failed fetching package {package}: {e}")
+
+# only these parts of conan packages are needed to build with them
+CONAN_PACKAGE_MEMBERS = ["include/", "lib/"]
+
+def download_conan_package_into(path, package, version, options, locked=None):
+    """Download and extract a conan dependency, or the locked conan version if one is given, and return the conan version"""
     import bootstrap_conan_utils as bcu
-    import tarfile
 
-    eprint(f"slm bootstrap: downloading \"{package}/{version}\" with options \"{options}\"")
-    cv = bcu.ConanVersion(package, version)
-    cv = bcu.conan_fully_qualify_latest_version(cv, options=options)
-    pfilename = bcu.conan_download_package(cv)
-    eprint(f"downloaded \"{pfilename}\", extracting to {path}")
+    check_cancelled()
+    if locked:
+        log("info", f"slm bootstrap: downloading locked \"{locked}\"")
+        cv = bcu.ConanVersion.from_string(locked)
+    else:
+        log("info", f"slm bootstrap: downloading \"{package}/{version}\" with options \"{options}\"")
+        cv = conan_resolver().resolve(bcu.ConanVersion(package, version), options)
+    store = bcu.ConanPackageStore()
+    check_cancelled()
 
-    tarfile.open(pfilename).extractall(path)
+    def extract(extracted):
+        if os.environ.get("SLM_STREAM_EXTRACT", "") not in ("", "0") and store.lookup(cv) is None:
+            # extract while downloading, without keeping the package
+            log("info", f"streaming \"{cv.to_string()}\", extracting to {extracted}")
+            bcu.conan_stream_extract_package(cv, extracted, CONAN_PACKAGE_MEMBERS)
+        else:
+            pfilename = bcu.conan_download_package(cv, package_store=store)
+            log("info", f"downloaded \"{pfilename}\", extracting to {extracted}")
+            with btu.TRACER.span(f"extract {package}/{version}", "extract", path=extracted):
+                bcu.extract_conan_package(pfilename, extracted, CONAN_PACKAGE_MEMBERS)
 
-def generate_stanza_proj():
+    # packages are extracted once per machine, and linked into each project
+    extracted = bcu.ConanExtractionCache().ensure(cv, CONAN_PACKAGE_MEMBERS, extract)
+    method = bcu.materialize_tree(extracted, path)
+    log("info", f"slm bootstrap: {cv.to_string()} in {path} ({method} of {extracted})")
+    return cv.to_string()
+
+def conan_platform():
+    """
+    Returns the platform the conan packages of this machine are for, like "linux-x86_64": its os,
+    and the arch of the conan profile packages are selected with, which keys the conan versions
+    in bootstrap.lock, so a lockfile shared between machines with different archs resolves on each
+    """
+    import bootstrap_conan_utils as bcu
+    return f"{slm_toml.current_platform()}-{bcu.host_profile()['arch']}"
+
+def options_digest(options):
+    """A short digest of conan options, to detect when locked conan versions are out of date"""
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+
+def read_lockfile():
+    """Returns the locked dependencies from bootstrap.lock, or an empty table if there is no lockfile"""
+    if not os.path.exists(BOOTSTRAP_LOCK):
+        return {}
+    with open(BOOTSTRAP_LOCK, "rb") as f:
+        return tomllib.load(f).get("dependencies", {})
+
+def locked_version(lock, dependency, specifier):
+    """
+    Returns the locked git commit or conan version string of a dependency, or None
+    if it isn't locked for the specifier in slm.toml
+    """
+    entry = lock.get(dependency, {})
+    if entry.get("version") != specifier["version"]:
+        return None
+    if "git" in specifier:
+        return entry.get("commit") if entry.get("git") == specifier["git"] else None
+    if entry.get("pkg") != specifier["pkg"] or entry.get("options-digest") != options_digest(specifier.get("options", {})):
+        return None
+    # conan package ids are different on each os and arch
+    return entry.get("conan", {}).get(conan_platform())
+
+def lock_entry(lock, dependency, specifier, resolved):
+    """Returns the bootstrap.lock entry for a dependency resolved to a git commit or conan version string"""
+    if "git" in specifier:
+        return {"git": specifier["git"], "version": specifier["version"], "commit": resolved}
+    digest = options_digest(specifier.get("options", {}))
+    old = lock.get(dependency, {})
+    conan = {}
+    if (old.get("pkg"), old.get("version"), old.get("options-digest")) == (specifier["pkg"], specifier["version"], digest):
+        # keep the locked versions for the other platforms, dropping the ones keyed by os only
+        conan.update({k: v for k, v in old.get("conan", {}).items() if "-" in k})
+    conan[conan_platform()] = resolved
+    return {"pkg": specifier["pkg"], "version": specifier["version"], "options-digest": digest, "conan": conan}
+
+def resolved_version(entry):
+    """Returns the git commit or conan version string that a bootstrap.lock entry resolves to on this platform"""
+    return entry["commit"] if "git" in entry else entry["conan"][conan_platform()]
+
+def write_lockfile(entries):
+    """Write bootstrap.lock with the given lock entries, if they have changed"""
+    def key(k):
+        return k if k.replace("-", "").replace("_", "").isalnum() else json.dumps(k)
+
+    lines = ["# generated by bootstrap.py: the resolved versions of the dependencies in slm.toml\n"]
+    for dependency, entry in sorted(entries.items()):
+        lines.append(f"\n[dependencies.{key(dependency)}]\n")
+        for k, v in entry.items():
+            if isinstance(v, dict):
+                lines.extend(f"{key(k)}.{key(k2)} = {json.dumps(v2)}\n" for k2, v2 in sorted(v.items()))
+            else:
+                lines.append(f"{key(k)} = {json.dumps(v)}\n")
+    write_if_changed(BOOTSTRAP_LOCK, "".join(lines))
+
+def generate_stanza_proj(dependencies):
     dep_proj_files = []
-    for dep in DEPENDENCIES.keys():
+    for dep in dependencies:
       dep_path = os.path.join(SLM_DEPS_DIR, dep, "stanza.proj")
       # For Windows - we replace the `\` with `/` so that the
       #  'stanza build' invokation will actually run. Otherwise,
@@ -80,49 +277,445 @@ def generate_stanza_proj():
       dep_unnorm = dep_path.replace(os.sep, '/')
       dep_proj_files.append(dep_unnorm)
 
-    with open(os.path.join(SLM_DIR, "stanza.proj"), "w") as f:
-        f.writelines([f'include? "{proj_file}"\n' for proj_file in dep_proj_files])
+    # leave the file untouched when it hasn't changed, so stanza doesn't rebuild for nothing
+    content = "".join(f'include? "{proj_file}"\n' for proj_file in dep_proj_files)
+    write_if_changed(os.path.join(SLM_DIR, "stanza.proj"), content)
+
+def read_state():
+    """
+    Returns the dependencies that the last bootstrap fetched into .slm/deps, as a table of
+    dependency name to {"specifier": slm.toml specifier, "resolved": commit or conan version},
+    or None if .slm has no bootstrap state
+    """
+    if not os.path.exists(SLM_STATE):
+        return None
+    try:
+        with open(SLM_STATE, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # conan packages are different on each os and arch, so a .slm copied from elsewhere is stale
+    if state.get("platform") != conan_platform():
+        return None
+    return state.get("dependencies", {})
+
+def write_state(dependencies):
+    content = json.dumps({"platform": conan_platform(), "dependencies": dependencies}, indent=2, sort_keys=True) + "\n"
+    write_if_changed(SLM_STATE, content)
+
+def reconcile_dependencies(state, lock, dependencies):
+    """
+    Compare the bootstrap state of .slm with dependencies and bootstrap.lock
+
+    A dependency is up to date if it was fetched with the same specifier, its directory
+    still exists, and bootstrap.lock doesn't lock it to something else.
+
+    Returns: (table of up to date dependency name to state entry, names of dependencies to fetch)
+    """
+    current = {}
+    fetch = []
+    for dependency, specifier in dependencies.items():
+        entry = (state or {}).get(dependency)
+        locked = locked_version(lock, dependency, specifier)
+        if (entry is not None and entry["specifier"] == specifier
+                and locked in (None, entry["resolved"])
+                and os.path.isdir(os.path.join(SLM_DEPS_DIR, dependency))):
+            current[dependency] = entry
+        else:
+            fetch.append(dependency)
+    return current, fetch
+
+def parse_version(version):
+    """Returns a semantic version string as a tuple of ints, or None if it isn't one"""
+    try:
+        return tuple(int(p) for p in version.split("-")[0].split("+")[0].split("."))
+    except ValueError:
+        return None
+
+def merge_dependency(resolved, parents, dependency, specifier, parent):
+    """
+    Add a dependency requested by parent to the resolved dependencies, removing duplicates
+    by name the way parse-slm-toml-and-resolve-dependencies in src/dependencies.stanza does:
+    the newest of compatible git versions wins, and conan packages must agree on a version
+    and options.  A git dependency at "latest" is the head of its repository, which is newer than any of
+    its tags, so it wins over a semantic version.
+
+    Returns: True if the dependency is new or replaced, and needs to be fetched
+    throws BootstrapError if the requested dependency conflicts with the resolved one
+    """
+    old = resolved.get(dependency)
+    if old is None:
+        resolved[dependency] = specifier
+        parents[dependency] = parent
+        return True
+    old_parent = parents[dependency]
+    if "git" in specifier and "git" in old:
+        if specifier["version"] == old["version"] or old["version"] == "latest":
+            return False
+        if specifier["version"] == "latest":
+            resolved[dependency] = specifier
+            parents[dependency] = parent
+            return True
+        new_version, old_version = parse_version(specifier["version"]), parse_version(old["version"])
+        if new_version is None or old_version is None or new_version[0] != old_version[0]:
+            raise BootstrapError(f"incompatible versions requested for git dependency {dependency}:\n"
+                                 f"  {parent} => {specifier['version']}\n  {old_parent} => {old['version']}")
+        if new_version > old_version:
+            resolved[dependency] = specifier
+            parents[dependency] = parent
+            return True
+        return False
+    if "pkg" in specifier and "pkg" in old:
+        if specifier["version"] != old["version"]:
+            raise BootstrapError(f"incompatible versions requested for package dependency {dependency}:\n"
+                                 f"  {parent} => {specifier['version']}\n  {old_parent} => {old['version']}")
+        if specifier.get("options", {}) != old.get("options", {}):
+            raise BootstrapError(f"incompatible options requested for package dependency {dependency}:\n"
+                                 f"  {parent} => {specifier.get('options', {})}\n  {old_parent} => {old.get('options', {})}")
+        return False
+    raise BootstrapError(f"incompatible dependency types requested for {dependency} by {parent} and {old_parent}")
+
+def prune_superseded(roots, resolved, parents, entries, dependencies_of=None):
+    """
+    Remove the dependencies that only versions which lost a merge required: the ones no longer
+    reachable from roots through the dependencies of the resolved versions
+
+    Parameters:
+        roots: the names of the dependencies of the project
+        dependencies_of: function returning the dependencies of a fetched dependency.  Optional, Default read_dependencies_of.
+
+    Returns: the names of the dependencies removed
+    """
+    dependencies_of = dependencies_of or read_dependencies_of
+    reachable = set()
+    stack = list(roots)
+    while stack:
+        dependency = stack.pop()
+        if dependency in reachable or dependency not in resolved:
+            continue
+        reachable.add(dependency)
+        stack.extend(dependencies_of(dependency))
+    superseded = [d for d in resolved if d not in reachable]
+    for dependency in superseded:
+        debug("prune_superseded: \"%s\" is only required by superseded versions", dependency)
+        resolved.pop(dependency)
+        parents.pop(dependency, None)
+        entries.pop(dependency, None)
+    return superseded
 
-def bootstrap(args):
-    # Create bootstrap dir structure
-    os.makedirs(SLM_DIR)
-    os.makedirs(SLM_PKGS_DIR)
-    os.makedirs(SLM_DEPS_DIR)
-    os.makedirs(SLM_PKGCACHE_DIR)
+def read_dependencies_of(dependency):
+    """Returns the [dependencies] of the slm.toml of a fetched dependency, or an empty table if it has none"""
+    path = os.path.join(SLM_DEPS_DIR, dependency, "slm.toml")
+    if not os.path.exists(path):
+        return {}
+    try:
+        return slm_toml.load_slm_toml(path).specifiers()
+    except slm_toml.SlmTomlError as e:
+        raise BootstrapError(str(e))
+
+def fetch_dependency(lock, dependency, specifier):
+    """Fetch a dependency from slm.toml into .slm/deps, and return its bootstrap.lock entry"""
+    with btu.TRACER.span(f"fetch {dependency}", "dependency"):
+        return fetch_dependency_into_deps(lock, dependency, specifier)
+
+def fetch_dependency_into_deps(lock, dependency, specifier):
+    log("info", f"dep \"{dependency}\" = \"{specifier}\"")
+    path = os.path.join(SLM_DEPS_DIR, dependency)
+    locked = locked_version(lock, dependency, specifier)
+    if "git" in specifier:
+        package = specifier["git"]
+        version = specifier["version"]
+        resolved = fetch_package_into(path, package, version, locked)
+    elif is_conan_dependency(specifier):
+        package = specifier["pkg"]
+        version = specifier["version"]
+        options = specifier["options"]
+        try:
+            resolved = download_conan_package_into(path, package, version, options, locked)
+        except BootstrapError:
+            raise
+        except Exception as e:
+            raise BootstrapError(f"failed downloading conan package {package}/{version}: {e}") from e
+    else:
+        raise BootstrapError(f"unknown dependency type: \"{dependency}\" = \"{specifier}\"")
+    return lock_entry(lock, dependency, specifier, resolved)
+
+def fetch_dependencies(lock, dependencies, jobs):
+    """
+    Fetch dependencies concurrently, running up to `jobs` fetches at a time.
+    The first failure cancels the other fetches.
+
+    Returns: table of dependency name to bootstrap.lock entry
+    """
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(fetch_dependency, lock, d, s): d for d, s in dependencies.items()}
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        failures = [f.exception() for f in done if f.exception() is not None]
+        if failures:
+            cancel_running()
+            for f in pending:
+                f.cancel()
+            wait(pending)
+            # report the failure that caused the cancellation, not the cancelled fetches
+            raise next((e for e in failures if not isinstance(e, BootstrapCancelled)), failures[0])
+    if futures:
+        log("info", f"slm bootstrap: fetched {len(futures)} dependencies in {time.monotonic() - start:.1f}s")
+    return {futures[f]: f.result() for f in futures}
+
+def fetch_wave(state, lock, resolved, parents, wave, entries, jobs):
+    """
+    Fetch a wave of dependencies concurrently, skipping the ones that are up to date in .slm,
+    and record them in state and entries
+
+    Returns: the next wave, the dependencies of this one that are new, or newer than before
+    """
+    specifiers = {d: resolved[d] for d in wave}
+    current, fetch = reconcile_dependencies(state, lock, specifiers)
+    if current:
+        log("info", f"slm bootstrap: {len(current)} dependencies are up to date")
+
+    # Forget the dependencies that are about to change before touching them,
+    # so an interrupted bootstrap refetches them next time
+    for dependency in fetch:
+        state.pop(dependency, None)
+    write_state(state)
+    remove_dependency_dirs(fetch)
+
+    # Start resolving all of the unlocked conan dependencies of the wave at once, so that
+    # each one's download starts as soon as it is resolved
+    conan = [d for d in fetch if is_conan_dependency(specifiers[d]) and locked_version(lock, d, specifiers[d]) is None]
+    if conan:
+        import bootstrap_conan_utils as bcu
+        for dependency in conan:
+            specifier = specifiers[dependency]
+            conan_resolver().submit(bcu.ConanVersion(specifier["pkg"], specifier["version"]), specifier["options"])
+
+    fetched = fetch_dependencies(lock, {d: specifiers[d] for d in fetch}, jobs)
+    for dependency, entry in fetched.items():
+        entries[dependency] = entry
+        state[dependency] = {"specifier": specifiers[dependency], "resolved": resolved_version(entry)}
+    for dependency, entry in current.items():
+        entries[dependency] = lock_entry(lock, dependency, specifiers[dependency], entry["resolved"])
+    write_state(state)
+
+    next_wave = []
+    for parent in wave:
+        for dependency, specifier in read_dependencies_of(parent).items():
+            if merge_dependency(resolved, parents, dependency, specifier, parent):
+                if dependency not in next_wave:
+                    next_wave.append(dependency)
+    return next_wave
 
-    # Clone dependencies
+def resolve_dependencies(state, lock, jobs):
+    """
+    Fetch the dependencies in slm.toml, then the dependencies in their slm.toml files, recursively.
+    Each newly discovered wave of dependencies is fetched concurrently, skipping the ones that
+    are up to date in .slm since the last bootstrap.
+
+    Returns: (table of dependency name to specifier, table of dependency name to bootstrap.lock entry)
+    """
+    state = dict(state or {})
+    resolved = {}
+    parents = {}
     for dependency, specifier in DEPENDENCIES.items():
-        eprint(f"dep \"{dependency}\" = \"{specifier}\"")
+        merge_dependency(resolved, parents, dependency, specifier, PROJECT_NAME)
+    entries = {}
+    wave = list(resolved)
+    depth = 0
+    while wave:
+        depth += 1
+        with btu.TRACER.span(f"wave {depth}", "phase", dependencies=len(wave)):
+            wave = fetch_wave(state, lock, resolved, parents, wave, entries, jobs)
+    prune_superseded(DEPENDENCIES, resolved, parents, entries)
+
+    # Prune the dependencies that are no longer in the graph
+    remove = [d for d in state if d not in resolved]
+    for dependency in remove:
+        state.pop(dependency)
+    write_state(state)
+    remove_dependency_dirs(remove)
+
+    log("info", f"slm bootstrap: resolved {len(resolved)} dependencies, {len(resolved) - len(DEPENDENCIES)} of them transitive")
+    return resolved, entries
+
+def remove_dependency_dirs(dependencies):
+    for dependency in dependencies:
         path = os.path.join(SLM_DEPS_DIR, dependency)
-        if "git" in specifier:
-            package = specifier["git"]
-            version = specifier["version"]
-            fetch_package_into(path, package, version)
-        elif "pkg" in specifier and "type" in specifier and specifier["type"]=="conan":
-            package = specifier["pkg"]
-            version = specifier["version"]
-            options = specifier["options"]
-            download_conan_package_into(path, package, version, options)
-        else:
-            error(f"unknown dependency type: \"{dependency}\" = \"{specifier}\"")
+        if os.path.lexists(path):
+            log("info", f"slm bootstrap: removing \"{path}\"")
+            shutil.rmtree(path)
+
+def stanza_pkg_cache():
+    """Returns the shared cache of compiled dependency packages, or None if SLM_PKG_CACHE=0 disables it"""
+    if os.environ.get("SLM_PKG_CACHE") == "0":
+        return None
+    version = bpu.stanza_version()
+    if version is None:
+        return None
+    import bootstrap_conan_utils as bcu
+    return bpu.StanzaPkgCache(os.path.join(bcu.default_cache_directory(), "pkgs"), version, conan_platform())
+
+def bootstrap(args, jobs=DEFAULT_JOBS):
+    # Create bootstrap dir structure, or reuse the one from an earlier bootstrap
+    os.makedirs(SLM_PKGS_DIR, exist_ok=True)
+    os.makedirs(SLM_DEPS_DIR, exist_ok=True)
+    os.makedirs(SLM_PKGCACHE_DIR, exist_ok=True)
+
+    # Fetch the dependency graph, at the locked versions in bootstrap.lock, skipping
+    # what is unchanged since the last bootstrap
+    lock = read_lockfile()
+    resolved, entries = resolve_dependencies(read_state(), lock, jobs)
+
+    # Record the resolved versions so that the next bootstrap can skip resolving them
+    write_lockfile(entries)
 
     # Generate stanza.proj for build
-    generate_stanza_proj()
+    generate_stanza_proj(resolved)
+
+    # Reuse the packages compiled for the same dependency versions by earlier builds
+    pkg_cache = stanza_pkg_cache()
+    if pkg_cache:
+        with btu.TRACER.span("seed pkg-cache", "phase"):
+            seeded = sum(pkg_cache.seed(d, resolved_version(entries[d]), SLM_PKGCACHE_DIR) for d in resolved)
+        if seeded:
+            log("info", f"slm bootstrap: reusing {seeded} compiled packages from {pkg_cache.directory}")
 
     # Attempt to build the project and packages
     try:
         check_run(["stanza", "build"] + args)
-    except CalledProcessError:
+    except (CalledProcessError, OSError):
         error("Bootstrap failed trying to run `stanza build`")
 
+    # Share the compiled dependency packages with later builds
+    if pkg_cache:
+        with btu.TRACER.span("publish pkg-cache", "phase"):
+            for dependency in resolved:
+                packages = bpu.stanza_package_names(os.path.join(SLM_DEPS_DIR, dependency))
+                if packages:
+                    pkg_cache.publish(dependency, resolved_version(entries[dependency]), packages,
+                                      [SLM_PKGCACHE_DIR, SLM_PKGS_DIR])
+
     slm_path = os.path.join(os.getcwd(), "slm")
     print(f"slm bootstrapped: run `{slm_path} build` to finish building.")
 
+def parse_jobs(args):
+    """
+    Removes the job count option ("-j N", "-jN" or "--jobs N") from the arguments
+
+    Returns: (job count, remaining arguments)
+    """
+    jobs = os.environ.get("SLM_JOBS", DEFAULT_JOBS)
+    rest = []
+    i = 0
+    while i < len(args):
+        if args[i] in ("-j", "--jobs") and i + 1 < len(args):
+            jobs = args[i + 1]
+            i += 2
+            continue
+        elif args[i].startswith("-j") and args[i][2:].isdigit():
+            jobs = args[i][2:]
+        else:
+            rest.append(args[i])
+        i += 1
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        error(f"invalid job count \"{jobs}\"")
+    if jobs < 1:
+        error(f"invalid job count \"{jobs}\"")
+    return jobs, rest
+
 def main(args):
-    if os.path.exists(SLM_DIR):
-        error(f"'{SLM_DIR}' exists, was `slm` already bootstrapped?")
+    jobs, args = parse_jobs(args)
+
+    try:
+        with btu.TRACER.span("bootstrap", "phase", jobs=jobs):
+            bootstrap(args, jobs)
+    except BootstrapError as e:
+        error(f"slm bootstrap: {e}")
+    finally:
+        # write the SLM_TRACE file and print the slowest operations, if tracing is enabled
+        btu.TRACER.finish()
+
+
+### Tests ######################################################################
+
+class TestMergeDependency(unittest.TestCase):
+    def merge(self, *requests):
+        resolved, parents = {}, {}
+        fetches = [merge_dependency(resolved, parents, "dep", {"git": "org/dep", "version": version}, parent)
+                   for parent, version in requests]
+        return resolved["dep"]["version"], parents["dep"], fetches
+
+    def test_newest_compatible_version_wins(self):
+        self.assertEqual(self.merge(("a", "0.1.0"), ("b", "0.2.0"), ("c", "0.1.5")), ("0.2.0", "b", [True, True, False]))
+        with self.assertRaises(BootstrapError):
+            self.merge(("a", "0.1.0"), ("b", "1.0.0"))
+
+    def test_equal_versions(self):
+        self.assertEqual(self.merge(("a", "0.1.0"), ("b", "0.1.0")), ("0.1.0", "a", [True, False]))
+        self.assertEqual(self.merge(("a", "latest"), ("b", "latest")), ("latest", "a", [True, False]))
+
+    def test_latest_wins_over_a_version(self):
+        self.assertEqual(self.merge(("a", "0.1.0"), ("b", "latest")), ("latest", "b", [True, True]))
+        self.assertEqual(self.merge(("a", "latest"), ("b", "0.1.0")), ("latest", "a", [True, False]))
+
+    def test_package_options_must_agree(self):
+        resolved, parents = {}, {}
+        merge_dependency(resolved, parents, "zlib", {"pkg": "zlib", "version": "1.3.1", "options": {"shared": "False"}}, "a")
+        self.assertFalse(merge_dependency(resolved, parents, "zlib", {"pkg": "zlib", "version": "1.3.1", "options": {"shared": "False"}}, "b"))
+        with self.assertRaisesRegex(BootstrapError, "incompatible options"):
+            merge_dependency(resolved, parents, "zlib", {"pkg": "zlib", "version": "1.3.1", "options": {"shared": "True"}}, "c")
+
+    def test_dependencies_of_superseded_versions_are_dropped(self):
+        # a@0.1.0 requires old, and b requires a@0.2.0, which doesn't
+        resolved, parents = {}, {}
+        merge_dependency(resolved, parents, "a", {"git": "org/a", "version": "0.1.0"}, "x")
+        merge_dependency(resolved, parents, "b", {"git": "org/b", "version": "0.1.0"}, "x")
+        merge_dependency(resolved, parents, "old", {"git": "org/old", "version": "0.1.0"}, "a")
+        merge_dependency(resolved, parents, "a", {"git": "org/a", "version": "0.2.0"}, "b")
+        entries = {d: {} for d in resolved}
+        fetched = {"a": {"shared": {}}, "b": {"a": {}}, "old": {}, "shared": {}}
+        self.assertEqual(prune_superseded(["a", "b"], resolved, parents, entries, fetched.get), ["old"])
+        self.assertEqual(sorted(resolved), ["a", "b"])
+        self.assertEqual(sorted(entries), ["a", "b"])
+
+    def test_package_versions_must_agree(self):
+        resolved, parents = {}, {}
+        merge_dependency(resolved, parents, "zlib", {"pkg": "zlib", "version": "1.3.1"}, "a")
+        self.assertFalse(merge_dependency(resolved, parents, "zlib", {"pkg": "zlib", "version": "1.3.1"}, "b"))
+        with self.assertRaises(BootstrapError):
+            merge_dependency(resolved, parents, "zlib", {"pkg": "zlib", "version": "1.3"}, "b")
+
+
+class TestLockfile(unittest.TestCase):
+    SPECIFIER = {"pkg": "zlib", "version": "1.3.1", "options": {"shared": "False"}}
+
+    def entry(self, conan):
+        return {"zlib": {"pkg": "zlib", "version": "1.3.1", "options-digest": options_digest({"shared": "False"}),
+                         "conan": conan}}
+
+    def test_conan_versions_are_keyed_by_os_and_arch(self):
+        from unittest import mock
+        with mock.patch(f"{__name__}.conan_platform", return_value="macos-armv8"):
+            # locked on another arch, or by os only before the arch was recorded
+            lock = self.entry({"macos-x86_64": "zlib/1.3.1#a:b#c", "macos": "zlib/1.3.1#d:e#f"})
+            self.assertIsNone(locked_version(lock, "zlib", self.SPECIFIER))
+            entry = lock_entry(lock, "zlib", self.SPECIFIER, "zlib/1.3.1#g:h#i")
+            self.assertEqual(entry["conan"], {"macos-x86_64": "zlib/1.3.1#a:b#c", "macos-armv8": "zlib/1.3.1#g:h#i"})
+            self.assertEqual(locked_version({"zlib": entry}, "zlib", self.SPECIFIER), "zlib/1.3.1#g:h#i")
+            self.assertEqual(resolved_version(entry), "zlib/1.3.1#g:h#i")
+
+
+class TestFetchPackage(unittest.TestCase):
+    def test_missing_git(self):
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as d, mock.patch.dict(os.environ, {"SLM_GIT_MIRROR": "0"}), \
+             mock.patch("subprocess.Popen", side_effect=FileNotFoundError(2, "No such file or directory", "git")):
+            with self.assertRaisesRegex(BootstrapError, "failed fetching package StanzaOrg/semver: .*git"):
+                fetch_package_into(os.path.join(d, "semver"), "StanzaOrg/semver", "0.1.0")
 
-    bootstrap(args)
 
 if __name__ == "__main__":
     import sys
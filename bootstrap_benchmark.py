@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import bootstrap_conan_utils as bcu
+from bootstrap_stub_utils import StubConanServer, make_tagged_repo, stub_package, synthetic_package_files
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+if sys.version_info[0] < 3 or (sys.version_info[0] == 3 and sys.version_info[1] < 11):
+    eprint("This script requires python version 3.11 or greater")
+    exit(1)
+
+
+# Offline benchmarks of the bootstrap: conan resolution, download and extraction
+# against a local StubConanServer, and whole bootstraps of a generated project
+# whose git dependencies are local bare repositories.  Results are compared
+# against the times stored in bootstrap_benchmark_baseline.json.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, "bootstrap_benchmark_baseline.json")
+
+# simulated round trip time to the conan server
+LATENCY = 0.02
+# number of recipe revisions of each package, each with packages for three platforms
+RECIPE_REVISIONS = 4
+# size of the packages downloaded and extracted
+PACKAGE_SIZE = 32 * 1024 * 1024
+# the generated project for the whole-bootstrap benchmarks
+GIT_DEPENDENCIES = 6
+GIT_TAGS = 50
+CONAN_DEPENDENCIES = 2
+CONAN_PACKAGE_SIZE = 8 * 1024 * 1024
+
+
+def resolution_packages(name: str) -> dict:
+    """Returns a package with several recipe revisions, of which only the oldest has a match for the current os"""
+    host_os = "Macos" if platform.system() == "Darwin" else platform.system()
+    rrevs = {}
+    for r in range(RECIPE_REVISIONS):
+        packages = {}
+        for os_name in ("Linux", "Macos", "Windows"):
+            matches = r == 0 or os_name != host_os
+            packages[f"pid-{os_name}-{r}"] = {
+                "info": {"settings": {"os": os_name, "arch": "x86_64"}, "options": {"shared": "False" if matches else "True"}},
+                "revisions": {f"prev{r}": {"time": f"2024-01-0{r + 1}T00:00:01.000+0000", "files": {}}}}
+        rrevs[f"rrev{r}"] = {"time": f"2024-01-0{r + 1}T00:00:00.000+0000", "packages": packages}
+    return {f"{name}/1.0": rrevs}
+
+
+def bench_resolution(tmpdir: str) -> dict:
+    packages = {}
+    names = [f"pkg{i}" for i in range(6)]
+    for name in names:
+        packages.update(resolution_packages(name))
+    cache = bcu.ConanMetadataCache(os.path.join(tmpdir, "metadata"))
+    results = {}
+    with StubConanServer(packages, latency=LATENCY) as server, bcu.ConanTransport() as transport:
+        for label, kwargs in (("resolution cold", {}), ("resolution cached", {"metadata_cache": cache})):
+            if "metadata_cache" in kwargs:
+                # fill the cache, then time resolving from it
+                for name in names:
+                    bcu.conan_fully_qualify_latest_version(bcu.ConanVersion(name, "1.0"), options={"shared": "False"},
+                                                           repourl=server.url, transport=transport, **kwargs)
+            start = time.perf_counter()
+            for name in names:
+                bcu.conan_fully_qualify_latest_version(bcu.ConanVersion(name, "1.0"), options={"shared": "False"},
+                                                       repourl=server.url, transport=transport, **kwargs)
+            results[label] = time.perf_counter() - start
+    return results
+
+
+def bench_download_and_extract(tmpdir: str) -> dict:
+    packages = stub_package("big", "1.0", synthetic_package_files(PACKAGE_SIZE))
+    fqcv = bcu.ConanVersion("big", "1.0", "rrev0", "pid0", "prev0")
+    results = {}
+    with StubConanServer(packages) as server:
+        store = bcu.ConanPackageStore(os.path.join(tmpdir, "store"))
+        start = time.perf_counter()
+        tgz = bcu.conan_download_package(fqcv, repourl=server.url, package_store=store)
+        results["download"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bcu.extract_conan_package(tgz, os.path.join(tmpdir, "extracted"), ["include/", "lib/"])
+        results["extract"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bcu.conan_stream_extract_package(fqcv, os.path.join(tmpdir, "streamed"), ["include/", "lib/"], repourl=server.url)
+        results["stream extract"] = time.perf_counter() - start
+    return results
+
+
+def write_project(directory: str, git_dependencies: list[str], conan_packages: list[str]):
+    os.makedirs(directory)
+    lines = ['name = "benchmark"\n', 'version = "0.1.0"\n', "\n", "[dependencies]\n"]
+    for name in git_dependencies:
+        lines.append(f'{name} = {{ git = "StanzaOrg/{name}", version = "0.0.{GIT_TAGS // 2}" }}\n')
+    for name in conan_packages:
+        lines.append(f'\n[dependencies.{name}]\npkg = "{name}"\nversion = "1.0"\ntype = "conan"\noptions.shared = "False"\n')
+    with open(os.path.join(directory, "slm.toml"), "w") as f:
+        f.writelines(lines)
+
+
+def bench_bootstrap(tmpdir: str) -> dict:
+    repos = os.path.join(tmpdir, "repos")
+    os.makedirs(repos)
+    git_dependencies = [f"dep{i}" for i in range(GIT_DEPENDENCIES)]
+    for name in git_dependencies:
+        make_tagged_repo(repos, name, GIT_TAGS, file_size=4096)
+
+    host_os = "Macos" if platform.system() == "Darwin" else platform.system()
+    conan_packages = [f"clib{i}" for i in range(CONAN_DEPENDENCIES)]
+    packages = {}
+    for name in conan_packages:
+        packages.update(stub_package(name, "1.0", synthetic_package_files(CONAN_PACKAGE_SIZE), host_os, {"shared": "False"}))
+
+    # a stanza that only knows its version, so the benchmark measures the bootstrap itself
+    bindir = os.path.join(tmpdir, "bin")
+    os.makedirs(bindir)
+    stanza = os.path.join(bindir, "stanza")
+    with open(stanza, "w") as f:
+        f.write("#!/bin/sh\nif [ \"$1\" = version ]; then echo 0.0.0; fi\n")
+    os.chmod(stanza, 0o755)
+
+    results = {}
+    with StubConanServer(packages, latency=LATENCY) as server:
+        env = dict(os.environ)
+        env.update({
+            "PATH": bindir + os.pathsep + env.get("PATH", ""),
+            "SLM_CACHE_DIR": os.path.join(tmpdir, "cache"),
+            "SLM_CONAN_URL": server.url,
+            # clone the StanzaOrg repositories from the local bare repositories instead of GitHub
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": f"url.file://{repos.replace(os.sep, '/')}/.insteadOf",
+            "GIT_CONFIG_VALUE_0": "git@github.com:StanzaOrg/",
+        })
+        env.pop("SLM_TRACE", None)
+
+        def run(label: str, project: str):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(HERE, "bootstrap.py")], cwd=project, env=env, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            results[label] = time.perf_counter() - start
+
+        first = os.path.join(tmpdir, "project1")
+        write_project(first, git_dependencies, conan_packages)
+        run("bootstrap cold", first)
+        run("bootstrap unchanged", first)
+        second = os.path.join(tmpdir, "project2")
+        write_project(second, git_dependencies, conan_packages)
+        run("bootstrap warm cache", second)
+    return results
+
+
+BENCHMARKS = {
+    "resolution": bench_resolution,
+    "download": bench_download_and_extract,
+    "bootstrap": bench_bootstrap,
+}
+
+
+def run_benchmarks(names: list[str], repeat: int) -> dict:
+    """Returns the best time in seconds of each benchmark over repeat runs"""
+    best = {}
+    for _ in range(repeat):
+        for name in names:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                for label, seconds in BENCHMARKS[name](tmpdir).items():
+                    best[label] = min(seconds, best.get(label, seconds))
+    return best
+
+
+def report(results: dict, baseline: dict):
+    """Prints the results next to the baseline"""
+    print(f"{'benchmark':<24} {'seconds':>10} {'baseline':>10} {'ratio':>8}")
+    for label, seconds in results.items():
+        base = baseline.get(label)
+        if base:
+            print(f"{label:<24} {seconds:10.3f} {base:10.3f} {seconds / base:8.2f}")
+        else:
+            print(f"{label:<24} {seconds:10.3f} {'-':>10} {'-':>8}")
+
+
+def main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="bootstrap_benchmark.py",
+                                     description="Offline benchmarks of the bootstrap against local stand-in servers")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help=f"benchmarks to run: {', '.join(BENCHMARKS)}.  Default all")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the best time is reported, default 3")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--max-ratio", type=float, default=None,
+                        help="exit with an error if a benchmark takes more than this many times its baseline")
+    a = parser.parse_args(args)
+    unknown = [b for b in a.benchmarks if b not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    baseline = {}
+    if os.path.exists(a.baseline):
+        with open(a.baseline) as f:
+            baseline = json.load(f)["seconds"]
+
+    results = run_benchmarks(a.benchmarks or list(BENCHMARKS), a.repeat)
+    report(results, baseline)
+
+    if a.update_baseline:
+        baseline.update(results)
+        with open(a.baseline, "w") as f:
+            json.dump({"platform": platform.system(), "python": platform.python_version(),
+                       "seconds": {k: round(v, 4) for k, v in sorted(baseline.items())}}, f, indent=2)
+            f.write("\n")
+    if a.max_ratio is not None:
+        slower = [label for label, seconds in results.items() if label in baseline and seconds > baseline[label] * a.max_ratio]
+        if slower:
+            eprint(f"slower than {a.max_ratio}x the baseline: {', '.join(slower)}")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
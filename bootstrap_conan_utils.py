@@ -1,23 +1,66 @@
 #!/usr/bin/env python
 
-from dataclasses import dataclass
-
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+
+import collections
+import functools
+import hashlib
+import io
 import json
 import os
 import platform
+import random
 import requests
+import requests.adapters
 import sys
+import tempfile
+import threading
+import time
 import unittest
 import urllib.parse
+import urllib.request
 
-DEFAULT_CONAN_URL = "http://conan.jitx.com:8081/artifactory/api/conan/conan-local"
+import bootstrap_trace_utils as btu
+from bootstrap_file_utils import atomic_write
+from bootstrap_trace_utils import debug, eprint, log
+
+# the slm.toml project model, shared with bootstrap.py and the conan recipes
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "slm_builder", "conan_lbstanza_generator"))
+import slm_toml
 
-def eprint(msg):
-    print(msg, file=sys.stderr)
+DEFAULT_CONAN_URL = "http://conan.jitx.com:8081/artifactory/api/conan/conan-local"
 
-def debug(msg):
-    pass
-    eprint(msg)
+# default (connect, read) timeouts in seconds for requests to the conan server
+DEFAULT_CONAN_TIMEOUT = (10, 60)
+# default maximum number of pooled keep-alive connections per host
+DEFAULT_CONAN_MAX_CONNECTIONS_PER_HOST = 8
+# default maximum number of concurrent queries while resolving a single package
+DEFAULT_CONAN_MAX_WORKERS = 8
+# default number of seconds a cached metadata response is used before revalidating it
+DEFAULT_CONAN_METADATA_TTL = 24 * 60 * 60
+# default maximum size in bytes of the metadata cache
+DEFAULT_CONAN_METADATA_CACHE_SIZE = 64 * 1024 * 1024
+# default size budget in bytes of the downloaded package store, enforced by "gc"
+DEFAULT_CONAN_PACKAGE_STORE_SIZE = 4 * 1024 * 1024 * 1024
+# default buffer size in bytes for reading and writing downloaded files
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# default number of times a dropped download is resumed before giving up
+DEFAULT_DOWNLOAD_RETRIES = 3
+# default number of times a failed request is retried, and seconds before the first retry,
+# unless core.download:retry and core.download:retry_wait are set in the conan global.conf
+DEFAULT_CONAN_RETRIES = 3
+DEFAULT_CONAN_RETRY_WAIT = 1
+# maximum number of seconds between retries, however many times a request has failed
+DEFAULT_CONAN_MAX_RETRY_WAIT = 30
+# seconds before a duplicate of a slow request is sent, while there are too few recent
+# request times to estimate their 95th percentile
+DEFAULT_CONAN_HEDGE_AFTER = 1.0
+# the conan configuration used to build the conan packages
+DEFAULT_CONAN_CONFIG_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conan-config")
+# conan profiles of the platforms the conan packages are built for
+DEFAULT_CONAN_PROFILES_DIRECTORY = os.path.join(DEFAULT_CONAN_CONFIG_DIRECTORY, "profiles")
 
 if sys.version_info[0] < 3:
     eprint("This script requires python version 3 or greater")
@@ -46,7 +89,7 @@ class ConanVersion:
                    where only "a/b" is mandatory
 
         """
-        debug(f"ConanVersion: s==\"{s}\"")
+        debug("ConanVersion: s==\"%s\"", s)
         # name before slash
         pslash = s.partition('/')
         name = pslash[0]
@@ -57,7 +100,7 @@ class ConanVersion:
         recipe_rev = pver[2] if pver[2] else None
         package_id = ppkg[0] if ppkg[0] else None
         package_rev = ppkg[2] if ppkg[2] else None
-        debug(f"ConanVersion( \"{name}\", \"{version}\", \"{recipe_rev}\", \"{package_id}\", \"{package_rev}\")")
+        debug("ConanVersion( \"%s\", \"%s\", \"%s\", \"%s\", \"%s\")", name, version, recipe_rev, package_id, package_rev)
         return ConanVersion(name, version, recipe_rev, package_id, package_rev)
 
     def to_string(self) -> str:
@@ -118,16 +161,716 @@ class ConanVersion:
 #  http://localhost:8082/artifactory/api/conan/conan-local/v2/files/_/pcre/8.45/_/125d5f684fea10391ff4cbcd809a5c74/package/139391a944851d9dacf1138cff94b3320d5775dd/ce6f2349e761f6350cbde62b02a687c7/conan_package.tgz
 
 
+class ConanFileAdapter(requests.adapters.BaseAdapter):
+    """
+    Serves file:// urls of a Conan mirror directory, so that a ConanTransport can use a
+    local mirror exactly like a conan server
+
+    The mirror directory has the layout of the conan v2 API urls: a url names either a
+    file, like ".../files/conan_package.tgz", or a directory holding the response in
+    index.json, like ".../revisions/index.json" next to the recipe revision directories.
+    A package name search ".../v2/conans/search?q=zlib" is answered from
+    ".../v2/conans/search/zlib.json".  "bootstrap_conan_utils.py mirror" creates them.
+
+    Range requests are supported, so dropped downloads resume as usual.
+    """
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        import urllib3
+
+        url = urllib.parse.urlparse(request.url)
+        path = urllib.request.url2pathname(url.path)
+        q = urllib.parse.parse_qs(url.query).get("q")
+        if q:
+            path = os.path.join(path, f"{q[0]}.json")
+        elif os.path.isdir(path):
+            path = os.path.join(path, "index.json")
+
+        headers = {}
+        try:
+            body = open(path, "rb")
+        except (FileNotFoundError, NotADirectoryError):
+            status, reason = 404, "Not Found"
+            body = json.dumps({"errors": [{"status": 404, "message": f"Not found: {url.path}"}]}).encode()
+            headers["Content-Length"] = str(len(body))
+            body = io.BytesIO(body)
+        else:
+            status, reason = 200, "OK"
+            size = os.fstat(body.fileno()).st_size
+            start = 0
+            range_header = request.headers.get("Range", "")
+            if range_header.startswith("bytes="):
+                start = int(range_header.removeprefix("bytes=").partition("-")[0])
+                body.seek(start)
+                status, reason = 206, "Partial Content"
+                headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+            headers["Content-Length"] = str(size - start)
+
+        raw = urllib3.HTTPResponse(body=body, headers=headers, status=status, reason=reason,
+                                   preload_content=False, decode_content=False)
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response.raw = raw
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def read_conan_global_conf(path: str) -> dict:
+    """Returns the "key = value" settings of a conan global.conf as strings, ignoring comments"""
+    conf = {}
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#") and "=" in line:
+                    k, _, v = line.partition("=")
+                    conf[k.strip()] = v.strip()
+    return conf
+
+
+@dataclass
+class ConanRequestPolicy:
+    """
+    How a ConanTransport sends requests: timeouts, retries and hedging
+
+    Failed requests (connection errors, timeouts, and 429 or 5xx responses) are retried up
+    to `retries` times, waiting an exponentially growing time with random jitter between
+    tries, starting at `retry_wait` seconds, so that many clients don't retry in lockstep.
+
+    With `hedge_after`, a request that hasn't been answered after that many seconds is sent
+    a second time, and the first answer is used, so that a single stalled connection or slow
+    replica doesn't hold up a bootstrap.  hedge_after "p95" waits for the 95th percentile of
+    the times of recent requests instead.  Streamed downloads are never hedged.
+    """
+    # (connect, read) timeouts in seconds, or a single number for both
+    timeout: object = DEFAULT_CONAN_TIMEOUT
+    retries: int = DEFAULT_CONAN_RETRIES
+    retry_wait: float = DEFAULT_CONAN_RETRY_WAIT
+    max_retry_wait: float = DEFAULT_CONAN_MAX_RETRY_WAIT
+    # None, seconds, or "p95"
+    hedge_after: object = None
+
+    # status codes of responses that are retried
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # number of recent request times the hedging percentile is estimated from, and the fewest it needs
+    HEDGE_WINDOW = 200
+    HEDGE_MIN_SAMPLES = 20
+
+    @classmethod
+    def from_config(cls, directory: str = DEFAULT_CONAN_CONFIG_DIRECTORY) -> "ConanRequestPolicy":
+        """
+        Returns the policy set in the global.conf of a conan config directory, the same settings
+        conan downloads with: core.download:retry, core.download:retry_wait and core.net.http:timeout.
+        Hedging is set with the SLM_CONAN_HEDGE_AFTER environment variable, to seconds or "p95".
+        """
+        conf = read_conan_global_conf(os.path.join(directory, "global.conf"))
+        policy = cls()
+        try:
+            if "core.download:retry" in conf:
+                policy.retries = int(conf["core.download:retry"])
+            if "core.download:retry_wait" in conf:
+                policy.retry_wait = float(conf["core.download:retry_wait"])
+            if "core.net.http:timeout" in conf:
+                policy.timeout = float(conf["core.net.http:timeout"])
+        except ValueError as e:
+            log("warning", f"ignoring invalid setting in \"{directory}/global.conf\": {e}")
+        hedge_after = os.environ.get("SLM_CONAN_HEDGE_AFTER")
+        if hedge_after:
+            policy.hedge_after = hedge_after if hedge_after == "p95" else float(hedge_after)
+        return policy
+
+    def backoff(self, attempt: int) -> float:
+        """Returns the seconds to wait before retrying after the attempt-th failure, counting from 0"""
+        wait = min(self.max_retry_wait, self.retry_wait * 2 ** attempt)
+        return random.uniform(wait / 2, wait)
+
+    def hedge_delay(self, recent: list[float]) -> float:
+        """Returns the seconds to wait before hedging a request, given recent request times, or None to not hedge"""
+        if self.hedge_after is None:
+            return None
+        if self.hedge_after != "p95":
+            return float(self.hedge_after)
+        if len(recent) < self.HEDGE_MIN_SAMPLES:
+            return DEFAULT_CONAN_HEDGE_AFTER
+        recent = sorted(recent)
+        return recent[min(len(recent) - 1, int(len(recent) * 0.95))]
+
+
+class ConanTransport:
+    """
+    A pooled, keep-alive HTTP transport shared by all of the Conan API calls, which also
+    reads file:// urls of a local mirror directory (see ConanFileAdapter)
+
+    Connections to each host are kept open and reused between requests, so
+    a bootstrap only pays for the TCP (and TLS) handshake once per host
+    instead of once per request.  Requests are sent with the timeouts, retries and
+    hedging of a ConanRequestPolicy.
+
+    Parameters:
+        timeout: (connect, read) timeout in seconds, or a single number for both.  Optional, Default the policy timeout.
+        max_connections_per_host: maximum number of open connections to any one host.  Optional, Default DEFAULT_CONAN_MAX_CONNECTIONS_PER_HOST.
+        max_hosts: number of per-host connection pools to keep.  Optional, Default 4.
+        policy: ConanRequestPolicy.  Optional, Default ConanRequestPolicy.from_config().
+    """
+    def __init__(self, timeout=None,
+                 max_connections_per_host: int = DEFAULT_CONAN_MAX_CONNECTIONS_PER_HOST,
+                 max_hosts: int = 4, policy: ConanRequestPolicy = None):
+        self.policy = policy or ConanRequestPolicy.from_config()
+        if timeout is not None:
+            self.policy = replace(self.policy, timeout=timeout)
+        self.timeout = self.policy.timeout
+        self.session = requests.Session()
+        # pool_block limits the number of simultaneous connections to each host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_hosts,
+                                                pool_maxsize=max_connections_per_host,
+                                                pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # local mirror directories
+        self.session.mount("file://", ConanFileAdapter())
+        # times of recent successful requests, to hedge the slowest ones
+        self.recent = collections.deque(maxlen=ConanRequestPolicy.HEDGE_WINDOW)
+        self.lock = threading.Lock()
+        self.hedge_executor = None
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Send a GET request over a pooled connection, using the transport timeout unless one is given,
+        and retrying and hedging it as the policy says
+
+        throws Exception (from 'requests') if the last try fails
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if url.startswith("file:") and kwargs.get("params"):
+            # requests only adds query parameters to http urls
+            url += "?" + urllib.parse.urlencode(kwargs.pop("params"))
+        with btu.TRACER.span("GET", "http", url=url) as span:
+            attempt = 0
+            while True:
+                try:
+                    r = self.hedged_get(url, span, **kwargs)
+                    if r.status_code not in ConanRequestPolicy.RETRY_STATUS or attempt >= self.policy.retries:
+                        break
+                    failure = f"status {r.status_code}"
+                    r.close()
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt >= self.policy.retries:
+                        raise
+                    failure = e
+                wait_seconds = self.policy.backoff(attempt)
+                attempt += 1
+                span.args["retries"] = attempt
+                debug("ConanTransport.get: retry %s of \"%s\" in %.2fs after %s", attempt, url, wait_seconds, failure)
+                time.sleep(wait_seconds)
+            span.args["status"] = r.status_code
+            # streamed bodies are counted by whoever reads them
+            if not kwargs.get("stream"):
+                span.args["bytes"] = len(r.content)
+            return r
+
+    def timed_get(self, url: str, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        r = self.session.get(url, **kwargs)
+        if r.status_code < 500 and not kwargs.get("stream"):
+            with self.lock:
+                self.recent.append(time.perf_counter() - start)
+        return r
+
+    def hedged_get(self, url: str, span, **kwargs) -> requests.Response:
+        """Send a GET request, and a duplicate of it if the policy hedges it and it is slow, and return the first response"""
+        with self.lock:
+            delay = None if kwargs.get("stream") else self.policy.hedge_delay(list(self.recent))
+            if delay is not None and self.hedge_executor is None:
+                self.hedge_executor = ThreadPoolExecutor(thread_name_prefix="conan-hedge")
+        if delay is None:
+            return self.timed_get(url, **kwargs)
+
+        first = self.hedge_executor.submit(self.timed_get, url, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        debug("ConanTransport.hedged_get: no response from \"%s\" after %.3fs, sending it again", url, delay)
+        span.args["hedged"] = True
+        second = self.hedge_executor.submit(self.timed_get, url, **kwargs)
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None or not pending:
+                    # the slower request finishes in the background, and its response is dropped
+                    return f.result()
+
+    def close(self):
+        """Close all pooled connections"""
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def default_cache_directory() -> str:
+    """
+    Returns the per-user directory for slm caches shared between projects
+
+    Uses the SLM_CACHE_DIR environment variable if it is set.
+    """
+    if "SLM_CACHE_DIR" in os.environ:
+        return os.environ["SLM_CACHE_DIR"]
+    if platform.system() == "Windows" and "LOCALAPPDATA" in os.environ:
+        return os.path.join(os.environ["LOCALAPPDATA"], "slm", "cache")
+    if "XDG_CACHE_HOME" in os.environ:
+        return os.path.join(os.environ["XDG_CACHE_HOME"], "slm")
+    return os.path.join(os.path.expanduser("~"), ".cache", "slm")
+
+
+class ConanMetadataCache:
+    """
+    A persistent on-disk cache of json responses from the conan server
+
+    Entries are keyed by the query url (which includes the repo url) and query parameters.
+    An entry younger than `ttl` seconds is used without contacting the server.  An older
+    entry is revalidated with If-None-Match / If-Modified-Since, so an unchanged response
+    costs a round trip but no body.  When the cache grows beyond `max_size` bytes, the least
+    recently used entries are evicted until it is back under EVICTION_TARGET of `max_size`.
+    The size of the cache is only measured on the first store, and kept as a running total
+    after that.  In `offline` mode, only cached entries are used, regardless of their age.
+
+    Parameters:
+        directory: directory to store the cache in.  Optional, Default "conan-metadata" in default_cache_directory().
+        ttl: seconds before an entry is revalidated.  Optional, Default DEFAULT_CONAN_METADATA_TTL.
+        max_size: maximum size of the cache in bytes.  Optional, Default DEFAULT_CONAN_METADATA_CACHE_SIZE.
+        offline: bool never contact the server.  Optional, Default False.
+    """
+    def __init__(self, directory: str = None, ttl: float = DEFAULT_CONAN_METADATA_TTL,
+                 max_size: int = DEFAULT_CONAN_METADATA_CACHE_SIZE, offline: bool = False):
+        self.directory = directory if directory is not None else os.path.join(default_cache_directory(), "conan-metadata")
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        # the total size of the cache entries, measured on the first store
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    @staticmethod
+    def from_environment():
+        """
+        A constructor using the settings in the environment variables
+        SLM_CONAN_METADATA_TTL, SLM_CONAN_METADATA_CACHE_SIZE and SLM_OFFLINE
+        """
+        return ConanMetadataCache(
+            ttl=float(os.environ.get("SLM_CONAN_METADATA_TTL", DEFAULT_CONAN_METADATA_TTL)),
+            max_size=int(os.environ.get("SLM_CONAN_METADATA_CACHE_SIZE", DEFAULT_CONAN_METADATA_CACHE_SIZE)),
+            offline=os.environ.get("SLM_OFFLINE", "") not in ("", "0"))
+
+    def path(self, queryurl: str, params: dict = None) -> str:
+        """Returns the path of the cache file for the given query"""
+        key = queryurl
+        if params:
+            key += "?" + urllib.parse.urlencode(sorted(params.items()))
+        h = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, h[:2], f"{h}.json")
+
+    def load(self, queryurl: str, params: dict = None) -> dict:
+        """Returns the cache entry for the given query, or None if there isn't one"""
+        path = self.path(queryurl, params)
+        try:
+            with open(path, "rb") as f:
+                entry = json.load(f)
+            # mark the entry as recently used
+            os.utime(path)
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["stored"] < self.ttl
+
+    def store(self, queryurl: str, params: dict, body: dict, etag: str = None, last_modified: str = None):
+        """Add or replace the cache entry for the given query, evicting old entries if the cache is full"""
+        entry = {"url": queryurl, "params": params, "stored": time.time(),
+                 "etag": etag, "last_modified": last_modified, "body": body}
+        path = self.path(queryurl, params)
+        data = json.dumps(entry).encode()
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        atomic_write(path, data)
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(size for mtime, size, path in self._entries())
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_size:
+                self.evict()
+
+    # the fraction of max_size to evict down to, so a full cache isn't scanned on every store
+    EVICTION_TARGET = 0.9
+
+    def _entries(self) -> list:
+        """Returns the (mtime, size, path) of every cache entry"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for fn in filenames:
+                try:
+                    st = os.stat(os.path.join(dirpath, fn))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(dirpath, fn)))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within EVICTION_TARGET of max_size"""
+        entries = self._entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size * self.EVICTION_TARGET:
+                break
+            debug("ConanMetadataCache: evicting \"%s\"", path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+
+
+class ConanPackageStore:
+    """
+    A local store of downloaded conan_package.tgz files shared between projects
+
+    Packages are stored by their fully-qualified ConanVersion, so the contents of a
+    stored file never change and a stored package can be used without any network access.
+    Files are written to a temporary name and renamed into place, so concurrent
+    bootstraps on the same machine never see a partially written package.
+
+    Parameters:
+        directory: directory to store the packages in.  Optional, Default "conan-packages" in default_cache_directory().
+    """
+    FILENAME = "conan_package.tgz"
+
+    def __init__(self, directory: str = None):
+        self.directory = directory if directory is not None else os.path.join(default_cache_directory(), "conan-packages")
+
+    def path(self, fqcv: ConanVersion) -> str:
+        """Returns the path of the stored package for the fully-qualified ConanVersion"""
+        if fqcv.recipe_revision is None or fqcv.package_id is None or fqcv.package_revision is None:
+            raise RuntimeError(f"conan version \"{fqcv.to_string()}\" must be fully specified with revisions and package_ids")
+        return os.path.join(self.directory, fqcv.name, fqcv.version, fqcv.recipe_revision,
+                            fqcv.package_id, fqcv.package_revision, self.FILENAME)
+
+    def lookup(self, fqcv: ConanVersion) -> str:
+        """Returns the path of the stored package, or None if it is not in the store"""
+        path = self.path(fqcv)
+        try:
+            # mark the package as recently used
+            os.utime(path)
+            return path
+        except OSError:
+            return None
+
+    def gc(self, max_size: int = DEFAULT_CONAN_PACKAGE_STORE_SIZE) -> list[str]:
+        """
+        Remove the least recently used packages until the store is within max_size bytes
+
+        Also removes temporary files left behind by interrupted downloads.
+
+        Returns: list of removed paths
+        """
+        packages = []
+        removed = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if fn.startswith(".tmp-"):
+                    # an abandoned download, unless it is still being written
+                    if time.time() - st.st_mtime > 60 * 60:
+                        removed.append(path)
+                    continue
+                packages.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        for mtime, size, path in sorted(packages):
+            if total <= max_size:
+                break
+            removed.append(path)
+            total -= size
+        for path in removed:
+            debug("ConanPackageStore: removing \"%s\"", path)
+            try:
+                os.remove(path)
+                os.removedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        return removed
+
+
+
+class ConanExtractionCache:
+    """
+    A local cache of extracted conan packages shared between projects
+
+    Packages are extracted once per fully-qualified ConanVersion and set of extracted
+    members, and each project's dependency directory is then materialized from the
+    extracted copy with materialize_tree, instead of extracting the package again.
+    Extraction renames a complete temporary directory into place, so a half-extracted
+    package is never seen.
+
+    Parameters:
+        directory: directory to extract the packages in.  Optional, Default "conan-extracted" in default_cache_directory().
+    """
+    def __init__(self, directory: str = None):
+        self.directory = directory if directory is not None else os.path.join(default_cache_directory(), "conan-extracted")
+
+    def path(self, fqcv: ConanVersion, members: list[str] = None) -> str:
+        """Returns the directory of the extracted package for the fully-qualified ConanVersion and members"""
+        if fqcv.recipe_revision is None or fqcv.package_id is None or fqcv.package_revision is None:
+            raise RuntimeError(f"conan version \"{fqcv.to_string()}\" must be fully specified with revisions and package_ids")
+        key = "all" if members is None else hashlib.sha256("\0".join(sorted(members)).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, fqcv.name, fqcv.version, fqcv.recipe_revision,
+                            fqcv.package_id, fqcv.package_revision, key)
+
+    def lookup(self, fqcv: ConanVersion, members: list[str] = None) -> str:
+        """Returns the directory of the extracted package, or None if it is not in the cache"""
+        path = self.path(fqcv, members)
+        if not os.path.isdir(path):
+            return None
+        # mark the package as recently used
+        os.utime(path)
+        return path
+
+    def ensure(self, fqcv: ConanVersion, members: list[str], extract) -> str:
+        """
+        Returns the directory of the extracted package, calling extract(path) to extract
+        it into path first if it is not in the cache
+
+        Another bootstrap may extract the same package at the same time, in which case
+        the first one to finish wins and the other's extraction is discarded.
+        """
+        path = self.lookup(fqcv, members)
+        if path is not None:
+            return path
+        path = self.path(fqcv, members)
+        try:
+            extract(path)
+        except OSError:
+            if os.path.isdir(path):
+                debug("ConanExtractionCache: \"%s\" was extracted concurrently", path)
+                return path
+            raise
+        return path
+
+
+# ioctl request to share the data blocks of a file with another (Linux btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def reflink(src: str, dst: str):
+    """
+    Create dst as a copy-on-write clone of src
+
+    throws OSError if the platform or filesystem doesn't support it
+    """
+    import fcntl
+    import shutil
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def materialize_tree(source: str, path: str) -> str:
+    """
+    Materialize a copy of the directory tree source at path, which must not exist yet
+
+    Files are reflinked where the filesystem supports it, otherwise hardlinked, and
+    copied if neither works, like across filesystems.  The tree is built in a temporary
+    directory next to path and renamed into place, so it appears complete or not at all.
+
+    Returns: "reflink", "hardlink" or "copy", the method used for the last file
+    """
+    import shutil
+
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    methods = ["reflink", "hardlink", "copy"] if hasattr(os, "link") else ["copy"]
+    if platform.system() != "Linux":
+        methods.remove("reflink")
+
+    def place(src: str, dst: str):
+        # fall back to the next method for the rest of the tree once a method fails
+        while True:
+            method = methods[0]
+            try:
+                if method == "reflink":
+                    reflink(src, dst)
+                elif method == "hardlink":
+                    os.link(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+                return
+            except OSError:
+                if len(methods) == 1:
+                    raise
+                debug("materialize_tree: %s of \"%s\" failed, falling back to %s", method, src, methods[1])
+                methods.pop(0)
+
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        with btu.TRACER.span("materialize", "extract", path=path) as span:
+            for dirpath, dirnames, filenames in os.walk(source):
+                rel = os.path.relpath(dirpath, source)
+                target = os.path.join(tmpdir, rel) if rel != "." else tmpdir
+                for d in dirnames:
+                    src = os.path.join(dirpath, d)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), os.path.join(target, d))
+                    else:
+                        os.makedirs(os.path.join(target, d), exist_ok=True)
+                for fn in filenames:
+                    src = os.path.join(dirpath, fn)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), os.path.join(target, fn))
+                    else:
+                        place(src, os.path.join(target, fn))
+            span.args["method"] = methods[0]
+        os.rename(tmpdir, path)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return methods[0]
+
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+def default_transport() -> ConanTransport:
+    """Returns the process-wide ConanTransport, creating it on first use"""
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = ConanTransport()
+        return _default_transport
+
+
 def urlenc(s: str) -> str:
     """Urlencode the given string"""
     return urllib.parse.quote_plus(s)
 
+def conan_repourl(repo: str) -> str:
+    """Returns the url of a conan repository, which is either a url or the path of a local mirror directory"""
+    if "://" in repo:
+        return repo
+    import pathlib
+    return pathlib.Path(os.path.abspath(repo)).as_uri()
+
 def repourl_from_kwargs(**kwargs) -> str:
-    return kwargs["repourl"] if "repourl" in kwargs else DEFAULT_CONAN_URL
+    return conan_repourl(kwargs["repourl"] if "repourl" in kwargs else os.environ.get("SLM_CONAN_URL", DEFAULT_CONAN_URL))
 
 def target_directory_from_kwargs(**kwargs) -> str:
     return kwargs["target_directory"] if "target_directory" in kwargs else "."
 
+def transport_from_kwargs(**kwargs) -> ConanTransport:
+    return kwargs["transport"] if "transport" in kwargs else default_transport()
+
+def package_store_from_kwargs(**kwargs) -> ConanPackageStore:
+    return kwargs["package_store"] if "package_store" in kwargs else None
+
+def chunk_size_from_kwargs(**kwargs) -> int:
+    return kwargs["chunk_size"] if "chunk_size" in kwargs else DEFAULT_DOWNLOAD_CHUNK_SIZE
+
+def download_retries_from_kwargs(**kwargs) -> int:
+    return kwargs["download_retries"] if "download_retries" in kwargs else DEFAULT_DOWNLOAD_RETRIES
+
+def max_workers_from_kwargs(**kwargs) -> int:
+    return kwargs["max_workers"] if "max_workers" in kwargs else DEFAULT_CONAN_MAX_WORKERS
+
+def profile_from_kwargs(**kwargs) -> dict:
+    return kwargs["profile"] if "profile" in kwargs else host_profile()
+
+def metadata_cache_from_kwargs(**kwargs) -> ConanMetadataCache:
+    return kwargs["metadata_cache"] if "metadata_cache" in kwargs else None
+
+def conan_api_get(queryurl: str, params: dict = None, headers: dict = None, **kwargs) -> requests.Response:
+    """
+    Send a GET request for a Conan API url through the shared transport
+
+    Parameters:
+        queryurl: the full url to request
+        params: dictionary of query parameters.  Optional.
+        headers: dictionary of additional request headers.  Optional.
+    kwargs:
+      transport: ConanTransport to send the request with.  Optional, Default default_transport().
+    """
+    h = {"Content-Type": "application/json"}
+    if headers:
+        h.update(headers)
+    return transport_from_kwargs(**kwargs).get(queryurl, headers=h, params=params)
+
+def conan_api_get_json(queryurl: str, params: dict = None, **kwargs) -> dict:
+    """
+    Get the json response for a Conan API url, using the metadata cache if one is given
+
+    Parameters:
+        queryurl: the full url to request
+        params: dictionary of query parameters.  Optional.
+    kwargs:
+      transport: ConanTransport to send the request with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for responses.  Optional, Default no caching.
+
+    throws Exception (from 'requests') on invalid json returned
+    throws RuntimeError if offline and the response is not cached
+    """
+    cache = metadata_cache_from_kwargs(**kwargs)
+    # a local mirror is as fast as the cache, and always current
+    if cache is None or queryurl.startswith("file:"):
+        return json.loads(conan_api_get(queryurl, params, **kwargs).text)
+
+    entry = cache.load(queryurl, params)
+    if entry is not None and (cache.offline or cache.is_fresh(entry)):
+        debug("conan_api_get_json: cache hit for \"%s\"", queryurl)
+        return entry["body"]
+    if cache.offline:
+        raise RuntimeError(f"Offline and no cached response for \"{queryurl}\"")
+
+    # revalidate a stale entry, so that the server can skip sending an unchanged body
+    headers = {}
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    response = conan_api_get(queryurl, params, headers, **kwargs)
+    if response.status_code == 304 and entry is not None:
+        debug("conan_api_get_json: cache revalidated for \"%s\"", queryurl)
+        body = entry["body"]
+    else:
+        body = json.loads(response.text)
+        if response.status_code != 200 or "errors" in body:
+            return body
+    cache.store(queryurl, params, body, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return body
+
 def conan_search_package_name(package_name: str, **kwargs) -> json:
     """
     Search for the given package name on the conan server
@@ -135,7 +878,9 @@ def conan_search_package_name(package_name: str, **kwargs) -> json:
     Parameters:
       package_name: str The package name to find.  Only the name, no version components.
     kwargs:
-      repourl: str The repo to search.  Optional, Default DEFAULT_CONAN_URL.
+      repourl: str The repo to search.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for search responses.  Optional, Default no caching.
 
     Returns: json results
 
@@ -143,11 +888,9 @@ def conan_search_package_name(package_name: str, **kwargs) -> json:
     """
     repourl = repourl_from_kwargs(**kwargs)
     queryurl = f"{repourl}/v2/conans/search"
-    headers = {"Content-Type": "application/json"}
     params = {"q": package_name}
 
-    response = requests.get(queryurl, headers=headers, params=params)
-    return json.loads(response.text)
+    return conan_api_get_json(queryurl, params, **kwargs)
 
 
 def conan_get_recipe_revisions(package_name: str, package_version: str, **kwargs) -> dict:
@@ -158,16 +901,16 @@ def conan_get_recipe_revisions(package_name: str, package_version: str, **kwargs
         package_name
         package_version
     kwargs:
-      repourl: str The repo to search.  Optional, Default DEFAULT_CONAN_URL.
+      repourl: str The repo to search.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for search responses.  Optional, Default no caching.
 
     throws RuntimeError on invalid json returned
     """
     repourl = repourl_from_kwargs(**kwargs)
     queryurl = f"{repourl}/v2/conans/{urlenc(package_name)}/{urlenc(package_version)}/_/_/revisions"
-    headers = {"Content-Type": "application/json"}
 
-    response = requests.get(queryurl, headers=headers)
-    jresult = json.loads(response.text)
+    jresult = conan_api_get_json(queryurl, **kwargs)
     if "errors" in jresult:
       raise RuntimeError("Conan error while getting recipe revisions for \"{package_name}/{package_version}\": \"{jresult}\"")
     return jresult["revisions"]
@@ -182,17 +925,17 @@ def conan_get_package_ids_for_revision(package_name: str, package_version: str,
         package_version
         recipe_revision
     kwargs:
-      repourl: str The repo to search.  Optional, Default DEFAULT_CONAN_URL.
+      repourl: str The repo to search.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for search responses.  Optional, Default no caching.
 
     throws RuntimeError on invalid json returned
     """
     repourl = repourl_from_kwargs(**kwargs)
     # search for available package_ids of the recipe revision
     queryurl = f"{repourl}/v2/conans/{urlenc(package_name)}/{urlenc(package_version)}/_/_/revisions/{urlenc(recipe_revision)}/search"
-    headers = {"Content-Type": "application/json"}
 
-    response = requests.get(queryurl, headers=headers)
-    jresult = json.loads(response.text)
+    jresult = conan_api_get_json(queryurl, **kwargs)
     if "errors" in jresult:
       raise RuntimeError("Conan error while getting package_ids for recipe revision \"{package_name}/{package_version}#{recipe_revision}\": \"{jresult}\"")
     return jresult
@@ -208,7 +951,9 @@ def conan_get_package_revisions(package_name: str, package_version: str, recipe_
         recipe_revision
         package_id
     kwargs:
-      repourl: str The repo to search.  Optional, Default DEFAULT_CONAN_URL.
+      repourl: str The repo to search.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for search responses.  Optional, Default no caching.
 
     throws Exception (from 'requests') on invalid json returned
     throws RuntimeError on error finding package
@@ -217,19 +962,147 @@ def conan_get_package_revisions(package_name: str, package_version: str, recipe_
     # search for available package_ids of the recipe revision
     queryurl = f"{repourl}/v2/conans/{urlenc(package_name)}/{urlenc(package_version)}/_/_/" + \
                f"revisions/{urlenc(recipe_revision)}/packages/{urlenc(package_id)}/revisions"
-    headers = {"Content-Type": "application/json"}
 
-    response = requests.get(queryurl, headers=headers)
-    jresult = json.loads(response.text)
+    jresult = conan_api_get_json(queryurl, **kwargs)
     if "errors" in jresult:
       raise RuntimeError("Conan error while getting package revisions for package_id \"{package_name}/{package_version}#{recipe_revision}\": \"{jresult}\"")
     return jresult["revisions"]
 
 
+def conan_os() -> str:
+    """Returns the conan "os" setting of the platform we're running on, like "Linux" or "Macos" """
+    system = platform.system()
+    return "Macos" if system == "Darwin" else system
+
+def conan_arch() -> str:
+    """Returns the conan "arch" setting of the machine we're running on, like "x86_64" or "armv8" """
+    machine = platform.machine().lower()
+    ARCHS = {"amd64": "x86_64", "x64": "x86_64", "aarch64": "armv8", "arm64": "armv8", "i386": "x86", "i686": "x86"}
+    return ARCHS.get(machine, machine)
+
+def read_conan_profile_settings(path: str) -> dict:
+    """Returns the [settings] section of a conan profile file as a dictionary"""
+    settings = {}
+    section = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("["):
+                section = line.strip("[]")
+            elif section == "settings" and "=" in line:
+                k, _, v = line.partition("=")
+                settings[k.strip()] = v.strip()
+    return settings
+
+# the arch of the profiles to fall back to on a machine without profiles for its own arch, like
+# x86_64 packages on Apple Silicon through Rosetta
+FALLBACK_CONAN_ARCH = "x86_64"
+
+@functools.lru_cache
+def host_profile(directory: str = DEFAULT_CONAN_PROFILES_DIRECTORY) -> dict:
+    """
+    Returns the conan settings packages are matched against: those of the default profile
+    of this platform in directory, like "linux-x86_64-default", which the conan packages
+    are built with.  Without a profile for the arch of this machine, those of the FALLBACK_CONAN_ARCH
+    profile of its os.  Without either, just the os and arch of this machine.
+    """
+    profile = {"os": conan_os(), "arch": conan_arch()}
+    for arch in dict.fromkeys((profile["arch"], FALLBACK_CONAN_ARCH)):
+        path = os.path.join(directory, f"{profile['os'].lower()}-{arch}-default")
+        if os.path.isfile(path):
+            profile.update(read_conan_profile_settings(path))
+            break
+    debug("host_profile: %s", profile)
+    return profile
+
+def normalize_option_value(value) -> str:
+    """Returns an option value the way the conan server reports it, like "True" for true or "true" """
+    s = str(value).strip()
+    return s.capitalize() if s.lower() in ("true", "false") else s
+
+def normalize_options(options: dict) -> dict:
+    return {str(k): normalize_option_value(v) for k, v in options.items()}
+
+# settings a package must not contradict to be usable on this platform
+REQUIRED_SETTINGS = ("os", "arch")
+
+def score_package(package_info: dict, profile: dict, options: dict) -> int:
+    """
+    Scores how well a package from a package_id search matches the host profile and the
+    normalized options
+
+    Returns: None if the package can't be used: its os or arch differ from the profile, or
+             its options differ.  Otherwise a score that is higher the closer its compiler
+             and compiler.version are to the profile.
+    """
+    settings = package_info.get("settings", {})
+    for s in REQUIRED_SETTINGS:
+        if s in settings and settings[s] != profile.get(s):
+            return None
+    if normalize_options(package_info.get("options", {})) != options:
+        return None
+    score = 0
+    if "compiler" in settings and settings["compiler"] == profile.get("compiler"):
+        score += 4
+        version, wanted = settings.get("compiler.version", ""), profile.get("compiler.version", "")
+        if version == wanted:
+            score += 3
+        elif version.split(".")[0] == wanted.split(".")[0]:
+            score += 2
+    return score
+
+def select_package(package_infos: dict, profile: dict, options: dict) -> str:
+    """
+    Returns the package_id of the best scoring package of a package_id search, the first
+    listed of equally good ones, or None if none can be used
+    """
+    best, best_score = None, None
+    for package_id, package_info in package_infos.items():
+        ### package_info format:
+        # {
+        # "settings":     {
+        #         "os":   "Windows",
+        #         "compiler.threads":     "posix",
+        #         "compiler.exception":   "seh",
+        #         "arch": "x86_64",
+        #         "compiler":     "gcc",
+        #         "build_type":   "Release",
+        #         "compiler.version":     "11.2"
+        # },
+        # "options":      {
+        #         "build_pcrecpp":        "False",
+        #         "shared":       "True",
+        #         "with_jit":     "False"
+        # }
+        score = score_package(package_info, profile, options)
+        debug("select_package: package \"%s\" settings = %s options = %s score = %s",
+              package_id, package_info.get("settings"), package_info.get("options"), score)
+        if score is not None and (best_score is None or score > best_score):
+            best, best_score = package_id, score
+    return best
+
+def revision_time(revision: dict) -> datetime:
+    """Returns the time of a recipe or package revision, or the earliest time if it can't be parsed"""
+    try:
+        return datetime.fromisoformat(revision["time"])
+    except (KeyError, TypeError, ValueError):
+        return datetime.min.replace(tzinfo=timezone.utc)
+
+def newest_first(revisions: list[dict]) -> list[dict]:
+    """Returns revisions sorted by time, newest first, keeping the server's order of equal times"""
+    return sorted(revisions, key=revision_time, reverse=True)
+
+
 def conan_fully_qualify_latest_version(cv: ConanVersion, **kwargs) -> ConanVersion:
     """
     Searches the given conan repository for the latest package matching the given ConanVersion and options.
 
+    Recipe revisions are tried newest first.  In each, the package_id whose settings best
+    match the host profile is chosen (see score_package), and only its package revisions
+    are fetched, of which the newest is returned.
+
     Parameters:
         package_name
         package_version
@@ -237,13 +1110,17 @@ def conan_fully_qualify_latest_version(cv: ConanVersion, **kwargs) -> ConanVersi
         package_id
     kwargs:
       options: dictionary of key/value options.  Optional, Default empty dictionary.
-      repourl: str The repo to search.  Optional, Default DEFAULT_CONAN_URL.
+      profile: dictionary of the conan settings to match.  Optional, Default host_profile().
+      repourl: str The repo to search.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for search responses.  Optional, Default no caching.
+      max_workers: int The maximum number of concurrent package_id searches.  Optional, Default DEFAULT_CONAN_MAX_WORKERS.
 
     throws Exception (from 'requests') on failure
     throws RuntimeError package not found
     """
 
-    debug(f"conan_fully_qualify_latest_version: qualifying version: {cv.to_string()}")
+    debug("conan_fully_qualify_latest_version: qualifying version: %s", cv.to_string())
     # If the cv has already has all of the parts, then return it unchanged
     if not (cv.package_id is None or cv.recipe_revision is None or cv.package_revision is None):
         return cv
@@ -251,89 +1128,119 @@ def conan_fully_qualify_latest_version(cv: ConanVersion, **kwargs) -> ConanVersi
         package_name = cv.name
         package_version = cv.version
         options = kwargs["options"] if "options" in kwargs else {}
+        profile = profile_from_kwargs(**kwargs)
 
-        current_conan_os = platform.system()
-        if current_conan_os == "Darwin":
-            current_conan_os = "Macos"
-
-        # look for platform-specific options (if any) and apply them to the requested options list.  Remove options for other platforms.
-        oslc = current_conan_os.lower()
-        if oslc in options:
-            # copy the platform-specific options to the top level
-            for k, v in options[oslc].items():
-                options[k] = v
-        # remove all other platforms
-        for plat in ("linux", "macos", "windows"):
-            if plat in options:
-                del options[plat]
+        # apply the platform-specific options (if any) of the host os, and drop the ones of other platforms
+        options = normalize_options(slm_toml.platform_options(options, profile["os"].lower()))
 
         # search for available recipe revisions using just the name and version
-        for rr in conan_get_recipe_revisions(package_name, package_version, **kwargs):
-            recipe_revision = rr["revision"]
-            recipe_revision_time = rr["time"]
-            debug(f"conan-fully_qualify_latest_version: recipe_revision: \"{recipe_revision}\" on \"{recipe_revision_time}\"")
-
-            for package_id, package_info in conan_get_package_ids_for_revision(package_name, package_version, recipe_revision, **kwargs).items():
-                ### package_info format:
-                # {
-                # "settings":     {
-                #         "os":   "Windows",
-                #         "compiler.threads":     "posix",
-                #         "compiler.exception":   "seh",
-                #         "arch": "x86_64",
-                #         "compiler":     "gcc",
-                #         "build_type":   "Release",
-                #         "compiler.version":     "11.2"
-                # },
-                # "options":      {
-                #         "build_pcrecpp":        "False",
-                #         "build_pcre_16":        "False",
-                #         "build_pcre_8": "True",
-                #         "shared":       "True",
-                #         "with_stack_for_recursion":     "True",
-                #         "build_pcregrep":       "False",
-                #         "build_pcre_32":        "False",
-                #         "with_utf":     "True",
-                #         "with_unicode_properties":      "True",
-                #         "with_jit":     "False"
-                # }
-
-                # look for packages compiled for the current os we're running on
-                # TODO this could be improved with arch and compiler checks
-                #      but for now just check os
-                package_settings_os = package_info["settings"]["os"]
-                if package_settings_os != current_conan_os:
-                    # not our os
-                    debug(f"conan_fully_qualify_latest_version: package \"{package_id}\" os = \"{package_settings_os}\" [SKIP]")
-                else:
-                    debug(f"conan_fully_qualify_latest_version: package \"{package_id}\" os = \"{package_settings_os}\" [ok]")
-
-                    # ensure the desired options match this package's options
-                    if options == package_info["options"]:
-                        # this package matches our os and the requested options
-                        # get the latest revision for this package
-                        for pr in conan_get_package_revisions(package_name, package_version, recipe_revision, package_id, **kwargs):
-                            package_revision = pr["revision"]
-                            package_revision_time = pr["time"]
-                            debug(f"conan_fully_qualify_latest_version: package_revision: \"{package_revision}\" on \"{package_revision_time}\"")
-
-                            # NOTE: assuming that the most recent revision is listed first
-                            # if this turns out not to be the case, then sort by package_revision_time
-                            fqcv = ConanVersion(package_name, package_version, recipe_revision, package_id, package_revision)
-                            debug(f"conan_fully_qualify_latest_version: found \"{fqcv}\"")
-                            return(fqcv)
-                    else:
-                        debug(f"conan_fully_qualify_latest_version: options \"{options}\" doesn't match \"{package_info['options']}\"")
-
+        recipe_revisions = newest_first(conan_get_recipe_revisions(package_name, package_version, **kwargs))
+
+        # search all of the recipe revisions for package_ids concurrently, then check the
+        # results newest first, so that the newest match wins
+        executor = ThreadPoolExecutor(max_workers=max_workers_from_kwargs(**kwargs))
+        try:
+            package_id_searches = [executor.submit(conan_get_package_ids_for_revision, package_name, package_version, rr["revision"], **kwargs)
+                                   for rr in recipe_revisions]
+            for rr, package_id_search in zip(recipe_revisions, package_id_searches):
+                recipe_revision = rr["revision"]
+                debug("conan-fully_qualify_latest_version: recipe_revision: \"%s\" on \"%s\"", recipe_revision, rr["time"])
+
+                package_id = select_package(package_id_search.result(), profile, options)
+                if package_id is None:
+                    debug("conan_fully_qualify_latest_version: no package of \"%s\" matches %s and options %s", recipe_revision, profile, options)
+                    continue
+
+                # get the latest revision of the selected package only
+                package_revisions = newest_first(conan_get_package_revisions(package_name, package_version, recipe_revision, package_id, **kwargs))
+                if package_revisions:
+                    fqcv = ConanVersion(package_name, package_version, recipe_revision, package_id, package_revisions[0]["revision"])
+                    debug("conan_fully_qualify_latest_version: found \"%s\" from \"%s\"", fqcv, package_revisions[0]["time"])
+                    return(fqcv)
+        finally:
+            # don't wait for searches of older revisions once a match is found
+            executor.shutdown(wait=False, cancel_futures=True)
 
     # if we reach here, we didn't find a match
     raise RuntimeError("conan search could not find matching package for options")
 
 
+class ConanResolver:
+    """
+    Resolves conan versions and options to fully qualified ConanVersions concurrently
+
+    Each distinct query is resolved once, however many times it is submitted, so a caller
+    can submit every conan dependency up front and then wait for each one just before
+    downloading it, and downloads start as soon as their own package is resolved.
+
+        with ConanResolver(metadata_cache=cache) as resolver:
+            plan = resolver.plan([(ConanVersion("zlib", "1.3.1"), {"shared": "False"}), ...])
+
+    kwargs are passed to conan_fully_qualify_latest_version, and max_workers also limits
+    the number of packages resolved at a time.
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers_from_kwargs(**kwargs), thread_name_prefix="conan-resolve")
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def key(cv: ConanVersion, options: dict) -> tuple:
+        return (cv.to_string(), json.dumps(options or {}, sort_keys=True, default=str))
+
+    def submit(self, cv: ConanVersion, options: dict = None):
+        """Returns a Future of the fully qualified ConanVersion of cv with options, starting to resolve it unless it already is"""
+        key = self.key(cv, options)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None:
+                future = self.executor.submit(self._resolve, cv, dict(options or {}))
+                self.futures[key] = future
+            else:
+                debug("ConanResolver.submit: already resolving \"%s\"", cv.to_string())
+        return future
+
+    def _resolve(self, cv: ConanVersion, options: dict) -> ConanVersion:
+        with btu.TRACER.span(f"resolve {cv.to_string()}", "conan"):
+            return conan_fully_qualify_latest_version(cv, **{**self.kwargs, "options": options})
+
+    def resolve(self, cv: ConanVersion, options: dict = None) -> ConanVersion:
+        """
+        Returns the fully qualified ConanVersion of cv with options
+
+        throws the exceptions of conan_fully_qualify_latest_version
+        """
+        return self.submit(cv, options).result()
+
+    def plan(self, queries: list) -> list[ConanVersion]:
+        """
+        Resolve a list of (ConanVersion, options) queries concurrently
+
+        Returns: the fully qualified ConanVersions, in the order of the queries
+        """
+        futures = [self.submit(cv, options) for cv, options in queries]
+        return [f.result() for f in futures]
+
+
 def conan_download_package(cv: ConanVersion, **kwargs) -> str :
     """
     returns path to downloaded file
 
+    The ConanVersion must be fully qualified, see conan_fully_qualify_latest_version.
+
+    If a package store is given, the package is downloaded into the store instead of
+    target_directory, and a package that is already in the store is not downloaded again.
+
     Parameters:
         package_name
         package_version
@@ -341,39 +1248,1122 @@ def conan_download_package(cv: ConanVersion, **kwargs) -> str :
         package_id
     kwargs:
       target_directory: directory to save the downloaded file into. Optional, Default current directory.
-      repourl: str The repo to search.  Optional, Default DEFAULT_CONAN_URL.
+      package_store: ConanPackageStore to look up and save the downloaded file in.  Optional, Default no store.
+      verify_manifest: bool check the downloaded files against conanmanifest.txt.  Optional, Default True.
+      repourl: str The repo to search.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for search responses.  Optional, Default no caching.
+      chunk_size: int buffer size in bytes.  Optional, Default DEFAULT_DOWNLOAD_CHUNK_SIZE.
+      download_retries: int number of times to resume a dropped download.  Optional, Default DEFAULT_DOWNLOAD_RETRIES.
 
     throws Exception (from 'requests') on failure or package not found
-    throws RuntimeError on invalid arguments
+    throws RuntimeError on invalid arguments or if the package fails an integrity check
     """
-    debug(f"conan_download_package: downloading version: {cv.to_string()}")
+    debug("conan_download_package: downloading version: %s", cv.to_string())
     target_directory = target_directory_from_kwargs(**kwargs)
     repourl = repourl_from_kwargs(**kwargs)
+    store = package_store_from_kwargs(**kwargs)
 
-    fqcv = conan_fully_qualify_latest_version(cv, **kwargs)
-
-    if cv.package_id is None or cv.recipe_revision is None or cv.package_revision is None:
+    # resolve versions with conan_fully_qualify_latest_version or ConanResolver first
+    fqcv = cv
+    if fqcv.package_id is None or fqcv.recipe_revision is None or fqcv.package_revision is None:
       raise RuntimeError("conan version must be fully specified with revisions and package_ids")
 
-    downloadurl = f"{repourl}/v2/conans/{urlenc(cv.name)}/{urlenc(cv.version)}/_/_/" + \
-                  f"revisions/{urlenc(cv.recipe_revision)}/packages/{urlenc(cv.package_id)}/revisions/{urlenc(cv.package_revision)}/files/conan_package.tgz"
-    headers = {"Content-Type": "application/json"}
-    debug(f"conan_download_package: downloadurl: \"{downloadurl}\"")
+    if store is not None:
+        outfile = store.lookup(fqcv)
+        if outfile is not None:
+            debug("conan_download_package: found in store: \"%s\"", outfile)
+            return outfile
+        outfile = store.path(fqcv)
+    else:
+        outfile = f"{target_directory}/conan_package_{fqcv.name}_{fqcv.version}_{fqcv.package_id}.tgz"
+    debug("conan_download_package: outfile: \"%s\"", outfile)
+
+    filesurl = f"{repourl}/v2/conans/{urlenc(fqcv.name)}/{urlenc(fqcv.version)}/_/_/" + \
+               f"revisions/{urlenc(fqcv.recipe_revision)}/packages/{urlenc(fqcv.package_id)}/revisions/{urlenc(fqcv.package_revision)}/files"
+    downloadurl = f"{filesurl}/conan_package.tgz"
+    debug("conan_download_package: downloadurl: \"%s\"", downloadurl)
+
+    check = None
+    if kwargs.get("verify_manifest", True):
+        response = conan_api_get(f"{filesurl}/conanmanifest.txt", **kwargs)
+        response.raise_for_status()
+        manifest = parse_conan_manifest(response.text)
+        check = lambda path: conan_verify_package(path, manifest)
+
+    return download_file(downloadurl, outfile, check, **kwargs)
+
+
+def write_revisions_index(directory: str, revisions: list[dict]):
+    """Add revisions to the index.json of a mirror revisions directory, keeping the ones already mirrored"""
+    path = os.path.join(directory, "index.json")
+    merged = {}
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            merged = {r["revision"]: r for r in json.load(f)["revisions"]}
+    merged.update({r["revision"]: {"revision": r["revision"], "time": r["time"]} for r in revisions})
+    atomic_write(path, json.dumps({"revisions": newest_first(list(merged.values()))}, indent=1).encode())
+
+def conan_mirror_package(cv: ConanVersion, directory: str, latest: bool = False, **kwargs) -> int:
+    """
+    Copy conan packages from a repository into a local mirror directory, which bootstrap.py
+    can then use with SLM_CONAN_URL set to the directory (see ConanFileAdapter)
+
+    Mirrors every recipe revision, package_id and package revision of cv, or only the ones
+    given in cv.  Package files that are already in the mirror are not downloaded again, and
+    revisions are listed in the mirror only after their files are complete, so a mirror can
+    be updated while bootstraps are using it.
+
+    Parameters:
+        cv: the ConanVersion to mirror, like "zlib/1.3.1", or fully qualified
+        directory: the mirror directory
+        latest: only mirror the newest recipe revision, and the newest revision of each of its packages
+    kwargs:
+      repourl: str The repo to copy from.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+
+    Returns: the number of packages downloaded
 
-    outfile = f"{target_directory}/conan_package_{fqcv.name}_{fqcv.version}_{fqcv.package_id}.tgz"
-    debug(f"conan_download_package: outfile: \"{outfile}\"")
+    throws Exception (from 'requests') on failure
+    throws RuntimeError if a package fails an integrity check
+    """
+    repourl = repourl_from_kwargs(**kwargs)
+    root = os.path.join(directory, "v2", "conans", cv.name, cv.version, "_", "_", "revisions")
+    downloaded = 0
+
+    recipe_revisions = newest_first(conan_get_recipe_revisions(cv.name, cv.version, **kwargs))
+    if cv.recipe_revision is not None:
+        recipe_revisions = [rr for rr in recipe_revisions if rr["revision"] == cv.recipe_revision]
+    elif latest:
+        recipe_revisions = recipe_revisions[:1]
+    for rr in recipe_revisions:
+        rrdir = os.path.join(root, rr["revision"])
+        package_infos = conan_get_package_ids_for_revision(cv.name, cv.version, rr["revision"], **kwargs)
+        if cv.package_id is not None:
+            package_infos = {pid: info for pid, info in package_infos.items() if pid == cv.package_id}
+        for package_id in package_infos:
+            package_revisions = newest_first(conan_get_package_revisions(cv.name, cv.version, rr["revision"], package_id, **kwargs))
+            if cv.package_revision is not None:
+                package_revisions = [pr for pr in package_revisions if pr["revision"] == cv.package_revision]
+            elif latest:
+                package_revisions = package_revisions[:1]
+            prdir = os.path.join(rrdir, "packages", package_id, "revisions")
+            for pr in package_revisions:
+                files = os.path.join(prdir, pr["revision"], "files")
+                if os.path.isfile(os.path.join(files, "conanmanifest.txt")):
+                    continue
+                fqcv = ConanVersion(cv.name, cv.version, rr["revision"], package_id, pr["revision"])
+                log("info", f"mirroring \"{fqcv.to_string()}\"")
+                filesurl = f"{repourl}/v2/conans/{urlenc(fqcv.name)}/{urlenc(fqcv.version)}/_/_/" + \
+                           f"revisions/{urlenc(fqcv.recipe_revision)}/packages/{urlenc(fqcv.package_id)}/revisions/{urlenc(fqcv.package_revision)}/files"
+                response = conan_api_get(f"{filesurl}/conanmanifest.txt", **kwargs)
+                response.raise_for_status()
+                manifest = parse_conan_manifest(response.text)
+                download_file(f"{filesurl}/conan_package.tgz", os.path.join(files, "conan_package.tgz"),
+                              lambda path: conan_verify_package(path, manifest), **kwargs)
+                # the manifest marks the package revision as complete
+                atomic_write(os.path.join(files, "conanmanifest.txt"), response.content)
+                downloaded += 1
+            write_revisions_index(prdir, package_revisions)
+        # list only the package_ids that are mirrored, merged with the ones mirrored before
+        search = os.path.join(rrdir, "search")
+        if os.path.isfile(search):
+            with open(search, "r") as f:
+                package_infos = {**json.load(f), **package_infos}
+        atomic_write(search, json.dumps(package_infos, indent=1).encode())
+    write_revisions_index(root, recipe_revisions)
+
+    # the package name search
+    search = os.path.join(directory, "v2", "conans", "search", f"{cv.name}.json")
+    results = []
+    if os.path.isfile(search):
+        with open(search, "r") as f:
+            results = json.load(f)["results"]
+    if f"{cv.name}/{cv.version}@_/_" not in results:
+        atomic_write(search, json.dumps({"results": sorted(results + [f"{cv.name}/{cv.version}@_/_"])}).encode())
+    return downloaded
+
+
+def download_file(url: str, outfile: str, check=None, **kwargs) -> str:
+    """
+    Download a url to a file, resuming the download if the connection drops
 
-    # download url to file
-    r = requests.get(downloadurl, stream=True)
-    with open(outfile, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=128):
-            fd.write(chunk)
+    The file is downloaded to a temporary file next to outfile, and renamed into place
+    only when it is complete and has passed the integrity checks, so outfile is never
+    seen partially written.  Dropped downloads are resumed from where they stopped with
+    an HTTP Range request.  The downloaded size is checked against the Content-Length,
+    and the sha1 against the X-Checksum-Sha1 header if the server (Artifactory) sends one.
+
+    Parameters:
+        url: the url to download
+        outfile: path of the file to save the download as
+        check: function called with the path of the complete temporary file, to raise an error if it is invalid.  Optional.
+    kwargs:
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      chunk_size: int buffer size in bytes.  Optional, Default DEFAULT_DOWNLOAD_CHUNK_SIZE.
+      download_retries: int number of times to resume a dropped download.  Optional, Default DEFAULT_DOWNLOAD_RETRIES.
+
+    Returns: outfile
+
+    throws Exception (from 'requests') on failure
+    throws RuntimeError if the downloaded file fails an integrity check
+    """
+    transport = transport_from_kwargs(**kwargs)
+    chunk_size = chunk_size_from_kwargs(**kwargs)
+    retries = download_retries_from_kwargs(**kwargs)
+
+    outdir = os.path.dirname(os.path.abspath(outfile))
+    os.makedirs(outdir, exist_ok=True)
+    fd, tmpfile = tempfile.mkstemp(dir=outdir, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f, btu.TRACER.span("download", "download", url=url) as span:
+            sha1 = hashlib.sha1()
+            received = 0
+            headers = {}
+            while True:
+                try:
+                    with transport.get(url, headers=headers, stream=True) as r:
+                        r.raise_for_status()
+                        if received > 0 and r.status_code != 206:
+                            # the server didn't honor the range request, start over
+                            debug("download_file: restarting download of \"%s\"", url)
+                            f.seek(0)
+                            f.truncate()
+                            sha1 = hashlib.sha1()
+                            received = 0
+                        if received == 0:
+                            etag = r.headers.get("ETag")
+                            expected_sha1 = r.headers.get("X-Checksum-Sha1")
+                            expected_size = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            sha1.update(chunk)
+                            received += len(chunk)
+                    span.args["bytes"] = received
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    if retries <= 0:
+                        raise
+                    retries -= 1
+                    debug("download_file: resuming \"%s\" at byte %s after error: %s", url, received, e)
+                    span.args["resumes"] = span.args.get("resumes", 0) + 1
+                    headers = {"Range": f"bytes={received}-"}
+                    if received > 0 and etag:
+                        # only resume if the file hasn't changed on the server
+                        headers["If-Range"] = etag
+
+        if expected_size is not None and received != expected_size:
+            raise RuntimeError(f"Downloaded {received} bytes from \"{url}\" but expected {expected_size}")
+        if expected_sha1 and sha1.hexdigest() != expected_sha1.lower():
+            raise RuntimeError(f"Checksum mismatch for \"{url}\": sha1 {sha1.hexdigest()} != {expected_sha1}")
+        if check is not None:
+            check(tmpfile)
+        os.replace(tmpfile, outfile)
+    except BaseException:
+        os.remove(tmpfile)
+        raise
 
     return outfile
 
 
+def parse_conan_manifest(text: str) -> dict[str, str]:
+    """
+    Parse the contents of a conanmanifest.txt file
+
+    The first line is a timestamp, followed by lines in the form "path: md5"
+
+    Returns: dictionary of file path to md5
+    """
+    manifest = {}
+    for line in text.splitlines()[1:]:
+        path, sep, md5 = line.rpartition(": ")
+        if sep:
+            manifest[path] = md5.strip()
+    return manifest
+
+
+def conan_verify_package(tgzpath: str, manifest: dict[str, str]):
+    """
+    Check the files in a conan_package.tgz against the md5s from its conanmanifest.txt
+
+    throws RuntimeError if a file is missing or its md5 doesn't match
+    """
+    import tarfile
+
+    md5s = {}
+    links = {}
+    with tarfile.open(tgzpath, "r:gz") as tf:
+        for m in tf:
+            if m.isfile():
+                h = hashlib.md5()
+                with tf.extractfile(m) as f:
+                    while chunk := f.read(DEFAULT_DOWNLOAD_CHUNK_SIZE):
+                        h.update(chunk)
+                md5s[m.name] = h.hexdigest()
+            elif m.issym():
+                links[m.name] = os.path.normpath(os.path.join(os.path.dirname(m.name), m.linkname)).replace(os.sep, "/")
+    # conan hashes the contents of the file a symlink points to
+    for name, target in links.items():
+        if target in md5s:
+            md5s[name] = md5s[target]
+
+    for path, md5 in manifest.items():
+        if path in ("conaninfo.txt", "conanmanifest.txt"):
+            # not part of conan_package.tgz
+            continue
+        if path not in md5s:
+            if path in links:
+                continue
+            raise RuntimeError(f"Package \"{tgzpath}\" is missing \"{path}\" listed in its conanmanifest.txt")
+        if md5s[path] != md5:
+            raise RuntimeError(f"Package \"{tgzpath}\" file \"{path}\" md5 {md5s[path]} doesn't match conanmanifest.txt {md5}")
+
+
+def conan_stream_extract_package(cv: ConanVersion, path: str, members: list[str] = None, **kwargs) -> ConanVersion:
+    """
+    Download a conan package and extract it into a directory as it downloads, without
+    saving the conan_package.tgz
+
+    The files are checked against conanmanifest.txt as they are extracted, and the
+    extracted package is only moved to path when it is complete.  Unlike
+    conan_download_package, a dropped download can't be resumed.
+
+    Parameters:
+        cv: the fully qualified ConanVersion to download
+        path: directory to extract the package into, which must not exist yet
+        members: list of path prefixes, like "include/", of the files to extract.  Optional, Default all files.
+    kwargs:
+      repourl: str The repo to search.  Optional, Default SLM_CONAN_URL or DEFAULT_CONAN_URL.
+      transport: ConanTransport to send requests with.  Optional, Default default_transport().
+      metadata_cache: ConanMetadataCache to use for search responses.  Optional, Default no caching.
+
+    Returns: the fully-qualified ConanVersion that was extracted
+
+    throws Exception (from 'requests') on failure or package not found
+    throws RuntimeError if cv isn't fully qualified, or the package contains an unsafe path or fails an integrity check
+    """
+    debug("conan_stream_extract_package: extracting version: %s into \"%s\"", cv.to_string(), path)
+    repourl = repourl_from_kwargs(**kwargs)
+    fqcv = cv
+    if fqcv.package_id is None or fqcv.recipe_revision is None or fqcv.package_revision is None:
+      raise RuntimeError("conan version must be fully specified with revisions and package_ids")
+    filesurl = f"{repourl}/v2/conans/{urlenc(fqcv.name)}/{urlenc(fqcv.version)}/_/_/" + \
+               f"revisions/{urlenc(fqcv.recipe_revision)}/packages/{urlenc(fqcv.package_id)}/revisions/{urlenc(fqcv.package_revision)}/files"
+
+    response = conan_api_get(f"{filesurl}/conanmanifest.txt", **kwargs)
+    response.raise_for_status()
+    manifest_text = response.text
+
+    with transport_from_kwargs(**kwargs).get(f"{filesurl}/conan_package.tgz", stream=True) as r, \
+         btu.TRACER.span("stream-extract", "extract", package=fqcv.to_string()) as span:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        extract_conan_package(r.raw, path, members, manifest_text)
+        span.args["bytes"] = r.raw.tell()
+    return fqcv
+
+
+def check_safe_member(member, root: str):
+    """
+    Check that extracting a tar member into root can't write outside of root
+
+    throws RuntimeError for absolute paths, paths containing "..", links pointing
+    outside of root, and device files
+    """
+    def inside(p: str) -> bool:
+        return os.path.commonpath([root, p]) == root
+
+    name = member.name.replace("\\", "/")
+    if name.startswith("/") or os.path.isabs(name) or os.path.splitdrive(name)[0] or not inside(os.path.normpath(os.path.join(root, name))):
+        raise RuntimeError(f"Refusing to extract unsafe path \"{member.name}\"")
+    if member.issym() and not inside(os.path.normpath(os.path.join(root, os.path.dirname(name), member.linkname))):
+        raise RuntimeError(f"Refusing to extract symlink \"{member.name}\" to \"{member.linkname}\" outside of the package")
+    if member.islnk() and not inside(os.path.normpath(os.path.join(root, member.linkname))):
+        raise RuntimeError(f"Refusing to extract hardlink \"{member.name}\" to \"{member.linkname}\" outside of the package")
+    if member.isdev():
+        raise RuntimeError(f"Refusing to extract device file \"{member.name}\"")
+
+
+def extract_conan_package(source, path: str, members: list[str] = None, manifest_text: str = None):
+    """
+    Extract a conan_package.tgz into a directory
+
+    The archive is read sequentially, so source can be a non-seekable stream like an
+    http response body.  It is extracted into a temporary directory next to path, which
+    is renamed to path when complete.  Members with unsafe paths are rejected.
+
+    Parameters:
+        source: path of a conan_package.tgz file, or a file object to read it from
+        path: directory to extract the package into, which must not exist yet
+        members: list of path prefixes, like "include/", of the files to extract.  Optional, Default all files.
+        manifest_text: contents of the package conanmanifest.txt, to check the extracted files and save with them.  Optional.
+
+    throws RuntimeError if the package contains an unsafe path or fails an integrity check
+    """
+    import shutil
+    import tarfile
+
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    manifest = parse_conan_manifest(manifest_text) if manifest_text is not None else {}
+    def wanted(name: str) -> bool:
+        return members is None or any(name.startswith(p) or f"{name}/" == p for p in members)
+
+    extracted = set()
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        if isinstance(source, str):
+            tf = tarfile.open(source, "r:gz")
+        else:
+            tf = tarfile.open(fileobj=source, mode="r|gz")
+        with tf:
+            for m in tf:
+                check_safe_member(m, tmpdir)
+                if not wanted(m.name):
+                    continue
+                extracted.add(m.name)
+                dest = os.path.join(tmpdir, m.name)
+                if m.isdir():
+                    os.makedirs(dest, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                if m.isfile():
+                    h = hashlib.md5()
+                    with tf.extractfile(m) as f, open(dest, "wb") as out:
+                        while chunk := f.read(DEFAULT_DOWNLOAD_CHUNK_SIZE):
+                            out.write(chunk)
+                            h.update(chunk)
+                    os.chmod(dest, m.mode & 0o777)
+                    if m.name in manifest and manifest[m.name] != h.hexdigest():
+                        raise RuntimeError(f"Package file \"{m.name}\" md5 {h.hexdigest()} doesn't match conanmanifest.txt {manifest[m.name]}")
+                elif m.issym():
+                    os.symlink(m.linkname, dest)
+                elif m.islnk():
+                    shutil.copy2(os.path.join(tmpdir, m.linkname), dest)
+        missing = [p for p in manifest if p not in ("conaninfo.txt", "conanmanifest.txt") and wanted(p) and p not in extracted]
+        if missing:
+            raise RuntimeError(f"Package is missing {missing} listed in its conanmanifest.txt")
+        if manifest_text is not None:
+            with open(os.path.join(tmpdir, "conanmanifest.txt"), "w") as f:
+                f.write(manifest_text)
+        os.rename(tmpdir, path)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def parse_size(s: str) -> int:
+    """Parse a size in bytes with an optional K, M or G suffix, like "512M" """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    s = s.strip().upper().removesuffix("B")
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+COMMANDS = ("gc", "mirror")
+
+def slm_toml_conan_dependencies(path: str) -> list[ConanVersion]:
+    """Returns the conan dependencies listed in a slm.toml"""
+    return [ConanVersion(d.pkg, d.version) for d in slm_toml.load_slm_toml(path).conan_dependencies()]
+
+def main(args: list[str]):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="bootstrap_conan_utils.py", description="Maintain the local conan caches and mirrors used by bootstrap.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    gcparser = subparsers.add_parser("gc", help="remove the least recently used packages from the package store")
+    gcparser.add_argument("--max-size", type=parse_size,
+                          default=parse_size(os.environ.get("SLM_CONAN_PACKAGE_STORE_SIZE", str(DEFAULT_CONAN_PACKAGE_STORE_SIZE))),
+                          help="size budget of the store, like 2G (default: $SLM_CONAN_PACKAGE_STORE_SIZE or 4G)")
+    gcparser.add_argument("--directory", default=None, help="package store directory (default: conan-packages in $SLM_CACHE_DIR)")
+    mirrorparser = subparsers.add_parser("mirror", help="copy conan packages into a local mirror directory, to point SLM_CONAN_URL at")
+    mirrorparser.add_argument("directory", help="the mirror directory")
+    mirrorparser.add_argument("packages", nargs="*", metavar="PACKAGE",
+                              help="package to mirror, like zlib/1.3.1, or a fully qualified zlib/1.3.1#rrev:package_id#prev")
+    mirrorparser.add_argument("--slm-toml", action="append", default=[], metavar="PATH",
+                              help="also mirror the conan dependencies of this slm.toml.  Can be repeated")
+    mirrorparser.add_argument("--latest", action="store_true",
+                              help="only mirror the newest recipe revision, and the newest revision of each of its packages")
+    mirrorparser.add_argument("--repourl", default=None, help="the repository to copy from (default: $SLM_CONAN_URL or the JITX conan server)")
+    opts = parser.parse_args(args)
+
+    if opts.command == "gc":
+        store = ConanPackageStore(opts.directory)
+        removed = store.gc(opts.max_size)
+        log("info", f"removed {len(removed)} files from \"{store.directory}\"")
+    elif opts.command == "mirror":
+        packages = [ConanVersion.from_string(p) for p in opts.packages]
+        for path in opts.slm_toml:
+            packages.extend(slm_toml_conan_dependencies(path))
+        if not packages:
+            parser.error("no packages to mirror")
+        kwargs = {"repourl": opts.repourl} if opts.repourl else {}
+        downloaded = sum(conan_mirror_package(cv, opts.directory, opts.latest, **kwargs) for cv in packages)
+        log("info", f"mirrored {len(packages)} packages into \"{opts.directory}\", downloaded {downloaded}")
+
+
 ### Tests ######################################################################
 
+class StubConanServerTestCase(unittest.TestCase):
+    """Tests against a stub conan server, whose module is only imported to run them"""
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import bootstrap_stub_utils
+        cls.stubs = bootstrap_stub_utils
+
+
+class TestConanTransport(StubConanServerTestCase):
+    def setUp(self):
+        self.conan_os = "Macos" if platform.system() == "Darwin" else platform.system()
+        self.packages = {
+            "pcre/8.45": {
+                "aaaa": {"time": "2024-02-17T00:31:04.551+0000", "packages": {
+                    "1111": {"info": self.stubs.stub_package_info(self.conan_os, {"shared": "False"}),
+                             "revisions": {"pppp": {"time": "2024-02-17T00:31:04.944+0000",
+                                                    "files": self.stubs.stub_package_files({"include/pcre.h": b"/* pcre */"})}}}}},
+                "bbbb": {"time": "2024-02-16T21:58:05.694+0000", "packages": {}},
+            }
+        }
+
+    def test_connection_reuse(self):
+        with self.stubs.StubConanServer(self.packages) as server, ConanTransport() as transport:
+            kwargs = {"repourl": server.url, "transport": transport}
+            self.assertEqual(conan_search_package_name("pcre", **kwargs), {"results": ["pcre/8.45@_/_"]})
+            for i in range(10):
+                self.assertEqual([r["revision"] for r in conan_get_recipe_revisions("pcre", "8.45", **kwargs)], ["aaaa", "bbbb"])
+            cv = conan_fully_qualify_latest_version(ConanVersion("pcre", "8.45"), options={"shared": "False"}, **kwargs)
+            self.assertEqual(cv, ConanVersion("pcre", "8.45", "aaaa", "1111", "pppp"))
+            with tempfile.TemporaryDirectory() as d:
+                dlp = conan_download_package(cv, target_directory=d, **kwargs)
+                self.assertEqual(os.path.dirname(dlp), d)
+            debug("TestConanTransport: %s requests over %s connections", server.requests, server.connections)
+            self.assertEqual(server.requests, 17)
+            # only the concurrent package_id searches of the two recipe revisions needed a second connection
+            self.assertLessEqual(server.connections, 2)
+
+    def test_connection_per_transport(self):
+        with self.stubs.StubConanServer(self.packages) as server:
+            for i in range(3):
+                with ConanTransport() as transport:
+                    conan_get_recipe_revisions("pcre", "8.45", repourl=server.url, transport=transport)
+            self.assertEqual(server.connections, 3)
+
+    def test_max_connections_per_host(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with self.stubs.StubConanServer(self.packages) as server, ConanTransport(max_connections_per_host=2) as transport:
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                list(ex.map(lambda i: conan_get_recipe_revisions("pcre", "8.45", repourl=server.url, transport=transport), range(32)))
+            self.assertEqual(server.requests, 32)
+            self.assertLessEqual(server.connections, 2)
+
+
+class TestConanRequestPolicy(StubConanServerTestCase):
+    def setUp(self):
+        self.packages = {"zlib/1.3.1": {"rrev": {"time": "2024-01-01T00:00:00.000+0000", "packages": {}}}}
+
+    def test_from_config(self):
+        policy = ConanRequestPolicy.from_config()
+        self.assertEqual((policy.retries, policy.retry_wait), (3, 5))
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "global.conf"), "w") as f:
+                f.write("# comment\ncore.download:retry = 7\ncore.download:retry_wait=0.5\ncore.net.http:timeout = 12\n"
+                        "tools.build:jobs = {{os.cpu_count()}}\n")
+            policy = ConanRequestPolicy.from_config(d)
+        self.assertEqual((policy.retries, policy.retry_wait, policy.timeout), (7, 0.5, 12))
+
+    def test_backoff(self):
+        policy = ConanRequestPolicy(retry_wait=1, max_retry_wait=5)
+        for attempt, (low, high) in enumerate([(0.5, 1), (1, 2), (2, 4), (2.5, 5), (2.5, 5)]):
+            wait = policy.backoff(attempt)
+            self.assertTrue(low <= wait <= high, (attempt, wait))
+
+    def test_hedge_delay(self):
+        self.assertIsNone(ConanRequestPolicy().hedge_delay([1.0] * 100))
+        self.assertEqual(ConanRequestPolicy(hedge_after=0.3).hedge_delay([]), 0.3)
+        policy = ConanRequestPolicy(hedge_after="p95")
+        self.assertEqual(policy.hedge_delay([0.01] * 5), DEFAULT_CONAN_HEDGE_AFTER)
+        self.assertEqual(policy.hedge_delay([i / 100 for i in range(100)]), 0.95)
+
+    def test_retries_failed_requests(self):
+        policy = ConanRequestPolicy(retries=8, retry_wait=0.001)
+        with self.stubs.StubConanServer(self.packages, fail_rate=0.3, seed=2) as server, ConanTransport(policy=policy) as transport:
+            for _ in range(20):
+                self.assertEqual(conan_get_recipe_revisions("zlib", "1.3.1", repourl=server.url, transport=transport)[0]["revision"], "rrev")
+            self.assertGreater(server.failures, 0)
+        with self.stubs.StubConanServer(self.packages, fail_rate=1) as server:
+            with ConanTransport(policy=replace(policy, retries=2)) as transport:
+                self.assertEqual(transport.get(f"{server.url}/v2/conans/search?q=zlib").status_code, 503)
+            self.assertEqual(server.requests, 3)
+
+    def percentile_99(self, policy):
+        with self.stubs.StubConanServer(self.packages, latency=0.005, stall=2, seed=3) as server, \
+             ConanTransport(policy=policy, max_connections_per_host=32) as transport:
+            # learn the usual request time, then start stalling
+            for _ in range(ConanRequestPolicy.HEDGE_MIN_SAMPLES):
+                conan_get_recipe_revisions("zlib", "1.3.1", repourl=server.url, transport=transport)
+            server.stall_rate = 0.05
+            times = []
+            for _ in range(100):
+                start = time.monotonic()
+                conan_get_recipe_revisions("zlib", "1.3.1", repourl=server.url, transport=transport)
+                times.append(time.monotonic() - start)
+            self.assertGreater(server.stalls, 1)
+        return sorted(times)[98]
+
+    def test_stalls_are_bounded(self):
+        # a read timeout retries stalled requests
+        p99 = self.percentile_99(ConanRequestPolicy(timeout=(5, 0.3), retry_wait=0.01))
+        debug("TestConanRequestPolicy: p99 with timeouts %.3fs", p99)
+        self.assertLess(p99, 1.0)
+        # hedging answers them from a second request
+        p99 = self.percentile_99(ConanRequestPolicy(timeout=(5, 3), hedge_after="p95"))
+        debug("TestConanRequestPolicy: p99 with hedging %.3fs", p99)
+        self.assertLess(p99, 1.0)
+
+
+class TestConanFanOut(StubConanServerTestCase):
+    LATENCY = 0.2
+
+    def setUp(self):
+        conan_os = "Macos" if platform.system() == "Darwin" else platform.system()
+        # twelve recipe revisions, of which only the two oldest have a package with matching options
+        self.packages = {"zlib/1.3.1": {}}
+        for i in range(12):
+            rrev = f"rrev{i:02}"
+            shared = "False" if i < 2 else "True"
+            self.packages["zlib/1.3.1"][rrev] = {"time": f"2024-01-{i+1:02}T00:00:00.000+0000", "packages": {
+                f"pid{i:02}": {"info": self.stubs.stub_package_info(conan_os, {"shared": shared}),
+                               "revisions": {f"prev{i:02}": {"time": f"2024-01-{i+1:02}T00:00:01.000+0000", "files": {}}}}}}
+
+    def test_newest_matching_revision_wins(self):
+        with self.stubs.StubConanServer(self.packages) as server, ConanTransport() as transport:
+            for max_workers in (1, 4, 16):
+                cv = conan_fully_qualify_latest_version(ConanVersion("zlib", "1.3.1"), options={"shared": "False"},
+                                                        repourl=server.url, transport=transport, max_workers=max_workers)
+                self.assertEqual(cv, ConanVersion("zlib", "1.3.1", "rrev01", "pid01", "prev01"))
+
+    def test_latency(self):
+        # the search of the newest matching revision is the slowest query
+        def latency(path):
+            return 2 * self.LATENCY if "rrev01/search" in path else self.LATENCY
+
+        with self.stubs.StubConanServer(self.packages, latency=latency) as server, ConanTransport(max_connections_per_host=16) as transport:
+            start = time.monotonic()
+            cv = conan_fully_qualify_latest_version(ConanVersion("zlib", "1.3.1"), options={"shared": "False"},
+                                                    repourl=server.url, transport=transport, max_workers=16)
+            elapsed = time.monotonic() - start
+            self.assertEqual(cv.recipe_revision, "rrev01")
+            # recipe revisions + slowest package_id search + package revisions, instead of one round trip per revision
+            debug("TestConanFanOut: resolved in %.3fs with %ss latency", elapsed, self.LATENCY)
+            self.assertLess(elapsed, 5 * self.LATENCY)
+
+
+class TestConanPackageSelection(StubConanServerTestCase):
+    PROFILE = {"os": "Linux", "arch": "x86_64", "compiler": "gcc", "compiler.version": "11", "build_type": "Release"}
+
+    def info(self, os_name="Linux", arch="x86_64", compiler="gcc", version="11", options=None):
+        return {"settings": {"os": os_name, "arch": arch, "compiler": compiler, "compiler.version": version},
+                "options": options or {"shared": "False"}}
+
+    def test_required_settings(self):
+        options = {"shared": "False"}
+        self.assertIsNone(score_package(self.info(os_name="Windows"), self.PROFILE, options))
+        self.assertIsNone(score_package(self.info(arch="armv8"), self.PROFILE, options))
+        self.assertIsNone(score_package(self.info(options={"shared": "True"}), self.PROFILE, options))
+        # packages without compiler settings, like header-only ones, still match
+        self.assertEqual(score_package({"settings": {"os": "Linux"}, "options": options}, self.PROFILE, options), 0)
+
+    def test_best_compiler_wins(self):
+        infos = {"clang": self.info(compiler="clang"),
+                 "gcc9": self.info(version="9"),
+                 "arm": self.info(arch="armv8"),
+                 "gcc11.2": self.info(version="11.2"),
+                 "gcc11": self.info()}
+        options = {"shared": "False"}
+        self.assertEqual(select_package(infos, self.PROFILE, options), "gcc11")
+        del infos["gcc11"]
+        self.assertEqual(select_package(infos, self.PROFILE, options), "gcc11.2")
+        self.assertIsNone(select_package({"arm": self.info(arch="armv8")}, self.PROFILE, options))
+
+    def test_normalize_options(self):
+        self.assertEqual(normalize_options({"shared": False, "fPIC": "true", "with_ssl": "openssl", "n": 3}),
+                         {"shared": "False", "fPIC": "True", "with_ssl": "openssl", "n": "3"})
+
+    def test_newest_first(self):
+        revisions = [{"revision": "a", "time": "2024-01-01T00:00:00.000+0000"},
+                     {"revision": "b", "time": "2024-03-01T00:00:00.000+0000"},
+                     {"revision": "c", "time": "2024-02-01T12:00:00.000+0100"}]
+        self.assertEqual([r["revision"] for r in newest_first(revisions)], ["b", "c", "a"])
+
+    def test_read_profile(self):
+        settings = read_conan_profile_settings(os.path.join(DEFAULT_CONAN_PROFILES_DIRECTORY, "windows-x86_64-gcc-11.2"))
+        self.assertEqual((settings["os"], settings["compiler"], settings["compiler.version"]), ("Windows", "gcc", "11.2"))
+        self.assertNotIn("ninja/[>1.11]", settings)
+        profile = host_profile()
+        self.assertEqual(profile["os"], conan_os())
+        self.assertIn(profile["arch"], (conan_arch(), FALLBACK_CONAN_ARCH))
+
+    def test_profile_falls_back_to_the_fallback_arch(self):
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as d, mock.patch(f"{__name__}.conan_os", return_value="Macos"), \
+             mock.patch(f"{__name__}.conan_arch", return_value="armv8"):
+            # no profiles at all: the arch of the machine
+            self.assertEqual(host_profile(d)["arch"], "armv8")
+            host_profile.cache_clear()
+            with open(os.path.join(d, "macos-x86_64-default"), "w") as f:
+                f.write("[settings]\nos=Macos\narch=x86_64\ncompiler=apple-clang\n")
+            profile = host_profile(d)
+            self.assertEqual((profile["arch"], profile["compiler"]), ("x86_64", "apple-clang"))
+            host_profile.cache_clear()
+            with open(os.path.join(d, "macos-armv8-default"), "w") as f:
+                f.write("[settings]\nos=Macos\narch=armv8\n")
+            self.assertEqual(host_profile(d)["arch"], "armv8")
+            host_profile.cache_clear()
+
+    def test_fetches_revisions_of_the_selected_package_only(self):
+        info = lambda arch, options: {"settings": {"os": "Linux", "arch": arch}, "options": options}
+        revisions = {"prev": {"time": "2024-01-01T00:00:01.000+0000", "files": {}}}
+        packages = {"zlib/1.3.1": {"rrev": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+            "pid-arm": {"info": info("armv8", {"shared": "False"}), "revisions": revisions},
+            "pid-shared": {"info": info("x86_64", {"shared": "True"}), "revisions": revisions},
+            "pid": {"info": info("x86_64", {"shared": "False"}), "revisions": revisions},
+            "pid-too": {"info": info("x86_64", {"shared": "False"}), "revisions": revisions}}}}}
+        with self.stubs.StubConanServer(packages) as server:
+            cv = conan_fully_qualify_latest_version(ConanVersion("zlib", "1.3.1"), options={"shared": False},
+                                                    profile=self.PROFILE, repourl=server.url)
+            self.assertEqual(cv, ConanVersion("zlib", "1.3.1", "rrev", "pid", "prev"))
+            # recipe revisions, package_ids, and the package revisions of "pid"
+            self.assertEqual(server.requests, 3)
+
+
+class TestConanResolver(StubConanServerTestCase):
+    def setUp(self):
+        conan_os = "Macos" if platform.system() == "Darwin" else platform.system()
+        self.packages = {}
+        for name in ("zlib", "pcre"):
+            self.packages[f"{name}/1.0"] = {"rrev": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+                f"{name}-{shared}": {"info": self.stubs.stub_package_info(conan_os, {"shared": shared}),
+                                     "revisions": {"prev": {"time": "2024-01-01T00:00:01.000+0000", "files": {}}}}
+                for shared in ("True", "False")}}}
+
+    def test_plan_resolves_each_query_once(self):
+        zlib, pcre = ConanVersion("zlib", "1.0"), ConanVersion("pcre", "1.0")
+        static, shared = {"shared": "False"}, {"shared": "True"}
+        with self.stubs.StubConanServer(self.packages, latency=0.05) as server, ConanResolver(repourl=server.url) as resolver:
+            plan = resolver.plan([(zlib, static), (pcre, static), (zlib, dict(static)), (zlib, shared), (zlib, static)])
+            self.assertEqual([cv.package_id for cv in plan], ["zlib-False", "pcre-False", "zlib-False", "zlib-True", "zlib-False"])
+            # three distinct queries of three requests each
+            self.assertEqual(server.requests, 9)
+            self.assertEqual(resolver.resolve(pcre, {"shared": "False"}), plan[1])
+            self.assertEqual(server.requests, 9)
+
+    def test_errors(self):
+        with self.stubs.StubConanServer(self.packages) as server, ConanResolver(repourl=server.url) as resolver:
+            with self.assertRaises(RuntimeError):
+                resolver.resolve(ConanVersion("zlib", "1.0"), {"shared": "Maybe"})
+            with self.assertRaises(RuntimeError):
+                conan_download_package(ConanVersion("zlib", "1.0"), repourl=server.url)
+
+
+class TestConanMetadataCache(StubConanServerTestCase):
+    def setUp(self):
+        conan_os = "Macos" if platform.system() == "Darwin" else platform.system()
+        self.packages = {"zlib/1.3.1": {"rrev": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+            "pid": {"info": self.stubs.stub_package_info(conan_os, {"shared": "False"}),
+                    "revisions": {"prev": {"time": "2024-01-01T00:00:01.000+0000", "files": {}}}}}}}}
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.expected = ConanVersion("zlib", "1.3.1", "rrev", "pid", "prev")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def resolve(self, server, cache):
+        return conan_fully_qualify_latest_version(ConanVersion("zlib", "1.3.1"), options={"shared": "False"},
+                                                  repourl=server.url, metadata_cache=cache)
+
+    def test_fresh_entries_skip_the_server(self):
+        cache = ConanMetadataCache(self.tmpdir.name)
+        with self.stubs.StubConanServer(self.packages) as server:
+            self.assertEqual(self.resolve(server, cache), self.expected)
+            self.assertEqual(server.requests, 3)
+            self.assertEqual(self.resolve(server, cache), self.expected)
+            self.assertEqual(server.requests, 3)
+
+    def test_stale_entries_are_revalidated(self):
+        cache = ConanMetadataCache(self.tmpdir.name, ttl=0)
+        with self.stubs.StubConanServer(self.packages) as server:
+            self.assertEqual(self.resolve(server, cache), self.expected)
+            self.assertEqual(self.resolve(server, cache), self.expected)
+            self.assertEqual(server.requests, 6)
+            self.assertEqual(server.not_modified, 3)
+
+    def test_offline(self):
+        with self.stubs.StubConanServer(self.packages) as server:
+            with self.assertRaises(RuntimeError):
+                self.resolve(server, ConanMetadataCache(self.tmpdir.name, offline=True))
+            self.assertEqual(server.requests, 0)
+            self.resolve(server, ConanMetadataCache(self.tmpdir.name, ttl=0))
+            self.assertEqual(self.resolve(server, ConanMetadataCache(self.tmpdir.name, ttl=0, offline=True)), self.expected)
+            self.assertEqual(server.requests, 3)
+
+    def test_lru_eviction(self):
+        cache = ConanMetadataCache(self.tmpdir.name)
+        cache.store("http://localhost/0", None, {"data": "x" * 200})
+        # room for four entries
+        cache.max_size = 4 * os.path.getsize(cache.path("http://localhost/0")) + 100
+        for i in range(4):
+            cache.store(f"http://localhost/{i}", None, {"data": "x" * 200})
+            # make sure each entry has a distinct mtime
+            os.utime(cache.path(f"http://localhost/{i}"), (i, i))
+        self.assertIsNotNone(cache.load("http://localhost/0"))
+        cache.store("http://localhost/4", None, {"data": "x" * 200})
+        self.assertIsNone(cache.load("http://localhost/1"))
+        for i in (0, 3, 4):
+            self.assertIsNotNone(cache.load(f"http://localhost/{i}"))
+
+    def test_store_scans_the_cache_only_when_full(self):
+        from unittest import mock
+        cache = ConanMetadataCache(self.tmpdir.name)
+        cache.store("http://localhost/0", None, {"data": "x" * 200})
+        cache.max_size = 4 * os.path.getsize(cache.path("http://localhost/0")) + 100
+        with mock.patch("os.walk", wraps=os.walk) as walk:
+            for i in range(4):
+                cache.store(f"http://localhost/{i}", None, {"data": "x" * 200})
+            self.assertEqual(walk.call_count, 0)
+            cache.store("http://localhost/4", None, {"data": "x" * 200})
+            self.assertEqual(walk.call_count, 1)
+        self.assertLessEqual(cache._size, cache.max_size)
+        self.assertEqual(cache._size, sum(size for mtime, size, path in cache._entries()))
+
+
+class TestConanPackageStore(StubConanServerTestCase):
+    def setUp(self):
+        conan_os = "Macos" if platform.system() == "Darwin" else platform.system()
+        self.packages = {"zlib/1.3.1": {"rrev": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+            "pid": {"info": self.stubs.stub_package_info(conan_os, {"shared": "False"}),
+                    "revisions": {"prev": {"time": "2024-01-01T00:00:01.000+0000",
+                                           "files": self.stubs.stub_package_files({"lib/libz.a": os.urandom(100000)})}}}}}}}
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fqcv = ConanVersion("zlib", "1.3.1", "rrev", "pid", "prev")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_store_hit_skips_network(self):
+        store = ConanPackageStore(self.tmpdir.name)
+        self.assertIsNone(store.lookup(self.fqcv))
+        with self.stubs.StubConanServer(self.packages) as server:
+            dlp = conan_download_package(self.fqcv, repourl=server.url, package_store=store)
+            self.assertEqual(dlp, store.path(self.fqcv))
+            self.assertEqual(server.requests, 2)
+            self.assertEqual(conan_download_package(self.fqcv, repourl=server.url, package_store=store), dlp)
+            self.assertEqual(server.requests, 2)
+        # no leftover temporary files
+        self.assertEqual(os.listdir(os.path.dirname(dlp)), [ConanPackageStore.FILENAME])
+
+    def test_concurrent_downloads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with self.stubs.StubConanServer(self.packages) as server, ThreadPoolExecutor(max_workers=4) as ex:
+            paths = list(ex.map(lambda i: conan_download_package(self.fqcv, repourl=server.url,
+                                                                 package_store=ConanPackageStore(self.tmpdir.name)), range(4)))
+        self.assertEqual(len(set(paths)), 1)
+        conan_verify_package(paths[0], parse_conan_manifest(self.packages["zlib/1.3.1"]["rrev"]["packages"]["pid"]
+                                                            ["revisions"]["prev"]["files"]["conanmanifest.txt"].decode()))
+
+    def test_gc(self):
+        store = ConanPackageStore(self.tmpdir.name)
+        fqcvs = [ConanVersion("zlib", "1.3.1", "rrev", "pid", f"prev{i}") for i in range(4)]
+        for i, fqcv in enumerate(fqcvs):
+            atomic_write(store.path(fqcv), b"z" * 1000)
+            os.utime(store.path(fqcv), (i, i))
+        store.lookup(fqcvs[0])
+        removed = store.gc(max_size=2500)
+        self.assertEqual(sorted(removed), sorted([store.path(fqcvs[1]), store.path(fqcvs[2])]))
+        self.assertFalse(os.path.exists(os.path.dirname(store.path(fqcvs[1]))))
+        self.assertIsNotNone(store.lookup(fqcvs[0]))
+        self.assertIsNotNone(store.lookup(fqcvs[3]))
+
+
+class TestConanMirror(StubConanServerTestCase):
+    def setUp(self):
+        conan_os = "Macos" if platform.system() == "Darwin" else platform.system()
+        self.lib = os.urandom(100000)
+        files = self.stubs.stub_package_files({"include/zlib.h": b"/* zlib */", "lib/libz.a": self.lib})
+        self.packages = {"zlib/1.3.1": {
+            "rrev-old": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+                "pid-old": {"info": self.stubs.stub_package_info(conan_os, {"shared": "False"}),
+                            "revisions": {"prev": {"time": "2024-01-01T00:00:01.000+0000", "files": files}}}}},
+            "rrev": {"time": "2024-02-01T00:00:00.000+0000", "packages": {
+                "pid": {"info": self.stubs.stub_package_info(conan_os, {"shared": "False"}),
+                        "revisions": {"prev-old": {"time": "2024-02-01T00:00:01.000+0000", "files": files},
+                                      "prev": {"time": "2024-02-02T00:00:01.000+0000", "files": files}}},
+                "pid-shared": {"info": self.stubs.stub_package_info(conan_os, {"shared": "True"}),
+                               "revisions": {"prev": {"time": "2024-02-01T00:00:01.000+0000", "files": files}}}}}}}
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = os.path.join(self.tmpdir.name, "mirror")
+        self.fqcv = ConanVersion("zlib", "1.3.1", "rrev", "pid", "prev")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resolve_and_download_from_mirror(self):
+        with self.stubs.StubConanServer(self.packages) as server:
+            self.assertEqual(conan_mirror_package(ConanVersion("zlib", "1.3.1"), self.mirror, latest=True, repourl=server.url), 2)
+            requests_made = server.requests
+            # everything is mirrored already
+            self.assertEqual(conan_mirror_package(ConanVersion("zlib", "1.3.1"), self.mirror, latest=True, repourl=server.url), 0)
+            self.assertLess(server.requests - requests_made, requests_made)
+
+        # the server is gone, the mirror answers the same queries
+        kwargs = {"repourl": self.mirror, "metadata_cache": ConanMetadataCache(os.path.join(self.tmpdir.name, "metadata"))}
+        self.assertEqual(conan_search_package_name("zlib", **kwargs), {"results": ["zlib/1.3.1@_/_"]})
+        self.assertEqual([r["revision"] for r in conan_get_recipe_revisions("zlib", "1.3.1", **kwargs)], ["rrev"])
+        cv = conan_fully_qualify_latest_version(ConanVersion("zlib", "1.3.1"), options={"shared": "False"}, **kwargs)
+        self.assertEqual(cv, self.fqcv)
+        store = ConanPackageStore(os.path.join(self.tmpdir.name, "store"))
+        tgz = conan_download_package(cv, package_store=store, **kwargs)
+        path = os.path.join(self.tmpdir.name, "extracted")
+        extract_conan_package(tgz, path)
+        with open(os.path.join(path, "lib", "libz.a"), "rb") as f:
+            self.assertEqual(f.read(), self.lib)
+        conan_stream_extract_package(cv, os.path.join(self.tmpdir.name, "streamed"), ["lib/"], **kwargs)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir.name, "streamed", "lib")), ["libz.a"])
+
+        # only the latest revisions were mirrored
+        with self.assertRaises(requests.HTTPError):
+            conan_download_package(ConanVersion("zlib", "1.3.1", "rrev", "pid", "prev-old"), target_directory=self.tmpdir.name, **kwargs)
+
+    def test_mirror_adds_revisions(self):
+        with self.stubs.StubConanServer(self.packages) as server:
+            conan_mirror_package(self.fqcv, self.mirror, repourl=server.url)
+            self.assertEqual(conan_mirror_package(ConanVersion("zlib", "1.3.1", "rrev-old"), self.mirror, repourl=server.url), 1)
+        kwargs = {"repourl": conan_repourl(self.mirror)}
+        self.assertTrue(kwargs["repourl"].startswith("file:"))
+        self.assertEqual([r["revision"] for r in conan_get_recipe_revisions("zlib", "1.3.1", **kwargs)], ["rrev", "rrev-old"])
+        self.assertEqual(list(conan_get_package_ids_for_revision("zlib", "1.3.1", "rrev", **kwargs)), ["pid"])
+        self.assertEqual(conan_fully_qualify_latest_version(ConanVersion("zlib", "1.3.1"), options={"shared": "False"}, **kwargs),
+                         self.fqcv)
+
+    def test_resume(self):
+        with self.stubs.StubConanServer(self.packages) as server:
+            conan_mirror_package(self.fqcv, self.mirror, repourl=server.url)
+        url = conan_repourl(self.mirror) + "/v2/conans/zlib/1.3.1/_/_/revisions/rrev/packages/pid/revisions/prev/files/conan_package.tgz"
+        with ConanTransport() as transport:
+            whole = transport.get(url).content
+            r = transport.get(url, headers={"Range": "bytes=100-"})
+            self.assertEqual((r.status_code, r.content), (206, whole[100:]))
+            self.assertEqual(transport.get(url + ".missing").status_code, 404)
+
+
+class TestDownloadFile(StubConanServerTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fqcv = ConanVersion("openssl", "3.2.2", "rrev", "pid", "prev")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def stub_packages(self, files: dict) -> dict:
+        return {"openssl/3.2.2": {"rrev": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+            "pid": {"info": self.stubs.stub_package_info("Linux", {}),
+                    "revisions": {"prev": {"time": "2024-01-01T00:00:01.000+0000", "files": files}}}}}}}
+
+    def test_resume_after_dropped_connection(self):
+        files = self.stubs.stub_package_files({"lib/libssl.a": os.urandom(300000), "lib/libcrypto.a": os.urandom(300000)})
+        with self.stubs.StubConanServer(self.stub_packages(files), drop_after=100000, drops=2) as server:
+            dlp = conan_download_package(self.fqcv, repourl=server.url, target_directory=self.tmpdir.name, chunk_size=16384)
+            # manifest, then the package in three parts
+            self.assertEqual(server.requests, 4)
+        with open(dlp, "rb") as f:
+            self.assertEqual(f.read(), files["conan_package.tgz"])
+
+    def test_too_many_dropped_connections(self):
+        files = self.stubs.stub_package_files({"lib/libssl.a": os.urandom(300000)})
+        with self.stubs.StubConanServer(self.stub_packages(files), drop_after=100000, drops=3) as server:
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                conan_download_package(self.fqcv, repourl=server.url, target_directory=self.tmpdir.name, download_retries=1)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_manifest_mismatch(self):
+        files = self.stubs.stub_package_files({"lib/libssl.a": b"good"})
+        files["conanmanifest.txt"] = self.stubs.stub_package_files({"lib/libssl.a": b"bad"})["conanmanifest.txt"]
+        with self.stubs.StubConanServer(self.stub_packages(files)) as server:
+            with self.assertRaisesRegex(RuntimeError, "libssl.a"):
+                conan_download_package(self.fqcv, repourl=server.url, target_directory=self.tmpdir.name)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    @unittest.skipUnless(os.environ.get("SLM_BENCHMARK"), "benchmarks not enabled, set SLM_BENCHMARK=1")
+    def test_download_throughput(self):
+        size = 200 * 1024 * 1024
+        files = {"conan_package.tgz": os.urandom(size)}
+        url_path = "/v2/conans/openssl/3.2.2/_/_/revisions/rrev/packages/pid/revisions/prev/files/conan_package.tgz"
+        with self.stubs.StubConanServer(self.stub_packages(files)) as server, ConanTransport() as transport:
+            for chunk_size in (128, 64 * 1024, DEFAULT_DOWNLOAD_CHUNK_SIZE):
+                outfile = os.path.join(self.tmpdir.name, "conan_package.tgz")
+                start = time.monotonic()
+                download_file(server.url + url_path, outfile, transport=transport, chunk_size=chunk_size)
+                elapsed = time.monotonic() - start
+                self.assertEqual(os.path.getsize(outfile), size)
+                eprint(f"download_file: chunk_size {chunk_size:>8}: {size / elapsed / (1024 * 1024):8.1f} MiB/s")
+
+
+class TestExtractConanPackage(StubConanServerTestCase):
+    FILES = {"include/z.h": b"/* zlib */", "lib/libz.a": b"!<arch>", "licenses/LICENSE": b"zlib license", "bin/minigzip": b"ELF"}
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fqcv = ConanVersion("zlib", "1.3.1", "rrev", "pid", "prev")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def stub_packages(self, files: dict) -> dict:
+        return {"zlib/1.3.1": {"rrev": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+            "pid": {"info": self.stubs.stub_package_info("Linux", {}),
+                    "revisions": {"prev": {"time": "2024-01-01T00:00:01.000+0000", "files": files}}}}}}}
+
+    def extracted_files(self, path: str) -> list[str]:
+        return sorted(os.path.relpath(os.path.join(d, f), path).replace(os.sep, "/") for d, ds, fs in os.walk(path) for f in fs)
+
+    def test_stream_extract_members(self):
+        path = os.path.join(self.tmpdir.name, "zlib")
+        with self.stubs.StubConanServer(self.stub_packages(self.stubs.stub_package_files(self.FILES))) as server:
+            fqcv = conan_stream_extract_package(self.fqcv, path, ["include/", "lib/"], repourl=server.url)
+        self.assertEqual(fqcv, self.fqcv)
+        self.assertEqual(self.extracted_files(path), ["conanmanifest.txt", "include/z.h", "lib/libz.a"])
+        with open(os.path.join(path, "lib", "libz.a"), "rb") as f:
+            self.assertEqual(f.read(), b"!<arch>")
+        self.assertEqual(os.listdir(self.tmpdir.name), ["zlib"])
+
+    def test_extract_file(self):
+        files = self.stubs.stub_package_files(self.FILES)
+        tgz = os.path.join(self.tmpdir.name, "conan_package.tgz")
+        with open(tgz, "wb") as f:
+            f.write(files["conan_package.tgz"])
+        path = os.path.join(self.tmpdir.name, "zlib")
+        extract_conan_package(tgz, path, manifest_text=files["conanmanifest.txt"].decode())
+        self.assertEqual(self.extracted_files(path), ["bin/minigzip", "conanmanifest.txt", "include/z.h", "lib/libz.a", "licenses/LICENSE"])
+
+    def test_stream_extract_manifest_mismatch(self):
+        files = self.stubs.stub_package_files(self.FILES)
+        files["conanmanifest.txt"] = self.stubs.stub_package_files(dict(self.FILES, **{"lib/libz.a": b"other"}))["conanmanifest.txt"]
+        path = os.path.join(self.tmpdir.name, "zlib")
+        with self.stubs.StubConanServer(self.stub_packages(files)) as server:
+            with self.assertRaisesRegex(RuntimeError, "libz.a"):
+                conan_stream_extract_package(self.fqcv, path, repourl=server.url)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_unsafe_members(self):
+        import io
+        import tarfile
+
+        def tgz(member: tarfile.TarInfo) -> io.BytesIO:
+            b = io.BytesIO()
+            with tarfile.open(fileobj=b, mode="w:gz") as tf:
+                tf.addfile(member, io.BytesIO(b"x" * member.size))
+            b.seek(0)
+            return b
+
+        parent = tarfile.TarInfo("../evil.txt")
+        parent.size = 1
+        absolute = tarfile.TarInfo("/tmp/evil.txt")
+        absolute.size = 1
+        symlink = tarfile.TarInfo("lib/evil")
+        symlink.type = tarfile.SYMTYPE
+        symlink.linkname = "../../../etc/passwd"
+        for member in (parent, absolute, symlink):
+            with self.assertRaisesRegex(RuntimeError, "Refusing"):
+                extract_conan_package(tgz(member), os.path.join(self.tmpdir.name, "evil"))
+            self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    @unittest.skipUnless(os.environ.get("SLM_BENCHMARK"), "benchmarks not enabled, set SLM_BENCHMARK=1")
+    def test_stream_extract_throughput(self):
+        files = self.stubs.stub_package_files({f"lib/lib{i}.a": os.urandom(8 * 1024 * 1024) for i in range(16)})
+        with self.stubs.StubConanServer(self.stub_packages(files), latency=0) as server, ConanTransport() as transport:
+            start = time.monotonic()
+            tgz = conan_download_package(self.fqcv, repourl=server.url, transport=transport, target_directory=self.tmpdir.name)
+            extract_conan_package(tgz, os.path.join(self.tmpdir.name, "a"))
+            download_then_extract = time.monotonic() - start
+
+            start = time.monotonic()
+            conan_stream_extract_package(self.fqcv, os.path.join(self.tmpdir.name, "b"), repourl=server.url, transport=transport)
+            stream_extract = time.monotonic() - start
+        eprint(f"extract_conan_package: download then extract {download_then_extract:.2f}s, stream extract {stream_extract:.2f}s")
+
+
+class TestConanExtractionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ConanExtractionCache(os.path.join(self.tmpdir.name, "extracted"))
+        self.fqcv = ConanVersion("zlib", "1.3.1", "rrev", "pid", "prev")
+        self.source = os.path.join(self.tmpdir.name, "source")
+        os.makedirs(os.path.join(self.source, "lib"))
+        os.makedirs(os.path.join(self.source, "include"))
+        with open(os.path.join(self.source, "lib", "libz.a"), "wb") as f:
+            f.write(b"!<arch>")
+        with open(os.path.join(self.source, "include", "zlib.h"), "wb") as f:
+            f.write(b"/* zlib */")
+        os.symlink("libz.a", os.path.join(self.source, "lib", "libz.so"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ensure_extracts_once(self):
+        calls = []
+        def extract(path):
+            calls.append(path)
+            os.makedirs(path)
+        path = self.cache.ensure(self.fqcv, ["lib/"], extract)
+        self.assertEqual(self.cache.ensure(self.fqcv, ["lib/"], extract), path)
+        self.assertEqual(calls, [path])
+        # extracting other members is a different entry
+        self.assertNotEqual(self.cache.ensure(self.fqcv, None, extract), path)
+        self.assertEqual(len(calls), 2)
+
+    def test_ensure_concurrent_extraction(self):
+        def extract(path):
+            # another bootstrap finished first, so renaming our extraction into place fails
+            os.makedirs(path)
+            raise OSError("Directory not empty")
+        path = self.cache.ensure(self.fqcv, None, extract)
+        self.assertTrue(os.path.isdir(path))
+
+    def test_materialize(self):
+        path = os.path.join(self.tmpdir.name, "deps", "zlib")
+        method = materialize_tree(self.source, path)
+        self.assertIn(method, ("reflink", "hardlink", "copy"))
+        with open(os.path.join(path, "lib", "libz.a"), "rb") as f:
+            self.assertEqual(f.read(), b"!<arch>")
+        self.assertEqual(os.readlink(os.path.join(path, "lib", "libz.so")), "libz.a")
+        if method == "hardlink":
+            self.assertEqual(os.stat(os.path.join(path, "include", "zlib.h")).st_ino,
+                             os.stat(os.path.join(self.source, "include", "zlib.h")).st_ino)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))), ["zlib"])
+
+    def test_materialize_falls_back_to_copy(self):
+        from unittest import mock
+        path = os.path.join(self.tmpdir.name, "deps", "zlib")
+        unsupported = OSError(95, "Operation not supported")
+        cross_device = OSError(18, "Invalid cross-device link")
+        with mock.patch(f"{__name__}.reflink", side_effect=unsupported), mock.patch("os.link", side_effect=cross_device):
+            self.assertEqual(materialize_tree(self.source, path), "copy")
+        self.assertNotEqual(os.stat(os.path.join(path, "lib", "libz.a")).st_ino,
+                            os.stat(os.path.join(self.source, "lib", "libz.a")).st_ino)
+
+    def test_materialize_is_atomic(self):
+        from unittest import mock
+        path = os.path.join(self.tmpdir.name, "deps", "zlib")
+        full = OSError(28, "No space left on device")
+        with mock.patch(f"{__name__}.reflink", side_effect=full), mock.patch("os.link", side_effect=full), \
+             mock.patch("shutil.copy2", side_effect=full):
+            with self.assertRaises(OSError):
+                materialize_tree(self.source, path)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+
 class TestConanVersion(unittest.TestCase):
     online=True  # set to True to enable online tests
 
@@ -569,5 +2559,8 @@ class TestConanVersion(unittest.TestCase):
 
 
 if __name__ == "__main__":
-    # self-test
-    unittest.main()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        main(sys.argv[1:])
+    else:
+        # self-test
+        unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import tempfile
+import unittest
+
+from bootstrap_trace_utils import eprint
+
+if sys.version_info[0] < 3:
+    eprint("This script requires python version 3 or greater")
+    exit(1)
+
+
+def atomic_write(path: str, data: bytes):
+    """
+    Write data to a temporary file next to path, then rename it into place, so a concurrent
+    reader sees either the old or the new content, and concurrent writers don't share the
+    temporary file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def write_if_changed(path: str, content: str) -> bool:
+    """
+    Write a text file with atomic_write, unless it already has exactly that content, so that
+    its mtime only changes when it does
+
+    Returns: True if the file was written
+    """
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    atomic_write(path, content.encode())
+    return True
+
+
+### Tests ######################################################################
+
+class TestFileUtils(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_atomic_write(self):
+        path = os.path.join(self.tmpdir.name, "cache", "entry.json")
+        atomic_write(path, b"{}")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"{}")
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["entry.json"])
+
+    def test_write_if_changed(self):
+        path = os.path.join(self.tmpdir.name, "bootstrap.lock")
+        self.assertTrue(write_if_changed(path, "[dependencies]\n"))
+        os.utime(path, ns=(10**9, 10**9))
+        self.assertFalse(write_if_changed(path, "[dependencies]\n"))
+        self.assertEqual(os.stat(path).st_mtime_ns, 10**9)
+        self.assertTrue(write_if_changed(path, "[dependencies.semver]\n"))
+        self.assertEqual([f for f in os.listdir(self.tmpdir.name) if f.startswith(".tmp")], [])
+
+
+if __name__ == "__main__":
+    # self-test
+    unittest.main()
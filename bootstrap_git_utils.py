@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+
+import bootstrap_trace_utils as btu
+from bootstrap_trace_utils import debug, eprint, log
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+if sys.version_info[0] < 3:
+    eprint("This script requires python version 3 or greater")
+    exit(1)
+
+
+def check_run(*args, **kwargs):
+    kwargs["check"] = True
+    with btu.TRACER.span(" ".join(args[0][:2]), "git", args=" ".join(args[0])):
+        subprocess.run(*args, **kwargs)
+
+def git_output(args: list[str], cwd: str, check: bool = True) -> subprocess.CompletedProcess:
+    """Run a git command that is only read from, like rev-parse, capturing its output"""
+    with btu.TRACER.span(" ".join(args[:2]), "git", args=" ".join(args)):
+        return subprocess.run(args, cwd=cwd, check=check, capture_output=True, text=True)
+
+def run_from_kwargs(**kwargs):
+    return kwargs["run"] if "run" in kwargs else check_run
+
+def git_filter_from_kwargs(**kwargs) -> str:
+    return kwargs["git_filter"] if "git_filter" in kwargs else None
+
+def mirror_from_kwargs(**kwargs) -> "GitMirrorCache":
+    return kwargs["mirror"] if "mirror" in kwargs else None
+
+def is_commit(ref: str) -> bool:
+    """Returns True if ref is a full commit hash rather than a tag or HEAD"""
+    return re.fullmatch(r"[0-9a-f]{40}", ref) is not None
+
+def git_rev_parse(path: str, rev: str = "HEAD") -> str:
+    return git_output(["git", "rev-parse", rev], path).stdout.strip()
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on the file at path, creating it if needed, blocking until it is available"""
+    with open(path, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after 10 seconds, keep waiting
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class GitMirrorCache:
+    """
+    Per-user bare repositories mirroring the git dependencies, shared between bootstraps
+
+    Each mirror only holds the refs that have been asked for, with their full history, so
+    fetching another version of a dependency only transfers the commits since the versions
+    already in the mirror.  Dependencies are then cloned from the mirror locally, which
+    hardlinks the objects when the mirror is on the same filesystem.
+
+    Mirror updates hold a lock file next to the mirror, so concurrent bootstraps are safe.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, url: str) -> str:
+        """Returns the directory of the mirror of url"""
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", url.rstrip("/").split("/")[-1])
+        if name.endswith(".git"):
+            name = name[:-4]
+        digest = hashlib.sha256(url.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}-{digest}.git")
+
+    @contextmanager
+    def lock(self, url: str):
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self.path(url) + ".lock"):
+            yield
+
+    def lookup(self, url: str, ref: str) -> str:
+        """
+        Returns the commit of a tag or commit hash if the mirror of url already has it, or None
+
+        HEAD is never found, because the remote branch may have moved since it was mirrored.
+        """
+        mirror = self.path(url)
+        if ref == "HEAD" or not os.path.isdir(mirror):
+            return None
+        rev = ref if is_commit(ref) else f"refs/tags/{ref}"
+        r = git_output(["git", "rev-parse", "--quiet", "--verify", f"{rev}^{{commit}}"], mirror, check=False)
+        return r.stdout.strip() if r.returncode == 0 else None
+
+    def update(self, url: str, ref: str, **kwargs) -> str:
+        """
+        Fetch a ref of url into its mirror, unless the mirror already has it
+
+        Parameters:
+            url: the remote repository
+            ref: "HEAD", a tag name like "v1.2.3", or a full commit hash
+        kwargs:
+          git_filter: str partial clone filter, like "blob:none", which makes the mirror a partial clone.  Optional, Default no filter.
+          run: function to run the git commands with, like check_run.  Optional, Default check_run.
+
+        Returns: the commit of the ref
+
+        throws CalledProcessError (from 'run') if a git command fails
+        """
+        run = run_from_kwargs(**kwargs)
+        git_filter = git_filter_from_kwargs(**kwargs)
+        mirror = self.path(url)
+        with self.lock(url):
+            commit = self.lookup(url, ref)
+            if commit:
+                debug("GitMirrorCache.update: \"%s\" of \"%s\" is already in \"%s\"", ref, url, mirror)
+                return commit
+
+            if not os.path.isdir(mirror):
+                # create the mirror in a temporary directory, so a failed fetch leaves no half-made mirror
+                tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+                try:
+                    run(["git", "init", "--quiet", "--bare", tmp])
+                    run(["git", "remote", "add", "origin", url], cwd=tmp)
+                    os.rename(tmp, mirror)
+                except BaseException:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    raise
+
+            # keep every fetched ref under a name in the mirror, so its commits are never pruned
+            if ref == "HEAD":
+                refspec, rev = "+HEAD:refs/slm/HEAD", "refs/slm/HEAD"
+            elif is_commit(ref):
+                refspec, rev = f"+{ref}:refs/slm/commits/{ref}", ref
+            else:
+                refspec, rev = f"+refs/tags/{ref}:refs/tags/{ref}", f"refs/tags/{ref}"
+
+            fetch = ["git", "fetch", "--no-tags", "--quiet"]
+            if git_filter:
+                fetch.append(f"--filter={git_filter}")
+
+            debug("GitMirrorCache.update: fetching \"%s\" of \"%s\" into \"%s\"", ref, url, mirror)
+            run(fetch + ["origin", refspec], cwd=mirror)
+            return git_rev_parse(mirror, f"{rev}^{{commit}}")
+
+    def partial_clone_filter(self, url: str) -> str:
+        """Returns the filter of the mirror of url if it is a partial clone, like "blob:none", or None"""
+        r = git_output(["git", "config", "--get", "remote.origin.partialclonefilter"], self.path(url), check=False)
+        return r.stdout.strip() if r.returncode == 0 else None
+
+def git_clone_from_mirror(path: str, url: str, ref: str, **kwargs) -> str:
+    """
+    Update the mirror of url with a ref, then clone it locally into path and check out the ref
+
+    The clone's origin is set to url, so later fetches in path go to the remote repository.
+    When the mirror is a partial clone, so is the clone, and the checkout fetches the blobs
+    the mirror doesn't have from url.
+
+    kwargs:
+      git_filter: str partial clone filter, like "blob:none", passed to the mirror update.  Optional, Default no filter.
+      mirror: GitMirrorCache to clone from.  Required.
+      run: function to run the git commands with, like check_run.  Optional, Default check_run.
+
+    Returns: the commit hash that was checked out
+
+    throws CalledProcessError (from 'run') if a git command fails
+    """
+    run = run_from_kwargs(**kwargs)
+    mirror = mirror_from_kwargs(**kwargs)
+    commit = mirror.update(url, ref, **kwargs)
+    debug("git_clone_from_mirror: cloning \"%s\" of \"%s\" into \"%s\"", ref, url, path)
+    run(["git", "clone", "--quiet", "--no-checkout", mirror.path(url), path])
+    run(["git", "remote", "set-url", "origin", url], cwd=path)
+    git_filter = mirror.partial_clone_filter(url)
+    if git_filter:
+        run(["git", "config", "remote.origin.promisor", "true"], cwd=path)
+        run(["git", "config", "remote.origin.partialclonefilter", git_filter], cwd=path)
+    run(["git", "checkout", "--quiet", "--force", commit], cwd=path)
+    return commit
+
+def git_fetch_ref(path: str, url: str, ref: str, **kwargs) -> str:
+    """
+    Create a repository at path containing only the commit of a single ref of url, at depth 1
+
+    Unlike cloning and then fetching tags, this transfers only the objects of the requested
+    commit, no matter how many tags or how much history the remote repository has.
+
+    Parameters:
+        path: directory to create the repository in
+        url: the remote repository, which is added as "origin"
+        ref: "HEAD", a tag name like "v1.2.3", or a full commit hash
+    kwargs:
+      git_filter: str partial clone filter, like "blob:none", to fetch blobs on demand, also through a mirror.  Optional, Default no filter.
+      mirror: GitMirrorCache to fetch through, instead of fetching only the ref from url.  Optional, Default None.
+      run: function to run the git commands with, like check_run.  Optional, Default check_run.
+
+    Returns: the commit hash that was checked out
+
+    throws CalledProcessError (from 'run') if a git command fails
+    """
+    mirror = mirror_from_kwargs(**kwargs)
+    if mirror:
+        return git_clone_from_mirror(path, url, ref, **kwargs)
+
+    run = run_from_kwargs(**kwargs)
+    git_filter = git_filter_from_kwargs(**kwargs)
+
+    if ref == "HEAD" or is_commit(ref):
+        refspec = ref
+    else:
+        # also create the local tag, so that the checkout is at a named version
+        refspec = f"+refs/tags/{ref}:refs/tags/{ref}"
+
+    fetch = ["git", "fetch", "--depth", "1", "--no-tags", "--quiet"]
+    if git_filter:
+        fetch.append(f"--filter={git_filter}")
+
+    debug("git_fetch_ref: fetching \"%s\" of \"%s\" into \"%s\"", ref, url, path)
+    run(["git", "init", "--quiet", path])
+    run(["git", "remote", "add", "origin", url], cwd=path)
+    run(fetch + ["origin", refspec], cwd=path)
+    run(["git", "checkout", "--quiet", "--force", "FETCH_HEAD"], cwd=path)
+    return git_rev_parse(path)
+
+
+### Tests ######################################################################
+
+class StubGitRepoTestCase(unittest.TestCase):
+    """Tests against stub git repositories, whose module is only imported to run them"""
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import bootstrap_stub_utils
+        cls.stubs = bootstrap_stub_utils
+
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(d, f)) for d, ds, fs in os.walk(path) for f in fs)
+
+def commit_count(path: str) -> int:
+    return int(subprocess.run(["git", "rev-list", "--count", "HEAD"], cwd=path, check=True,
+                              capture_output=True, text=True).stdout)
+
+
+class TestGitFetchRef(StubGitRepoTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.url = cls.stubs.make_tagged_repo(cls.tmpdir.name, "dep", tags=20)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(dir=self.tmpdir.name)
+        os.rmdir(self.path)
+
+    def version_in(self, path: str) -> str:
+        with open(os.path.join(path, "slm.toml")) as f:
+            return f.read().splitlines()[1]
+
+    def test_fetch_tag(self):
+        commit = git_fetch_ref(self.path, self.url, "v0.0.7")
+        self.assertEqual(self.version_in(self.path), "version = \"0.0.7\"")
+        self.assertEqual(commit_count(self.path), 1)
+        self.assertEqual(git_rev_parse(self.path, "v0.0.7^{commit}"), commit)
+        # no other tags were transferred
+        tags = subprocess.run(["git", "tag"], cwd=self.path, check=True, capture_output=True, text=True).stdout.split()
+        self.assertEqual(tags, ["v0.0.7"])
+
+    def test_fetch_head(self):
+        git_fetch_ref(self.path, self.url, "HEAD")
+        self.assertEqual(self.version_in(self.path), "version = \"0.0.20\"")
+        self.assertEqual(commit_count(self.path), 1)
+
+    def test_fetch_commit(self):
+        commit = git_fetch_ref(self.path, self.url, "v0.0.3")
+        other = self.path + "-by-commit"
+        self.assertEqual(git_fetch_ref(other, self.url, commit), commit)
+        self.assertEqual(self.version_in(other), "version = \"0.0.3\"")
+
+    def test_fetch_with_filter(self):
+        git_fetch_ref(self.path, self.url, "v0.0.5", git_filter="blob:none")
+        self.assertEqual(self.version_in(self.path), "version = \"0.0.5\"")
+        self.assertEqual(commit_count(self.path), 1)
+
+    def test_missing_tag(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            git_fetch_ref(self.path, self.url, "v9.9.9", run=lambda *a, **k: check_run(*a, stderr=subprocess.DEVNULL, **k))
+
+    @unittest.skipUnless(os.environ.get("SLM_BENCHMARK"), "benchmarks not enabled, set SLM_BENCHMARK=1")
+    def test_fetch_benchmark(self):
+        url = self.stubs.make_tagged_repo(self.tmpdir.name, "many-tags", tags=300, file_size=16 * 1024)
+        mirror = GitMirrorCache(os.path.join(self.tmpdir.name, "mirrors"))
+
+        def clone_then_fetch_tags(path):
+            # the previous bootstrap fetch
+            check_run(["git", "clone", "--depth", "1", "--quiet", url, path])
+            check_run(["git", "fetch", "--tags", "--quiet"], cwd=path)
+            check_run(["git", "checkout", "--quiet", "--force", "v0.0.150"], cwd=path)
+
+        for name, fetch in (("clone + fetch --tags", clone_then_fetch_tags),
+                            ("single ref", lambda path: git_fetch_ref(path, url, "v0.0.150")),
+                            ("single ref blob:none", lambda path: git_fetch_ref(path, url, "v0.0.150", git_filter="blob:none")),
+                            ("cold mirror", lambda path: git_fetch_ref(path, url, "v0.0.150", mirror=mirror)),
+                            ("warm mirror", lambda path: git_fetch_ref(path, url, "v0.0.150", mirror=mirror))):
+            path = os.path.join(self.tmpdir.name, name.replace(" ", "_").replace(":", "_"))
+            start = time.monotonic()
+            fetch(path)
+            elapsed = time.monotonic() - start
+            objects = directory_size(os.path.join(path, ".git", "objects"))
+            eprint(f"git fetch {name:>22}: {elapsed:6.2f}s, {objects / 1024:10.1f} KiB of objects, {commit_count(path)} commits")
+
+
+class TestGitMirrorCache(StubGitRepoTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.url = self.stubs.make_tagged_repo(self.tmpdir.name, "dep", tags=10)
+        self.mirror = GitMirrorCache(os.path.join(self.tmpdir.name, "cache", "git"))
+        self.fetches = []
+        self.fetches_lock = threading.Lock()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_git(self, args, **kwargs):
+        # record the commands that talk to the remote repository
+        if args[1] == "fetch":
+            with self.fetches_lock:
+                self.fetches.append(args)
+        check_run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+
+    def fetch(self, name: str, ref: str) -> str:
+        path = os.path.join(self.tmpdir.name, name)
+        return git_fetch_ref(path, self.url, ref, mirror=self.mirror, run=self.run_git)
+
+    def git_out(self, path: str, *args) -> str:
+        return subprocess.run(["git", *args], cwd=path, check=True, capture_output=True, text=True).stdout.strip()
+
+    def test_cold_then_warm(self):
+        commit = self.fetch("a", "v0.0.4")
+        self.assertEqual(len(self.fetches), 1)
+        path = os.path.join(self.tmpdir.name, "a")
+        self.assertEqual(git_rev_parse(path), commit)
+        self.assertEqual(self.git_out(path, "remote", "get-url", "origin"), self.url)
+        self.assertEqual(self.git_out(path, "rev-parse", "v0.0.4^{commit}"), commit)
+
+        # the mirror has the tag, so no fetch from the remote
+        self.assertEqual(self.fetch("b", "v0.0.4"), commit)
+        self.assertEqual(len(self.fetches), 1)
+        # nor for the commit of the tag, or an older tag in its history, which is only fetched once
+        self.assertEqual(self.fetch("c", commit), commit)
+        self.assertEqual(len(self.fetches), 1)
+
+    def test_new_tag_is_fetched(self):
+        self.fetch("a", "v0.0.10")
+        self.stubs.push_tag(self.url, "v0.1.0")
+        self.fetch("b", "v0.1.0")
+        self.assertEqual(len(self.fetches), 2)
+        with open(os.path.join(self.tmpdir.name, "b", "v0.1.0.txt")) as f:
+            self.assertEqual(f.read(), "v0.1.0")
+
+    def test_head_is_always_fetched(self):
+        self.fetch("a", "HEAD")
+        self.stubs.push_tag(self.url, "v0.1.0")
+        self.fetch("b", "HEAD")
+        self.assertEqual(len(self.fetches), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, "b", "v0.1.0.txt")))
+
+    def test_missing_tag(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.fetch("a", "v9.9.9")
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, "a")))
+        # the mirror itself is still usable
+        self.fetch("b", "v0.0.1")
+
+    def test_filter(self):
+        self.fetch("a", "v0.0.2")
+        path = os.path.join(self.tmpdir.name, "b")
+        commit = git_fetch_ref(path, self.url, "v0.0.8", mirror=self.mirror, run=self.run_git, git_filter="blob:none")
+        self.assertIn("--filter=blob:none", self.fetches[-1])
+        self.assertEqual(self.mirror.partial_clone_filter(self.url), "blob:none")
+        self.assertEqual(git_rev_parse(path), commit)
+        with open(os.path.join(path, "slm.toml")) as f:
+            self.assertIn("version = \"0.0.8\"", f.read())
+        # the mirror stays a partial clone for fetches without the filter
+        self.fetch("c", "v0.0.9")
+        with open(os.path.join(self.tmpdir.name, "c", "slm.toml")) as f:
+            self.assertIn("version = \"0.0.9\"", f.read())
+
+    def test_concurrent_fetches(self):
+        tags = [f"v0.0.{i}" for i in range(1, 11)]
+        results = {}
+        def fetch(tag):
+            results[tag] = self.fetch(tag, tag)
+        threads = [threading.Thread(target=fetch, args=(tag,)) for tag in tags]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), len(tags))
+        for tag in tags:
+            self.assertEqual(git_rev_parse(os.path.join(self.tmpdir.name, tag)), results[tag])
+
+    def test_file_lock_excludes(self):
+        path = os.path.join(self.tmpdir.name, "lock")
+        inside = []
+        def hold():
+            with file_lock(path):
+                inside.append(1)
+                time.sleep(0.05)
+                self.assertEqual(len(inside), 1)
+                inside.pop()
+        threads = [threading.Thread(target=hold) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(inside, [])
+
+
+if __name__ == "__main__":
+    # self-test
+    unittest.main()
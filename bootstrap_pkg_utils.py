@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import bootstrap_trace_utils as btu
+from bootstrap_trace_utils import debug, eprint, log
+
+if sys.version_info[0] < 3:
+    eprint("This script requires python version 3 or greater")
+    exit(1)
+
+# extensions of the compiled packages stanza writes: debug and optimized, as in slm_build.py of the conan recipes
+PKG_EXTENSIONS = (".pkg", ".fpkg")
+
+DEFPACKAGE = re.compile(r"^\s*defpackage\s+([^\s:]+)\s*:", re.MULTILINE)
+
+def stanza_package_names(directory: str) -> set[str]:
+    """Returns the names of the packages defined with defpackage in the .stanza files under directory"""
+    names = set()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            if f.endswith(".stanza"):
+                with open(os.path.join(root, f), "r", errors="replace") as fd:
+                    names.update(DEFPACKAGE.findall(fd.read()))
+    return names
+
+def pkg_filenames(package: str) -> list[str]:
+    """Returns the file names stanza gives the compiled package, like "slm$utils.pkg" for "slm/utils" """
+    mangled = package.replace("/", "$")
+    return [mangled + ext for ext in PKG_EXTENSIONS]
+
+def stanza_version() -> str:
+    """Returns the version of the stanza on the PATH, like "0.18.78", or None if it can't be run"""
+    try:
+        r = subprocess.run(["stanza", "version", "-terse"], check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return r.stdout.strip() or None
+
+class StanzaPkgCache:
+    """
+    Per-user cache of the compiled .pkg files of stanza dependencies, shared between bootstraps
+
+    Entries are keyed by stanza version, platform, dependency name, and the resolved git
+    commit or conan package revision of the dependency, so a cached package was compiled
+    from exactly the same sources by the same compiler.  Stanza still checks the packages
+    it finds in the pkg-cache of a project, so a package whose own dependencies changed is
+    recompiled as usual.
+
+    Entries are published by renaming a complete temporary directory into place, and never
+    change after that.  They are copied rather than hardlinked into projects, since stanza
+    may rewrite the packages in a project pkg-cache in place.
+    """
+    def __init__(self, directory: str, stanza_version: str, platform: str):
+        self.directory = directory
+        self.stanza_version = stanza_version
+        self.platform = platform
+
+    def path(self, dependency: str, resolved: str) -> str:
+        """Returns the directory of the cached packages of a dependency at a resolved version"""
+        return os.path.join(self.directory, self.stanza_version, self.platform, dependency,
+                            re.sub(r"[^A-Za-z0-9_.#-]", "_", resolved))
+
+    def seed(self, dependency: str, resolved: str, pkg_cache: str) -> int:
+        """
+        Copy the cached packages of a dependency into a project pkg-cache directory,
+        without replacing packages that are already there
+
+        Returns: the number of packages added
+        """
+        entry = self.path(dependency, resolved)
+        if not os.path.isdir(entry):
+            return 0
+        os.makedirs(pkg_cache, exist_ok=True)
+        added = 0
+        for f in os.listdir(entry):
+            dst = os.path.join(pkg_cache, f)
+            if not os.path.exists(dst):
+                shutil.copy2(os.path.join(entry, f), dst)
+                added += 1
+        debug("StanzaPkgCache.seed: %s packages of \"%s\" from \"%s\"", added, dependency, entry)
+        return added
+
+    def publish(self, dependency: str, resolved: str, packages: set[str], pkg_dirs: list[str]) -> int:
+        """
+        Save the compiled packages of a dependency from the pkg_dirs of a project build,
+        unless the cache already has them
+
+        Parameters:
+            dependency: name of the dependency
+            resolved: its resolved git commit or conan version
+            packages: the names of the stanza packages the dependency defines
+            pkg_dirs: directories to look for the compiled packages in, in order
+
+        Returns: the number of packages published
+        """
+        entry = self.path(dependency, resolved)
+        if os.path.isdir(entry):
+            return 0
+        files = {}
+        for package in packages:
+            for f in pkg_filenames(package):
+                found = next((os.path.join(d, f) for d in pkg_dirs if os.path.isfile(os.path.join(d, f))), None)
+                if found:
+                    files[f] = found
+        if not files:
+            return 0
+
+        parent = os.path.dirname(entry)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        try:
+            for f, src in files.items():
+                # copy rather than link, so a later build can't change the cached file in place
+                shutil.copy2(src, os.path.join(tmp, f))
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if os.path.isdir(entry):
+                return 0  # published concurrently by another build
+            raise
+        debug("StanzaPkgCache.publish: %s packages of \"%s\" to \"%s\"", len(files), dependency, entry)
+        return len(files)
+
+
+### Tests ######################################################################
+
+class TestStanzaPkgCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = StanzaPkgCache(os.path.join(self.tmpdir.name, "cache"), "0.18.78", "linux")
+        self.dep = os.path.join(self.tmpdir.name, "deps", "semver")
+        os.makedirs(os.path.join(self.dep, "src"))
+        with open(os.path.join(self.dep, "src", "semver.stanza"), "w") as f:
+            f.write("defpackage semver :\n  import core\n")
+        with open(os.path.join(self.dep, "src", "utils.stanza"), "w") as f:
+            f.write("#use-added-syntax(tests)\ndefpackage semver/utils:\n  import core\n")
+        self.build = os.path.join(self.tmpdir.name, "build", "pkg-cache")
+        os.makedirs(self.build)
+        for f in ("semver.pkg", "semver$utils.pkg", "other.pkg"):
+            with open(os.path.join(self.build, f), "wb") as fd:
+                fd.write(f.encode())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_package_names(self):
+        self.assertEqual(stanza_package_names(self.dep), {"semver", "semver/utils"})
+        self.assertEqual(pkg_filenames("semver/utils"), ["semver$utils.pkg", "semver$utils.fpkg"])
+
+    def test_publish_then_seed(self):
+        packages = stanza_package_names(self.dep)
+        self.assertEqual(self.cache.publish("semver", "abc123", packages, [self.build]), 2)
+        # published once
+        self.assertEqual(self.cache.publish("semver", "abc123", packages, [self.build]), 0)
+        self.assertEqual(sorted(os.listdir(self.cache.path("semver", "abc123"))), ["semver$utils.pkg", "semver.pkg"])
+
+        project = os.path.join(self.tmpdir.name, "project", "pkg-cache")
+        self.assertEqual(self.cache.seed("semver", "abc123", project), 2)
+        self.assertEqual(sorted(os.listdir(project)), ["semver$utils.pkg", "semver.pkg"])
+        # copies, so rewriting a package in the project leaves the cache alone
+        with open(os.path.join(project, "semver.pkg"), "wb") as f:
+            f.write(b"recompiled")
+        with open(os.path.join(self.cache.path("semver", "abc123"), "semver.pkg"), "rb") as f:
+            self.assertEqual(f.read(), b"semver.pkg")
+        # packages already in the project are kept
+        self.assertEqual(self.cache.seed("semver", "abc123", project), 0)
+
+    def test_keys(self):
+        self.cache.publish("semver", "abc123", {"semver"}, [self.build])
+        project = os.path.join(self.tmpdir.name, "project")
+        self.assertEqual(self.cache.seed("semver", "def456", project), 0)
+        other = StanzaPkgCache(self.cache.directory, "0.18.79", "linux")
+        self.assertEqual(other.seed("semver", "abc123", project), 0)
+        other = StanzaPkgCache(self.cache.directory, "0.18.78", "macos")
+        self.assertEqual(other.seed("semver", "abc123", project), 0)
+
+    def test_nothing_to_publish(self):
+        self.assertEqual(self.cache.publish("term-colors", "abc123", {"term-colors"}, [self.build]), 0)
+        self.assertFalse(os.path.exists(self.cache.path("term-colors", "abc123")))
+
+
+if __name__ == "__main__":
+    # self-test
+    unittest.main()
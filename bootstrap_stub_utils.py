@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+if sys.version_info[0] < 3:
+    eprint("This script requires python version 3 or greater")
+    exit(1)
+
+
+# Local stand-ins for the conan server and the StanzaOrg git repositories, for
+# the offline tests and benchmarks of the bootstrap scripts.
+
+class StubConanServer:
+    """
+    A minimal local stand-in for the conan server v2 API, for offline tests
+
+    Serves the packages in `packages`, which is a dictionary in the form:
+        { "name/version": { recipe_revision: { "time": str,
+                                               "packages": { package_id: { "info": dict,
+                                                                           "revisions": { package_revision: { "time": str,
+                                                                                                              "files": { filename: bytes }}}}}}}}
+
+    Counts the number of requests and client connections it has handled, and
+    answers conditional requests with a matching ETag with "304 Not Modified".
+
+    latency is either a number of seconds to delay every response by, or a function
+    of the request path returning the number of seconds to delay that response by.
+    bandwidth limits the rate in bytes per second that each response body is sent at.
+
+    Range requests are supported.  To simulate dropped connections, the first `drops`
+    file downloads are cut off after `drop_after` bytes.  To simulate an overloaded
+    server, a `fail_rate` fraction of requests is answered with "503 Service Unavailable",
+    and a `stall_rate` fraction of requests stalls for `stall` seconds before it is answered,
+    chosen by a random generator seeded with `seed`.
+    """
+    def __init__(self, packages: dict, latency=0, drop_after: int = 0, drops: int = 0,
+                 bandwidth: int = 0, fail_rate: float = 0.0, stall_rate: float = 0.0, stall: float = 0,
+                 seed: int = 0, port: int = 0):
+        import http.server
+        import random
+
+        stub = self
+        self.packages = packages
+        self.latency = latency
+        self.drop_after = drop_after
+        self.drops = drops
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.random = random.Random(seed)
+        self.failures = 0
+        self.stalls = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.requests = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # HTTP/1.1 so that clients can keep connections alive
+            protocol_version = "HTTP/1.1"
+            # send headers and small bodies right away, instead of waiting for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub.lock:
+                    stub.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on a stalled or dropped response
+                    pass
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                latency = stub.latency(self.path) if callable(stub.latency) else stub.latency
+                if latency:
+                    time.sleep(latency)
+                with stub.lock:
+                    fail = stub.fail_rate > 0 and stub.random.random() < stub.fail_rate
+                    stub.failures += 1 if fail else 0
+                    stall = stub.stall_rate > 0 and stub.random.random() < stub.stall_rate
+                    stub.stalls += 1 if stall else 0
+                if stall:
+                    time.sleep(stub.stall)
+                if fail:
+                    status, body = 503, {"errors": [{"status": 503, "message": "Service Unavailable"}]}
+                else:
+                    status, body = stub.route(self.path)
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body).encode()
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    with stub.lock:
+                        stub.not_modified += 1
+                    status, body = 304, b""
+                content_range = None
+                range_header = self.headers.get("Range", "")
+                if status == 200 and range_header.startswith("bytes=") and self.headers.get("If-Range", etag) == etag:
+                    start = int(range_header.removeprefix("bytes=").partition("-")[0])
+                    content_range = f"bytes {start}-{len(body) - 1}/{len(body)}"
+                    status, body = 206, body[start:]
+                drop = False
+                if "/files/" in self.path and len(body) > stub.drop_after:
+                    with stub.lock:
+                        drop = stub.drops > 0
+                        stub.drops -= 1 if drop else 0
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                if content_range:
+                    self.send_header("Content-Range", content_range)
+                self.end_headers()
+                if drop:
+                    self.send_body(body[:stub.drop_after])
+                    self.close_connection = True
+                else:
+                    self.send_body(body)
+
+            def send_body(self, body: bytes):
+                if not stub.bandwidth:
+                    self.wfile.write(body)
+                else:
+                    # send a tenth of a second's worth at a time
+                    chunk = max(1, stub.bandwidth // 10)
+                    for i in range(0, len(body), chunk):
+                        self.wfile.write(body[i:i + chunk])
+                        time.sleep(len(body[i:i + chunk]) / stub.bandwidth)
+                with stub.lock:
+                    stub.bytes_sent += len(body)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/artifactory/api/conan/conan-local"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def route(self, path: str):
+        notfound = (404, {"errors": [{"status": 404, "message": "Not Found"}]})
+        url = urllib.parse.urlparse(path)
+        parts = [urllib.parse.unquote_plus(p) for p in url.path.partition("/v2/conans/")[2].split("/")]
+        if parts == ["search"]:
+            q = urllib.parse.parse_qs(url.query).get("q", [""])[0]
+            return 200, {"results": [f"{nv}@_/_" for nv in self.packages if nv.partition("/")[0] == q]}
+        if len(parts) < 5 or parts[2:5] != ["_", "_", "revisions"]:
+            return notfound
+        rrevs = self.packages.get(f"{parts[0]}/{parts[1]}", {})
+        rest = parts[5:]
+
+        def revision_list(d):
+            revs = [{"revision": r, "time": v["time"]} for r, v in d.items()]
+            return sorted(revs, key=lambda r: r["time"], reverse=True)
+
+        if not rest:
+            return (200, {"revisions": revision_list(rrevs)}) if rrevs else notfound
+        if rest[0] not in rrevs:
+            return notfound
+        pkgs = rrevs[rest[0]]["packages"]
+        if rest[1:] == ["search"]:
+            return 200, {pid: p["info"] for pid, p in pkgs.items()}
+        if len(rest) < 4 or rest[1] != "packages" or rest[2] not in pkgs or rest[3] != "revisions":
+            return notfound
+        prevs = pkgs[rest[2]]["revisions"]
+        if len(rest) == 4:
+            return 200, {"revisions": revision_list(prevs)}
+        if len(rest) == 7 and rest[4] in prevs and rest[5] == "files" and rest[6] in prevs[rest[4]]["files"]:
+            return 200, prevs[rest[4]]["files"][rest[6]]
+        return notfound
+
+
+def stub_package_info(os_name: str, options: dict) -> dict:
+    """Returns a package search result entry for a package built for the given os"""
+    return {"settings": {"os": os_name, "arch": "x86_64", "build_type": "Release"}, "options": options}
+
+
+def stub_package_files(files: dict[str, bytes]) -> dict[str, bytes]:
+    """Returns the conan_package.tgz and conanmanifest.txt of a package containing the given files"""
+    import io
+    import tarfile
+
+    tgz = io.BytesIO()
+    with tarfile.open(fileobj=tgz, mode="w:gz") as tf:
+        for name, data in files.items():
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            tf.addfile(ti, io.BytesIO(data))
+    manifest = "1700000000\n" + "".join(f"{name}: {hashlib.md5(data).hexdigest()}\n" for name, data in sorted(files.items()))
+    return {"conan_package.tgz": tgz.getvalue(), "conanmanifest.txt": manifest.encode()}
+
+
+
+def stub_package(name: str, version: str, files: dict[str, bytes], os_name: str = "Linux", options: dict = None) -> dict:
+    """Returns the StubConanServer packages entry of a single package with one revision of one package_id"""
+    return {f"{name}/{version}": {"rrev0": {"time": "2024-01-01T00:00:00.000+0000", "packages": {
+        "pid0": {"info": stub_package_info(os_name, options or {}),
+                 "revisions": {"prev0": {"time": "2024-01-01T00:00:01.000+0000", "files": stub_package_files(files)}}}}}}}
+
+
+def synthetic_package_files(size: int, files: int = 8) -> dict[str, bytes]:
+    """Returns the files of a package of about size bytes, with a header and incompressible libraries"""
+    contents = {"include/stub.h": b"/* stub */\n"}
+    for i in range(files):
+        contents[f"lib/libstub{i}.a"] = os.urandom(size // files)
+    return contents
+
+
+def git_quiet(*args, cwd=None):
+    subprocess.run(["git", "-c", "user.name=slm", "-c", "user.email=slm@localhost", *args], cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def make_tagged_repo(directory: str, name: str, tags: int, file_size: int = 1024) -> str:
+    """
+    Create a bare repository with one commit per tag v0.0.1, v0.0.2, ...  Each commit
+    adds a file of file_size random bytes, so the history grows with the number of tags.
+
+    Returns: the file:// url of the bare repository
+    """
+    work = os.path.join(directory, f"{name}-work")
+    bare = os.path.join(directory, f"{name}.git")
+    git_quiet("init", "--quiet", work)
+    for i in range(1, tags + 1):
+        with open(os.path.join(work, f"file{i}.bin"), "wb") as f:
+            f.write(os.urandom(file_size))
+        with open(os.path.join(work, "slm.toml"), "w") as f:
+            f.write(f"name = \"{name}\"\nversion = \"0.0.{i}\"\n")
+        git_quiet("add", "-A", cwd=work)
+        git_quiet("commit", "--quiet", "-m", f"version 0.0.{i}", cwd=work)
+        git_quiet("tag", f"v0.0.{i}", cwd=work)
+    git_quiet("clone", "--quiet", "--bare", work, bare)
+    # allow partial clone filters and fetching commits by hash, like GitHub does
+    git_quiet("config", "uploadpack.allowFilter", "true", cwd=bare)
+    git_quiet("config", "uploadpack.allowAnySHA1InWant", "true", cwd=bare)
+    shutil.rmtree(work)
+    return "file://" + bare.replace(os.sep, "/")
+
+def push_tag(url: str, tag: str):
+    """Add a commit tagged tag to the bare repository at url"""
+    with tempfile.TemporaryDirectory() as work:
+        git_quiet("clone", "--quiet", url, work)
+        with open(os.path.join(work, f"{tag}.txt"), "w") as f:
+            f.write(tag)
+        git_quiet("add", "-A", cwd=work)
+        git_quiet("commit", "--quiet", "-m", tag, cwd=work)
+        git_quiet("tag", tag, cwd=work)
+        git_quiet("push", "--quiet", "origin", "HEAD", tag, cwd=work)
+
+
+### Tests ######################################################################
+
+class TestStubConanServer(unittest.TestCase):
+    def get(self, url: str):
+        import urllib.request
+        import urllib.error
+        try:
+            with urllib.request.urlopen(url) as r:
+                return r.status, r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def files_url(self, server) -> str:
+        return f"{server.url}/v2/conans/stub/1.0/_/_/revisions/rrev0/packages/pid0/revisions/prev0/files"
+
+    def test_routes(self):
+        with StubConanServer(stub_package("stub", "1.0", {"lib/a.a": b"a"})) as server:
+            status, body = self.get(f"{server.url}/v2/conans/search?q=stub")
+            self.assertEqual((status, json.loads(body)), (200, {"results": ["stub/1.0@_/_"]}))
+            status, body = self.get(f"{server.url}/v2/conans/stub/1.0/_/_/revisions")
+            self.assertEqual(json.loads(body)["revisions"][0]["revision"], "rrev0")
+            status, body = self.get(f"{self.files_url(server)}/conanmanifest.txt")
+            self.assertIn(b"lib/a.a: ", body)
+            self.assertEqual(self.get(f"{server.url}/v2/conans/other/1.0/_/_/revisions")[0], 404)
+
+    def test_bandwidth(self):
+        files = synthetic_package_files(256 * 1024, files=1)
+        with StubConanServer(stub_package("stub", "1.0", files), bandwidth=1024 * 1024) as server:
+            start = time.monotonic()
+            status, body = self.get(f"{self.files_url(server)}/conan_package.tgz")
+            elapsed = time.monotonic() - start
+        self.assertEqual(status, 200)
+        self.assertGreater(elapsed, 0.8 * len(body) / (1024 * 1024))
+
+    def test_fail_rate(self):
+        with StubConanServer(stub_package("stub", "1.0", {}), fail_rate=0.5, seed=1) as server:
+            statuses = [self.get(f"{server.url}/v2/conans/search?q=stub")[0] for _ in range(40)]
+        self.assertEqual(statuses.count(503), server.failures)
+        self.assertTrue(5 < server.failures < 35)
+        self.assertEqual(statuses.count(200), 40 - server.failures)
+
+    def test_stall_rate(self):
+        with StubConanServer(stub_package("stub", "1.0", {}), stall_rate=0.25, stall=0.2, seed=1) as server:
+            times = []
+            for _ in range(20):
+                start = time.monotonic()
+                self.assertEqual(self.get(f"{server.url}/v2/conans/search?q=stub")[0], 200)
+                times.append(time.monotonic() - start)
+        self.assertTrue(0 < server.stalls < 20)
+        self.assertEqual(len([t for t in times if t >= 0.2]), server.stalls)
+
+    def test_tagged_repo(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            url = make_tagged_repo(tmpdir, "dep", tags=3)
+            push_tag(url, "v1.0.0")
+            tags = subprocess.run(["git", "ls-remote", "--tags", url], check=True, capture_output=True, text=True).stdout
+        self.assertEqual(sorted(line.rpartition("/")[2] for line in tags.splitlines()), ["v0.0.1", "v0.0.2", "v0.0.3", "v1.0.0"])
+
+
+def parse_size(s: str) -> int:
+    """Parses a size like "512K", "4M" or "2G" into bytes"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    s = s.strip().upper().removesuffix("B")
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="bootstrap_stub_utils.py",
+                                     description="Local stand-in for the conan server, for testing and benchmarking bootstrap.py offline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve synthetic conan packages until interrupted")
+    serve.add_argument("--port", type=int, default=0, help="port to listen on, default any free port")
+    serve.add_argument("--package", action="append", default=[], metavar="NAME/VERSION:SIZE",
+                       help="serve a synthetic package, like zlib/1.3.1:4M.  Can be repeated")
+    serve.add_argument("--os", default="Linux", help="os setting of the served packages, default Linux")
+    serve.add_argument("--latency", type=float, default=0, help="seconds to delay each response by")
+    serve.add_argument("--bandwidth", type=parse_size, default=0, help="bytes per second to send responses at, like 10M")
+    serve.add_argument("--fail-rate", type=float, default=0, help="fraction of requests to fail with 503")
+    serve.add_argument("--stall-rate", type=float, default=0, help="fraction of requests to stall")
+    serve.add_argument("--stall", type=float, default=10, help="seconds stalled requests wait before they are answered, default 10")
+    serve.add_argument("--drops", type=int, default=0, help="number of file downloads to cut off")
+    serve.add_argument("--drop-after", type=parse_size, default=0, help="bytes after which dropped downloads are cut off")
+    a = parser.parse_args(args)
+
+    packages = {}
+    for spec in a.package:
+        nv, _, size = spec.partition(":")
+        name, _, version = nv.partition("/")
+        packages.update(stub_package(name, version, synthetic_package_files(parse_size(size or "1M")), a.os))
+    with StubConanServer(packages, latency=a.latency, bandwidth=a.bandwidth, fail_rate=a.fail_rate,
+                         stall_rate=a.stall_rate, stall=a.stall, drops=a.drops, drop_after=a.drop_after, port=a.port) as server:
+        # the SLM_CONAN_URL to point bootstrap.py at this server
+        print(server.url, flush=True)
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("serve",):
+        main(sys.argv[1:])
+    else:
+        # self-test
+        unittest.main()
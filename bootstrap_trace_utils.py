@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+
+_output_lock = threading.Lock()
+
+def eprint(msg):
+    # write each message at once, so that messages from concurrent threads don't interleave
+    with _output_lock:
+        sys.stderr.write(f"{msg}\n")
+        sys.stderr.flush()
+
+if sys.version_info[0] < 3:
+    eprint("This script requires python version 3 or greater")
+    exit(1)
+
+
+# log levels, from least to most verbose
+LOG_LEVELS = ("error", "warning", "info", "debug")
+DEFAULT_LOG_LEVEL = "info"
+
+# number of slowest operations printed in the summary of a trace
+DEFAULT_TRACE_TOP = 10
+
+def log_level_from_environment() -> str:
+    """Returns the log level in the SLM_LOG_LEVEL environment variable, or the default log level"""
+    level = os.environ.get("SLM_LOG_LEVEL", DEFAULT_LOG_LEVEL).lower()
+    return level if level in LOG_LEVELS else DEFAULT_LOG_LEVEL
+
+def log_enabled(level: str, current: str = None) -> bool:
+    """Returns True if messages at level are shown at the current log level"""
+    return LOG_LEVELS.index(level) <= LOG_LEVELS.index(current or LOG_LEVEL)
+
+LOG_LEVEL = log_level_from_environment()
+
+DEBUG = log_enabled("debug")
+
+def log(level: str, msg: str, *args):
+    """
+    Print a message at a log level, if SLM_LOG_LEVEL enables it
+
+    The message is only formatted with args when it is printed, like "fetched %s in %.1fs".
+    """
+    if log_enabled(level):
+        eprint(msg % args if args else msg)
+
+def debug(msg: str, *args):
+    """Print a debug message, if SLM_LOG_LEVEL=debug, without formatting it otherwise"""
+    if DEBUG:
+        eprint(msg % args if args else msg)
+
+
+class Span:
+    """
+    A timed operation in a trace
+
+    Operations can add details to args while they run, like the number of bytes they transferred.
+    """
+    __slots__ = ("name", "category", "args", "start", "duration", "thread")
+
+    def __init__(self, name: str, category: str, args: dict):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.duration = None
+        self.thread = None
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "category": self.category, "start": self.start,
+                "duration": self.duration, "thread": self.thread, "args": self.args}
+
+
+class NullArgs(dict):
+    """The args of a NullSpan, which stay empty"""
+    def __setitem__(self, key, value):
+        pass
+
+    def update(self, *args, **kwargs):
+        pass
+
+
+class NullSpan:
+    """The span of a disabled tracer, which records nothing"""
+    __slots__ = ()
+    args = NullArgs()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Records the time of bootstrap phases and external calls, to write them as JSON and as a
+    Chrome trace (https://ui.perfetto.dev or chrome://tracing can show it), and to summarize
+    the slowest operations.
+
+    A disabled tracer hands out a shared no-op span, so tracing costs nothing unless it is enabled.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls) -> "Tracer":
+        """Returns a tracer that is enabled if the SLM_TRACE environment variable names an output file"""
+        return cls(enabled=bool(os.environ.get("SLM_TRACE")))
+
+    def span(self, name: str, category: str, **args):
+        """
+        Returns a context manager timing an operation, like:
+
+            with TRACER.span("GET", "http", url=url) as span:
+                ...
+                span.args["bytes"] = n
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return self._span(name, category, args)
+
+    @contextmanager
+    def _span(self, name: str, category: str, args: dict):
+        span = Span(name, category, args)
+        span.thread = threading.current_thread().name
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.args["error"] = type(e).__name__
+            raise
+        finally:
+            span.start = start - self.origin
+            span.duration = time.perf_counter() - start
+            with self.lock:
+                self.spans.append(span)
+
+    def slowest(self, n: int = DEFAULT_TRACE_TOP) -> list:
+        with self.lock:
+            return sorted(self.spans, key=lambda s: s.duration, reverse=True)[:n]
+
+    def to_json(self) -> dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        return {"spans": [s.to_dict() for s in spans]}
+
+    def to_chrome_trace(self) -> dict:
+        """Returns the spans as complete ("X") events of the Chrome trace event format, in microseconds"""
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        threads = {}
+        events = []
+        for s in spans:
+            tid = threads.setdefault(s.thread, len(threads))
+            events.append({"name": s.name, "cat": s.category, "ph": "X", "pid": 0, "tid": tid,
+                           "ts": round(s.start * 1e6), "dur": round(s.duration * 1e6), "args": s.args})
+        for thread, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: str):
+        """
+        Write the trace to path as JSON, and as a Chrome trace next to it
+
+        For "trace.json", writes "trace.json" and "trace.chrome.json"
+        """
+        stem = path[:-5] if path.endswith(".json") else path
+        with open(f"{stem}.json", "w") as f:
+            json.dump(self.to_json(), f, indent=1)
+        with open(f"{stem}.chrome.json", "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def summary(self, n: int = DEFAULT_TRACE_TOP) -> str:
+        """Returns a table of the total time per category, and of the n slowest operations"""
+        with self.lock:
+            spans = list(self.spans)
+        totals = {}
+        for s in spans:
+            count, total = totals.get(s.category, (0, 0.0))
+            totals[s.category] = (count + 1, total + s.duration)
+        lines = ["time by category:"]
+        for category, (count, total) in sorted(totals.items(), key=lambda t: t[1][1], reverse=True):
+            lines.append(f"  {total:8.3f}s  {count:5d}x  {category}")
+        lines.append(f"{min(n, len(spans))} slowest operations:")
+        for s in self.slowest(n):
+            detail = " ".join(f"{k}={v}" for k, v in s.args.items())
+            lines.append(f"  {s.duration:8.3f}s  {s.category:<8} {s.name} {detail}".rstrip())
+        return "\n".join(lines)
+
+    def finish(self):
+        """Write the trace to the SLM_TRACE file and print the summary, if tracing is enabled"""
+        if not self.enabled:
+            return
+        path = os.environ.get("SLM_TRACE")
+        if path:
+            self.write(path)
+        top = int(os.environ.get("SLM_TRACE_TOP", DEFAULT_TRACE_TOP))
+        eprint(self.summary(top))
+
+
+# the tracer shared by the bootstrap modules
+TRACER = Tracer.from_environment()
+
+
+### Tests ######################################################################
+
+class TestTracer(unittest.TestCase):
+    def test_disabled_records_nothing(self):
+        tracer = Tracer(enabled=False)
+        with tracer.span("op", "test", x=1) as span:
+            span.args["bytes"] = 10
+        self.assertIs(tracer.span("op", "test"), NULL_SPAN)
+        self.assertEqual(tracer.spans, [])
+        self.assertEqual(NULL_SPAN.args, {})
+
+    def test_span_records_args_and_duration(self):
+        tracer = Tracer(enabled=True)
+        with tracer.span("GET", "http", url="http://x") as span:
+            time.sleep(0.01)
+            span.args["bytes"] = 123
+        [s] = tracer.spans
+        self.assertEqual((s.name, s.category), ("GET", "http"))
+        self.assertEqual(s.args, {"url": "http://x", "bytes": 123})
+        self.assertGreaterEqual(s.duration, 0.01)
+        self.assertGreaterEqual(s.start, 0)
+
+    def test_span_records_errors(self):
+        tracer = Tracer(enabled=True)
+        with self.assertRaises(ValueError):
+            with tracer.span("op", "test"):
+                raise ValueError("x")
+        self.assertEqual(tracer.spans[0].args["error"], "ValueError")
+
+    def test_threads(self):
+        tracer = Tracer(enabled=True)
+        def work():
+            for _ in range(100):
+                with tracer.span("op", "test"):
+                    pass
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(tracer.spans), 400)
+        trace = tracer.to_chrome_trace()
+        self.assertEqual(len([e for e in trace["traceEvents"] if e["ph"] == "M"]), 4)
+
+    def test_chrome_trace_and_summary(self):
+        tracer = Tracer(enabled=True)
+        with tracer.span("outer", "phase"):
+            with tracer.span("fast", "git"):
+                pass
+            with tracer.span("slow", "http"):
+                time.sleep(0.02)
+        events = [e for e in tracer.to_chrome_trace()["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual([e["name"] for e in events], ["outer", "fast", "slow"])
+        for e in events:
+            self.assertTrue({"name", "cat", "ph", "pid", "tid", "ts", "dur"} <= set(e))
+        self.assertEqual([s.name for s in tracer.slowest(2)], ["outer", "slow"])
+        summary = tracer.summary(2)
+        self.assertIn("2 slowest operations:", summary)
+        self.assertNotIn("fast", summary.split("slowest operations:")[1])
+
+    def test_write(self):
+        import tempfile
+        tracer = Tracer(enabled=True)
+        with tracer.span("op", "test"):
+            pass
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracer.write(os.path.join(tmpdir, "trace.json"))
+            with open(os.path.join(tmpdir, "trace.json")) as f:
+                self.assertEqual(json.load(f)["spans"][0]["name"], "op")
+            with open(os.path.join(tmpdir, "trace.chrome.json")) as f:
+                self.assertEqual(json.load(f)["traceEvents"][0]["name"], "op")
+
+    def test_log_levels(self):
+        self.assertTrue(log_enabled("info", "debug"))
+        self.assertFalse(log_enabled("debug", "info"))
+        self.assertTrue(log_enabled("error", "error"))
+
+    def test_log(self):
+        import io
+        from unittest import mock
+        for level, expected in (("warning", "warned 1\n"), ("info", "warned 1\ninformed 2\n")):
+            with mock.patch(f"{__name__}.LOG_LEVEL", level), mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+                log("warning", "warned %s", 1)
+                log("info", "informed %s", 2)
+                self.assertEqual(stderr.getvalue(), expected)
+
+
+if __name__ == "__main__":
+    # self-test
+    unittest.main()
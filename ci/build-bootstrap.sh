@@ -11,6 +11,7 @@ case "$OSTYPE" in
       /usr/bin/find .slm -not -perm /u+w -exec chmod u+w {} + ;;
 esac
 
+# slm clean keeps bootstrap.lock, so the next bootstrap fetches the same versions
 ./slm clean
 ./slm build -verbose -- -verbose
 
@@ -6,13 +6,13 @@ if V[0] < 3 or (V[0] == 3 and V[1] < 11):
 
 import os
 import platform
-import tomllib
 from conan import ConanFile
 from conan.errors import ConanInvalidConfiguration
 from conan.tools.build import can_run
 from conan.tools.files import copy
 from conan.tools.cmake import CMakeDeps, CMakeToolchain
 from conan.tools.env import VirtualBuildEnv
+from io import StringIO
 from pathlib import Path
 from shutil import copy2, copytree, which
 
@@ -20,30 +20,37 @@ required_conan_version = ">=2.0"
 
 class ConanSlmPackage(ConanFile):
   package_type = "application"
-  python_requires = "lbstanzagenerator_pyreq/[>=0.6.20 <0.7.0]"
+  python_requires = "lbstanzagenerator_pyreq/[>=0.6.31 <0.7.0]"
 
   # Binary configuration
   #settings = "os", "arch", "compiler", "build_type"
   settings = "os", "arch"
 
+  # compiled_pkgs: also package the compiled stanza packages, for consumers to load instead of compiling
+  options = {"compiled_pkgs": [True, False]}
+  default_options = {"compiled_pkgs": False}
+
   # hide all dependencies from consumers
   # https://blog.conan.io/2024/07/09/Introducing-vendoring-packages.html
   vendor = True
 
 
+  # _slm_project(): The slm.toml of the recipe, parsed once and shared with the generator
+  def _slm_project(self):
+    return self.python_requires["lbstanzagenerator_pyreq"].module.load_slm_toml(os.path.join(self.recipe_folder, "slm.toml"))
+
+
   # set_name(): Dynamically define the name of a package
   def set_name(self):
     self.output.info("conanfile.py: set_name()")
-    with open(f"{self.recipe_folder}/slm.toml", "rb") as f:
-        self.name = tomllib.load(f)["name"]
+    self.name = self._slm_project().name
     self.output.info(f"conanfile.py: set_name() - self.name={self.name} from slm.toml")
 
 
   # set_version(): Dynamically define the version of a package.
   def set_version(self):
     self.output.info("conanfile.py: set_version()")
-    with open(f"{self.recipe_folder}/slm.toml", "rb") as f:
-        self.version = tomllib.load(f)["version"]
+    self.version = self._slm_project().version
     self.output.info(f"conanfile.py: set_version() - self.version={self.version} from slm.toml")
 
 
@@ -89,9 +96,9 @@ class ConanSlmPackage(ConanFile):
   def export_sources(self):
     self.output.info("conanfile.py: export_sources()")
     copy2(os.path.join(self.recipe_folder, "slm.toml"), self.export_sources_folder)
-    #lock = os.path.join(self.recipe_folder, "slm.lock")
-    #if os.path.exists(lock):
-    #  copy2(lock, self.export_sources_folder)
+    lock = os.path.join(self.recipe_folder, "bootstrap.lock")
+    if os.path.exists(lock):
+      copy2(lock, self.export_sources_folder)
     # copy template stanza proj files, if any
     for f in Path(".").glob("template-stanza-*.proj"):
         copy2(os.path.join(self.recipe_folder, f), self.export_sources_folder)
@@ -107,61 +114,49 @@ class ConanSlmPackage(ConanFile):
   def configure(self):
     self.output.info("conanfile.py: configure()")
 
-    with open(f"{self.recipe_folder}/slm.toml", "rb") as f:
-      deps = tomllib.load(f)["dependencies"]
-      # get current platform
-      psys = platform.system().lower()
-      if psys=="darwin":
-        psys = "macos"
-
-      # for each dependency in slm.toml
-      for k, d in deps.items():
-        # if it's a conan pkg dependency
-        if "pkg" in d.keys() and "type" in d.keys() and d["type"]=="conan":
-          # get its name and set any options
-          pkgname = d["pkg"]
-
-          if "options" in d.keys():
-            opts = d["options"]
-            for k, v in opts.items():
-              self.output.trace(f"conanfile.py: configure() options[\"{pkgname}\"].{k}={v}")
-              # check for platform-specific options
-              if k in ["linux", "macos", "windows"]:
-                # only apply our platform, skip others
-                if k==psys:
-                  for k2, v2 in v.items():
-                    self.options[pkgname]._set(k2,v2)
-              else:
-                self.options[pkgname]._set(k,v)
+    # for each conan pkg dependency in slm.toml, set its options for the current platform
+    for d in self._slm_project().conan_dependencies():
+      for k, v in d.options.items():
+        self.output.trace(f"conanfile.py: configure() options[\"{d.pkg}\"].{k}={v}")
+        self.options[d.pkg]._set(k, v)
 
 
   # requirements(): Define the dependencies of the package
   def requirements(self):
     self.output.info("conanfile.py: requirements()")
 
-    with open(f"{self.recipe_folder}/slm.toml", "rb") as f:
-      deps = tomllib.load(f)["dependencies"]
+    # for each conan pkg dependency in slm.toml, use its name and version as a conan requires
+    for d in self._slm_project().conan_dependencies():
+      pkgname = d.pkg
+      pkgver = d.version
+
+      # package_id_mode="unrelated_mode" means don't list this required lib in the
+      # requirements for the slm output package
+      self.output.trace(f"conanfile.py: requirements() requires(\"{pkgname}/{pkgver}\", package_id_mode=\"unrelated_mode\")")
+      self.requires(f"{pkgname}/{pkgver}", package_id_mode="unrelated_mode")
 
-      # for each dependency in slm.toml
-      for k, d in deps.items():
-        # if it's a conan pkg dependency
-        if "pkg" in d.keys() and "type" in d.keys() and d["type"]=="conan":
-          # use its name and version as a conan requires
-          pkgname = d["pkg"]
-          pkgver = d["version"]
 
-          # package_id_mode="unrelated_mode" means don't list this required lib in the
-          # requirements for the slm output package
-          self.output.trace(f"conanfile.py: requirements() requires(\"{pkgname}/{pkgver}\", package_id_mode=\"unrelated_mode\")")
-          self.requires(f"{pkgname}/{pkgver}", package_id_mode="unrelated_mode")
+  # validate(): Verify if a configuration is valid
+  def validate(self):
+    if self.options.compiled_pkgs and not self._packaged_stanza_version():
+      raise ConanInvalidConfiguration("compiled_pkgs=True requires the stanza version to compile them with, "
+                                      "like -c user.jitx.slm:stanza_version=0.18.78")
+
+
+  # _packaged_stanza_version(): The lbstanza version of packaged compiled packages, from user.jitx.slm:stanza_version
+  def _packaged_stanza_version(self):
+    return self.conf.get("user.jitx.slm:stanza_version")
 
 
   # build_requirements(): Defines tool_requires and test_requires
   def build_requirements(self):
     self.output.info("conanfile.py: build_requirements()")
   
-    # use stanza provided by conan
-    self.tool_requires("lbstanza/[>=0.18.78 <1.0]")
+    # use stanza provided by conan, exactly the version that packaged compiled packages are specific to
+    if self.options.compiled_pkgs and self._packaged_stanza_version():
+      self.tool_requires(f"lbstanza/{self._packaged_stanza_version()}")
+    else:
+      self.tool_requires("lbstanza/[>=0.18.78 <1.0]")
     self.tool_requires(f"slm/[>=0.6.22 <{self.version}]")
 
     # use cmake and ninja provided by conan
@@ -174,6 +169,16 @@ class ConanSlmPackage(ConanFile):
       self.tool_requires("mingw-builds/11.2.0")
 
 
+  # package_id(): Customize the package id of the binary package
+  def package_id(self):
+    # compiled stanza packages can only be loaded by the stanza version that compiled them,
+    # so a binary package that ships them is specific to that version.  The package id can't
+    # come from the resolved lbstanza tool_requires: tool_requires don't take part in it, and
+    # the dependencies of vendor packages aren't even expanded to compute it.
+    if self.info.options.compiled_pkgs:
+      self.info.conf.define("user.jitx.slm:stanza_version", self._packaged_stanza_version())
+
+
   # generate(): Generates the files that are necessary for building the package
   def generate(self):
     self.output.info("conanfile.py: generate()")
@@ -183,35 +188,56 @@ class ConanSlmPackage(ConanFile):
     #self.run("pwd ; ls -la", cwd=None, ignore_errors=False, env="", quiet=False, shell=True, scope="build")
 
 
+  # _toolchain(): The versions of the tools and the settings that compiled packages depend on
+  def _toolchain(self):
+    toolchain = {"os": platform.system(), "arch": platform.machine()}
+    for tool in ("stanza", "slm"):
+      out = StringIO()
+      self.run(f"{tool} version", stdout=out, cwd=self.source_folder, scope="build")
+      toolchain[tool] = out.getvalue().strip()
+      self.output.info(f"conanfile.py: {tool} version {toolchain[tool]}")
+    return toolchain
+
+
+  # _build_outputs(): The files that `slm build` produces
+  def _build_outputs(self):
+    return ["slm.exe" if platform.system()=="Windows" else "slm"]
+
+
   # build(): Contains the build instructions to build a package from source
   def build(self):
     self.output.info("conanfile.py: build()")
     self.run("bash -c 'pwd ; ls -la'", cwd=self.source_folder, scope="build")
-    self.run("stanza version", cwd=self.source_folder, scope="build")
-    self.run("slm version", cwd=self.source_folder, scope="build")
-    self.run("bash -c '[ ! -d .slm ] || slm clean'", cwd=self.source_folder, scope="build")
-    self.run("slm build -verbose -- -verbose", cwd=self.source_folder, scope="build")
+
+    # build incrementally, reusing the compiled packages in .slm unless the toolchain or the
+    # dependencies changed.  Set user.jitx.slm:clean_build=True to always build from scratch.
+    # the compiled packages the dependencies ship are copied into the pkg-cache after any clean
+    slm_build = self.python_requires["lbstanzagenerator_pyreq"].module
+    clean = self.conf.get("user.jitx.slm:clean_build", default=False, check_type=bool)
+    package_folders = [dep.package_folder for dep in self.dependencies.values() if dep.package_folder]
+    mode, fingerprint = slm_build.prepare_build(self.source_folder, self._toolchain(), package_folders,
+                                                lambda cmd: self.run(cmd, cwd=self.source_folder, scope="build"),
+                                                clean, self._build_outputs())
+    self.output.info(f"conanfile.py: build() - {mode} build")
+    if mode != "up-to-date":
+      self.run("slm build -verbose -- -verbose", cwd=self.source_folder, scope="build")
 
     if not self.conf.get("tools.build:skip_test", default=False):
       d="build"
       t="test"
-      self.run(f"stanza clean", cwd=self.source_folder, scope="build")
+      # the test build reuses the packages compiled above, from the pkg-cache in stanza.proj
       self.run(f"stanza build {t} -o {d}/{t} -verbose", cwd=self.source_folder, scope="build")
       update_path_cmd=""
       if platform.system()=="Darwin":
-        # on macos, find all dlls in the current directory recursively, and add their directories to the DYLD_LIBRARY_PATH so that the dlls can be located at runtime
-        # get a unique set of directories that contain dlls under the current directory
-        dylib_dirs = {p.resolve().parents[0].as_posix() for p in sorted(Path('.').glob('**/*.dylib'))}
-        path_str = ':'.join(dylib_dirs)
+        # on macos, add the library directories of the dependencies, listed by the generator, to the DYLD_LIBRARY_PATH so that the dlls can be located at runtime
+        path_str = ':'.join(slm_build.runtime_library_dirs(self.source_folder))
         if path_str:
           update_path_cmd=f"export DYLD_LIBRARY_PATH={path_str}:$DYLD_LIBRARY_PATH ; "
       elif platform.system()=="Windows":
         t="test.exe"
-        # on windows, find all dlls in the current directory recursively, and add their directories to the PATH so that the dlls can be located at runtime
-        # get a unique set of directories that contain dlls under the current directory
-        dll_win_dirs = {p.resolve().parents[0].as_posix() for p in sorted(Path('.').glob('**/*.dll'))}
+        # on windows, add the library directories of the dependencies, listed by the generator, to the PATH so that the dlls can be located at runtime
         # convert those windows-style paths to bash-style paths
-        dll_bash_dirs = [f"/{d[0].lower()}{d[2:]}" for d in dll_win_dirs]
+        dll_bash_dirs = [f"/{d[0].lower()}{d[2:]}" for d in slm_build.runtime_library_dirs(self.source_folder)]
         # make a path-style string of those bash-style paths
         path_str = ':'.join(dll_bash_dirs)
         if path_str:
@@ -219,6 +245,8 @@ class ConanSlmPackage(ConanFile):
       self.run(f"bash -c '{update_path_cmd} {d}/{t}'",
                cwd=self.source_folder, scope="build")
 
+    slm_build.write_build_stamp(self.source_folder, fingerprint)
+
 
   # _codesign(): Internal function to sign the executables
   def _codesign(self):
@@ -236,11 +264,19 @@ class ConanSlmPackage(ConanFile):
       self._codesign()
 
     copy2(os.path.join(self.source_folder, "slm.toml"), self.package_folder)
-    #copy2(os.path.join(self.source_folder, "slm.lock"), self.package_folder)
+    lock = os.path.join(self.source_folder, "bootstrap.lock")
+    if os.path.exists(lock):
+      copy2(lock, self.package_folder)
     copy2(os.path.join(self.source_folder, f"stanza-{outerlibname}-relative.proj"), os.path.join(self.package_folder, f"stanza-{outerlibname}.proj"))
     copy2(os.path.join(self.source_folder, "stanza.proj"), os.path.join(self.package_folder, "stanza.proj"))
     copytree(os.path.join(self.source_folder, "src"), os.path.join(self.package_folder, "src"))
 
+    # copy the compiled stanza packages of src/, which the build() of consumers copies into their pkg-cache
+    if self.options.compiled_pkgs:
+      slm_build = self.python_requires["lbstanzagenerator_pyreq"].module
+      n = slm_build.package_compiled_pkgs(self.source_folder, os.path.join(self.package_folder, slm_build.PACKAGED_PKGS_DIRECTORY))
+      self.output.info(f"conanfile.py: package() - {n} compiled stanza packages")
+
     # copy slm executable from the build directory to /bin/
     slm="slm"
     if platform.system()=="Windows":
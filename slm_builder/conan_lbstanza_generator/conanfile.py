@@ -4,13 +4,29 @@
 
 from conan import ConanFile
 from conan.tools.files import save
-from io import TextIOWrapper
+import os
+from io import StringIO, TextIOWrapper
 from pathlib import Path
 
+# the slm.toml project model, for the recipes that python_requires this package:
+# self.python_requires["lbstanzagenerator_pyreq"].module.load_slm_toml(path)
+from slm_toml import (ConanDependency, GitDependency, PathDependency, SlmProject, SlmTomlError,
+                      load_slm_toml, platform_options)
+# incremental builds, for the build() of the recipes:
+# self.python_requires["lbstanzagenerator_pyreq"].module.build_mode(folder, fingerprint)
+from slm_build import (PACKAGED_PKGS_DIRECTORY, PKG_CACHE_DIRECTORY, RUNTIME_ENV, build_fingerprint, build_mode, package_compiled_pkgs,
+                       prepare_build, read_build_stamp, runtime_library_dirs, seed_pkg_cache, write_build_stamp, write_if_changed,
+                       write_runtime_env)
+
 class LBStanzaGeneratorPyReq(ConanFile):
     name = "lbstanzagenerator_pyreq"
-    version = "0.6.20"
+    version = "0.6.31"
     package_type = "python-require"
+    exports = "slm_toml.py", "slm_build.py"
+
+def quoted_paths(paths) -> str:
+    """Returns paths as space separated stanza strings, with forward slashes on all platforms"""
+    return " ".join('"' + str(p).replace("\\", "/") + '"' for p in paths)
 
 # LBStanza Generator class
 class LBStanzaGenerator:
@@ -43,7 +59,9 @@ class LBStanzaGenerator:
         self._conanfile.output.trace(f"      libs[\"windows\"] = \"{libs['windows']}\",")
         self._conanfile.output.trace(f"      \"{outfilename}\")")
         outerlibname = self._conanfile.name.removeprefix("slm-")
-        with open(outfilename, 'w') as outf:
+        # render the fragment in memory, and only write it if it changed, so that an unchanged
+        # fragment keeps its mtime and doesn't invalidate the build caching of stanza
+        with StringIO() as outf:
             # look for a file called "template-stanza-{outerlibname}.proj", and include its contents if it exists.
             # this is because all "package requires" statements for a stanza package must be in the same file.
             # and it's cleaner to include them in this file fragment rather than put these fragment contents into the top-level stanza.proj
@@ -80,11 +98,11 @@ class LBStanzaGenerator:
             if is_shared_lib:
                 outf.write(f'  dynamic-libraries:\n')
                 outf.write(f'    on-platform:\n')
-                s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["linux"]])
+                s = quoted_paths(libs["linux"])
                 outf.write(f'      linux: ( {s} )\n')
-                s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["macos"]])
+                s = quoted_paths(libs["macos"])
                 outf.write(f'      os-x: ( {s} )\n')
-                s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["windows"]])
+                s = quoted_paths(libs["windows"])
                 outf.write(f'      windows: ( {s} )\n')
             else:  # static
                 pass
@@ -92,12 +110,12 @@ class LBStanzaGenerator:
             outf.write(f'    on-platform:\n')
             incdirall = ""
             for incdir in include_dirs:
-                incdirall += f" \"-I{incdir.replace('\\', '/')}\" "
-            s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["linux"]])
+                incdirall += f" {quoted_paths(['-I' + str(incdir)])} "
+            s = quoted_paths(libs["linux"])
             outf.write(f'      linux: ( {incdirall} {startgrp} {s} {extralibslnx} {endgrp} )\n')
-            s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["macos"]])
+            s = quoted_paths(libs["macos"])
             outf.write(f'      os-x: ( {incdirall} {s} {extralibsmac} )\n')
-            s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["windows"]])
+            s = quoted_paths(libs["windows"])
             outf.write(f'      windows: ( {incdirall} {startgrp} {s} {extralibswin} {endgrp} )\n')
 
             outf.write(f'\n')
@@ -107,23 +125,30 @@ class LBStanzaGenerator:
             if is_shared_lib:
                 outf.write(f'  dynamic-libraries:\n')
                 outf.write(f'    on-platform:\n')
-                s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["linux"]])
+                s = quoted_paths(libs["linux"])
                 outf.write(f'      linux: ( {s} )\n')
-                s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["macos"]])
+                s = quoted_paths(libs["macos"])
                 outf.write(f'      os-x: ( {s} )\n')
-                s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["windows"]])
+                s = quoted_paths(libs["windows"])
                 outf.write(f'      windows: ( {s} )\n')
             else:  # static
                 pass
             outf.write(f'  ccflags:\n')
             outf.write(f'    on-platform:\n')
-            s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["linux"]])
+            s = quoted_paths(libs["linux"])
             outf.write(f'      linux: ( {incdirall} {startgrp} {s} {extralibslnx} {endgrp} )\n')
-            s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["macos"]])
+            s = quoted_paths(libs["macos"])
             outf.write(f'      os-x: ( {incdirall} {s} {extralibsmac} )\n')
-            s = " ".join([fr'"{str(p).replace('\\', '/')}"' for p in libs["windows"]])
+            s = quoted_paths(libs["windows"])
             outf.write(f'      windows: ( {incdirall} {startgrp} {s} {extralibswin} {endgrp} )\n')
 
+            content = outf.getvalue()
+
+        if write_if_changed(outfilename, content):
+            self._conanfile.output.trace(f"Wrote {outfilename}")
+        else:
+            self._conanfile.output.trace(f"{outfilename} is unchanged")
+
 
     def get_component_libs_from_dependency(self, depname: str, depinst) -> list:
         #self._conanfile.output.trace(f"    - depinst.cppinfo: \"{depinst.cpp_info.serialize()}\"")
@@ -201,6 +226,7 @@ class LBStanzaGenerator:
 
     def create_stanza_proj_fragment(self):
         incdirs = []
+        libdirs = []
         libs = {}
         is_shared_lib = False
         for dep in self._conanfile.dependencies.items():
@@ -222,6 +248,7 @@ class LBStanzaGenerator:
                 is_shared_lib = dinst.package_type is self.dep_is_shared_lib(dep, dinst)  # assumption: accept the last value because they should all be the same
                 for compname, compinst in dinst.cpp_info.get_sorted_components().items():
                     incdirs.extend(compinst.includedirs)
+                    libdirs.extend(compinst.libdirs)
                 for cl in self.get_component_libs_from_dependency(str(dreq.ref), dinst):
                     self._conanfile.output.trace(f"    - dep \"{dreq.ref}\" component \"{cl}\"")
                     # cl is a dictionary {name: path}
@@ -234,6 +261,7 @@ class LBStanzaGenerator:
                 self._conanfile.output.trace(f"    - dep \"{dreq.ref}\" lib dirs: {dinst.cpp_info.libdirs}")
                 self._conanfile.output.trace(f"    - dep \"{dreq.ref}\" libs: {dinst.cpp_info.libs}")
                 incdirs.extend(dinst.cpp_info.includedirs)
+                libdirs.extend(dinst.cpp_info.libdirs)
                 if len(dinst.cpp_info.libdirs) > 1:
                     self._conanfile.output.error(f"Dependency \"{dreq.ref}\" has more than one libdir.  This generator currently doesn't handle that.")
                 if len(dinst.cpp_info.libdirs) > 0:
@@ -253,9 +281,169 @@ class LBStanzaGenerator:
 
         self.write_cpp_info_to_fragment(is_shared_lib, incdirs, libs)
 
+        # the library directories, for build() to find the shared libraries when running tests
+        self._conanfile.output.trace(f"Generating {RUNTIME_ENV} with libdirs {libdirs}")
+        write_runtime_env(".", libdirs)
+
     def generate(self):
         self._conanfile.output.trace(f"---- LBStanzaGenerator version {LBStanzaGeneratorPyReq.version} .generate() ----")
 
         self.create_stanza_proj_fragment()
 
         self._conanfile.output.trace("----")
+
+
+### Tests ######################################################################
+
+import shutil
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+class TestLBStanzaGenerator(unittest.TestCase):
+    class Output:
+        def trace(self, msg):
+            pass
+        error = trace
+
+    def conanfile(self, libdir: str, package_folder: str = None):
+        """A consumer of a static zlib, as conan install passes it to generate()"""
+        cpp_info = SimpleNamespace(components={}, includedirs=[os.path.join(libdir, "..", "include")], libdirs=[libdir], libs=["z"])
+        dinst = SimpleNamespace(pref="zlib/1.3.1#rrev:pid#prev", package_type="static-library", package_folder=package_folder,
+                                package_path=package_folder, cpp_info=cpp_info)
+        dreq = SimpleNamespace(ref="zlib/1.3.1", libs=True)
+        return SimpleNamespace(name="slm-x", output=self.Output(), dependencies=SimpleNamespace(items=lambda: [(dreq, dinst)]))
+
+    def test_packaged_compiled_packages_survive_a_clean_build(self):
+        with tempfile.TemporaryDirectory() as d:
+            cwd = os.getcwd()
+            os.chdir(d)
+            try:
+                package_folder = os.path.join(d, "conan", "slm-dep")
+                os.makedirs(os.path.join(package_folder, PACKAGED_PKGS_DIRECTORY))
+                with open(os.path.join(package_folder, PACKAGED_PKGS_DIRECTORY, "dep.pkg"), "w") as f:
+                    f.write("compiled")
+                LBStanzaGenerator(self.conanfile("/conan/zlib/lib", package_folder)).generate()
+                # the project keeps its own pkg-cache
+                for fragment in ("stanza-x.proj", "stanza-x-relative.proj"):
+                    with open(fragment) as f:
+                        self.assertNotIn("pkg-cache", f.read())
+
+                def run(cmd):
+                    # what `slm clean` deletes
+                    self.assertIn("slm clean", cmd)
+                    for directory in (".slm/deps", ".slm/pkgs", PKG_CACHE_DIRECTORY):
+                        shutil.rmtree(directory, ignore_errors=True)
+                mode, fingerprint = prepare_build(d, {"stanza": "0.18.78"}, [package_folder], run)
+                self.assertEqual(mode, "clean")
+                self.assertEqual(os.listdir(PKG_CACHE_DIRECTORY), ["dep.pkg"])
+            finally:
+                os.chdir(cwd)
+
+    def test_unchanged_fragments_keep_their_mtimes(self):
+        with tempfile.TemporaryDirectory() as d:
+            cwd = os.getcwd()
+            os.chdir(d)
+            try:
+                fragments = ["stanza-x.proj", "stanza-x-relative.proj", RUNTIME_ENV]
+                LBStanzaGenerator(self.conanfile("/conan/zlib/lib")).generate()
+                for f in fragments:
+                    os.utime(f, ns=(10**9, 10**9))
+                # a conan install that changes nothing
+                LBStanzaGenerator(self.conanfile("/conan/zlib/lib")).generate()
+                self.assertEqual([os.stat(f).st_mtime_ns for f in fragments], [10**9] * 3)
+                # a new package revision of zlib
+                LBStanzaGenerator(self.conanfile("/conan/zlib2/lib")).generate()
+                self.assertNotEqual(os.stat("stanza-x.proj").st_mtime_ns, 10**9)
+                self.assertEqual(os.stat("stanza-x-relative.proj").st_mtime_ns, 10**9)
+                with open("stanza-x.proj") as f:
+                    self.assertIn("/conan/zlib2/lib/libz.a", f.read())
+            finally:
+                os.chdir(cwd)
+
+
+class TestCompiledPkgsPackageId(unittest.TestCase):
+    """Computes the package ids of the slm recipes with conan, against stand-in tool and library recipes"""
+    HERE = os.path.dirname(os.path.abspath(__file__))
+    RECIPES = {"application": os.path.join(HERE, "..", "..", "conanfile.py"),
+               "library": os.path.join(HERE, "..", "conanfile.py")}
+    STANDIN = ("from conan import ConanFile\n"
+               "class StandIn(ConanFile):\n"
+               "    settings = \"os\", \"arch\"\n"
+               "    options = {\"shared\": [True, False], \"fPIC\": [True, False]}\n"
+               "    default_options = {\"shared\": False, \"fPIC\": True}\n")
+
+    @classmethod
+    def setUpClass(cls):
+        import shutil
+        import subprocess
+        if not shutil.which("conan"):
+            raise unittest.SkipTest("conan is not on the PATH")
+        cls.subprocess = subprocess
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.env = dict(os.environ, CONAN_HOME=os.path.join(cls.tmpdir.name, "home"))
+        profiles = os.path.join(cls.env["CONAN_HOME"], "profiles")
+        os.makedirs(profiles)
+        with open(os.path.join(profiles, "default"), "w") as f:
+            f.write("[settings]\nos=Linux\narch=x86_64\n")
+        cls.conan("export", cls.HERE)
+        standin = os.path.join(cls.tmpdir.name, "standin")
+        os.makedirs(standin)
+        with open(os.path.join(standin, "conanfile.py"), "w") as f:
+            f.write(cls.STANDIN)
+        for ref in ("lbstanza/0.18.78", "lbstanza/0.18.79", "slm/0.6.22", "cmake/3.27.0", "ninja/1.11.1", "zlib/1.3.1"):
+            name, version = ref.split("/")
+            cls.conan("export", standin, "--name", name, "--version", version)
+        cls.standin = standin
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    @classmethod
+    def conan(cls, *args) -> str:
+        r = cls.subprocess.run(["conan", *args], env=cls.env, capture_output=True, text=True)
+        if r.returncode != 0:
+            raise AssertionError(f"conan {' '.join(args)} failed:\n{r.stderr}")
+        return r.stdout
+
+    def package_id(self, recipe: str, compiled_pkgs: bool, stanza_version: str = None) -> str:
+        """Returns the package id of a slm project with one conan dependency, built with recipe"""
+        import json
+        import shutil
+        project = tempfile.mkdtemp(dir=self.tmpdir.name)
+        shutil.copy(self.RECIPES[recipe], project)
+        with open(os.path.join(project, "slm.toml"), "w") as f:
+            f.write('name = "slm-x"\nversion = "0.7.0"\n\n[dependencies.zlib]\npkg = "zlib"\nversion = "1.3.1"\n'
+                    'type = "conan"\noptions.shared = "False"\noptions.linux.fPIC = "True"\n')
+        # the sources export_sources() copies
+        for d in ("ci", "src", "tests"):
+            os.makedirs(os.path.join(project, d))
+        with open(os.path.join(project, "stanza.proj"), "w") as f:
+            f.write('packages x/* defined-in "src/"\n')
+        self.conan("export", project)
+        args = ["graph", "info", "--requires=slm-x/0.7.0", "-o", f"slm-x/*:compiled_pkgs={compiled_pkgs}", "--no-remote", "--format=json"]
+        if stanza_version:
+            args += ["-c", f"user.jitx.slm:stanza_version={stanza_version}"]
+        graph = json.loads(self.conan(*args))
+        [node] = [n for n in graph["graph"]["nodes"].values() if n["ref"].startswith("slm-x/")]
+        return node["binary"] if node["binary"] == "Invalid" else node["package_id"]
+
+    def test_stanza_version_is_in_the_package_id(self):
+        for recipe in self.RECIPES:
+            with self.subTest(recipe=recipe):
+                plain = self.package_id(recipe, False)
+                self.assertEqual(self.package_id(recipe, False, "0.18.79"), plain)
+                compiled = self.package_id(recipe, True, "0.18.78")
+                self.assertNotIn(compiled, (plain, "Invalid"))
+                self.assertNotIn(self.package_id(recipe, True, "0.18.79"), (compiled, "Invalid"))
+
+    def test_compiled_pkgs_requires_a_stanza_version(self):
+        for recipe in self.RECIPES:
+            with self.subTest(recipe=recipe):
+                self.assertEqual(self.package_id(recipe, True), "Invalid")
+
+if __name__ == "__main__":
+    # self-test
+    unittest.main()
@@ -0,0 +1,390 @@
+# Builds of slm projects in conan recipes
+# Shared by the conan recipes through lbstanzagenerator_pyreq, so that build() reuses the
+# compiled packages in .slm/pkgs and .slm/pkg-cache when they are still valid, instead of
+# starting every build with `slm clean`, and package() can ship those compiled packages.
+# Only depends on the Python standard library, so it can be imported without conan.
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+# written to .slm after a successful build, with the fingerprint it was built from
+BUILD_STAMP = os.path.join(".slm", "conan-build.json")
+
+# where the binary package has the compiled stanza packages, when it has them
+PACKAGED_PKGS_DIRECTORY = "pkgs"
+# the pkg-cache that the stanza.proj of slm projects sets
+PKG_CACHE_DIRECTORY = os.path.join(".slm", "pkg-cache")
+# where `slm build` leaves compiled packages: the pkg directory of the build and the pkg-cache
+BUILD_PKG_DIRECTORIES = (os.path.join(".slm", "pkgs"), PKG_CACHE_DIRECTORY)
+
+# written by LBStanzaGenerator next to the stanza.proj fragments: the library directories of
+# the conan dependencies, for running the programs of a build without searching for libraries
+RUNTIME_ENV = "slm-runtime-env.json"
+
+# extensions of the compiled packages stanza writes: debug and optimized
+PKG_EXTENSIONS = (".pkg", ".fpkg")
+
+DEFPACKAGE = re.compile(r"^\s*defpackage\s+([^\s:]+)\s*:", re.MULTILINE)
+
+# files whose contents are inputs of a stanza build
+SOURCE_EXTENSIONS = (".stanza", ".proj", ".c", ".h", ".cpp", ".hpp")
+# directories with build outputs, not inputs
+SKIP_DIRECTORIES = ("build", "lib", "test_package")
+
+def is_lock_file(relpath: str) -> bool:
+    """Returns True for the files that pin the dependencies: slm.toml, slm.lock, and the generated stanza-*.proj fragments"""
+    name = os.path.basename(relpath)
+    return relpath == name and (name in ("slm.toml", "slm.lock") or (name.startswith("stanza-") and name.endswith(".proj")))
+
+def digest_files(folder: str, relpaths: list[str]) -> str:
+    """Returns the sha256 of the names and contents of files in folder"""
+    h = hashlib.sha256()
+    for relpath in sorted(relpaths):
+        h.update(relpath.replace(os.sep, "/").encode() + b"\0")
+        with open(os.path.join(folder, relpath), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        h.update(b"\0")
+    return h.hexdigest()
+
+def stanza_package_names(directory: str) -> set[str]:
+    """Returns the names of the packages defined with defpackage in the .stanza files under directory"""
+    names = set()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            if f.endswith(".stanza"):
+                with open(os.path.join(root, f), "r", errors="replace") as fd:
+                    names.update(DEFPACKAGE.findall(fd.read()))
+    return names
+
+def pkg_filenames(package: str) -> list[str]:
+    """Returns the file names stanza gives the compiled package, like "slm$utils.pkg" for "slm/utils" """
+    mangled = package.replace("/", "$")
+    return [mangled + ext for ext in PKG_EXTENSIONS]
+
+def package_compiled_pkgs(folder: str, destination: str, sources: str = "src") -> int:
+    """
+    Copy the compiled packages of the stanza packages defined in the sources of the project
+    in folder from its build directories to destination, so the binary package can ship them
+    and its consumers don't have to compile them again
+
+    Returns: the number of compiled packages copied
+    """
+    copied = 0
+    for package in sorted(stanza_package_names(os.path.join(folder, sources))):
+        for f in pkg_filenames(package):
+            found = next((os.path.join(folder, d, f) for d in BUILD_PKG_DIRECTORIES if os.path.isfile(os.path.join(folder, d, f))), None)
+            if found:
+                os.makedirs(destination, exist_ok=True)
+                shutil.copy2(found, os.path.join(destination, f))
+                copied += 1
+    return copied
+
+def seed_pkg_cache(pkgs: str, pkg_cache: str) -> int:
+    """
+    Copy the compiled packages that a dependency ships in its binary package into the pkg-cache
+    of a project, so stanza loads them instead of compiling the dependency.  The packages are
+    copied rather than linked, because stanza rewrites the stale packages in its pkg-cache, and
+    the conan package folder must not change.  A package already in the pkg-cache is replaced
+    only when the packaged copy is newer, so the packages stanza compiled since are kept.
+
+    Returns: the number of packages copied
+    """
+    copied = 0
+    for f in sorted(os.listdir(pkgs)) if os.path.isdir(pkgs) else []:
+        src = os.path.join(pkgs, f)
+        dst = os.path.join(pkg_cache, f)
+        if not f.endswith(PKG_EXTENSIONS) or (os.path.exists(dst) and os.stat(dst).st_mtime >= os.stat(src).st_mtime):
+            continue
+        os.makedirs(pkg_cache, exist_ok=True)
+        shutil.copy2(src, dst)
+        copied += 1
+    return copied
+
+def atomic_write(path: str, data: bytes):
+    """
+    Write data to a temporary file next to path, then rename it into place, so a concurrent
+    reader sees either the old or the new content, and concurrent writers don't share the
+    temporary file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def write_if_changed(path: str, content: str) -> bool:
+    """
+    Write a generated text file with atomic_write, unless it already has exactly that content,
+    so that its mtime only changes when it does
+
+    Returns: True if the file was written
+    """
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    atomic_write(path, content.encode())
+    return True
+
+def write_runtime_env(folder: str, libdirs: list[str]):
+    """
+    Write RUNTIME_ENV in folder, listing the library directories of the conan dependencies
+    of this host, like
+
+        {"libdirs": ["/conan/p/zlib/p/lib"]}
+
+    The file is only written if its contents change.
+    """
+    dirs = list(dict.fromkeys(str(d).replace("\\", "/") for d in libdirs))
+    content = json.dumps({"libdirs": dirs}, indent=2, sort_keys=True) + "\n"
+    write_if_changed(os.path.join(folder, RUNTIME_ENV), content)
+
+def runtime_library_dirs(folder: str) -> list[str]:
+    """
+    Returns the directories to search for shared libraries when running a program built in
+    folder: the ones RUNTIME_ENV lists for the conan dependencies, then the lib directory of
+    the project itself, if it has one.  The recipe puts them in the library path variable of
+    the platform, like DYLD_LIBRARY_PATH on macos or PATH on windows.
+    """
+    try:
+        with open(os.path.join(folder, RUNTIME_ENV)) as f:
+            dirs = list(json.load(f)["libdirs"])
+    except (OSError, ValueError, KeyError, TypeError):
+        dirs = []
+    lib = os.path.join(folder, "lib")
+    if os.path.isdir(lib):
+        dirs.append(os.path.abspath(lib).replace("\\", "/"))
+    return [d for d in dirs if os.path.isdir(d)]
+
+def build_fingerprint(folder: str, toolchain: dict) -> dict:
+    """
+    Returns the fingerprint of a build of the slm project in folder: separate digests of
+    its sources, of the files that pin its dependencies, and of the toolchain
+
+    Parameters:
+        folder: the source folder of the project
+        toolchain: the versions of the tools and the settings the build uses, like
+            {"stanza": "0.18.78", "slm": "0.6.25", "os": "Linux", "arch": "x86_64"}
+    """
+    sources = []
+    locks = []
+    for root, dirs, files in os.walk(folder):
+        rel = os.path.relpath(root, folder)
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and not (rel == "." and d in SKIP_DIRECTORIES))
+        for f in files:
+            relpath = os.path.normpath(os.path.join(rel, f))
+            if is_lock_file(relpath):
+                locks.append(relpath)
+            elif f.endswith(SOURCE_EXTENSIONS):
+                sources.append(relpath)
+    return {
+        "sources": digest_files(folder, sources),
+        "lock": digest_files(folder, locks),
+        "toolchain": hashlib.sha256(json.dumps(toolchain, sort_keys=True).encode()).hexdigest(),
+    }
+
+def read_build_stamp(folder: str) -> dict:
+    """Returns the fingerprint of the last successful build in folder, or None"""
+    try:
+        with open(os.path.join(folder, BUILD_STAMP)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_build_stamp(folder: str, fingerprint: dict):
+    """Record the fingerprint of a successful build in folder"""
+    write_if_changed(os.path.join(folder, BUILD_STAMP), json.dumps(fingerprint, indent=2, sort_keys=True))
+
+def build_mode(folder: str, fingerprint: dict, clean: bool = False, outputs: list[str] = ()) -> str:
+    """
+    Returns how to build the project in folder:
+
+        "clean": with `slm clean` first, when asked to, when there is no record of the last
+            build, or when the toolchain or the dependencies changed, so that no package
+            compiled against something else is reused
+        "up-to-date": nothing changed since the last build, and its outputs are still there
+        "incremental": only sources changed, and stanza recompiles just what depends on them
+
+    Parameters:
+        folder: the source folder of the project
+        fingerprint: the build_fingerprint() of the project now
+        clean: True to always build from scratch
+        outputs: files the build produces, relative to folder
+    """
+    stamp = read_build_stamp(folder)
+    if clean or stamp is None or any(stamp.get(k) != fingerprint[k] for k in ("toolchain", "lock")):
+        return "clean"
+    if stamp.get("sources") == fingerprint["sources"] and all(os.path.exists(os.path.join(folder, o)) for o in outputs):
+        return "up-to-date"
+    return "incremental"
+
+def prepare_build(folder: str, toolchain: dict, package_folders: list[str], run, clean: bool = False,
+                  outputs: list[str] = ()) -> tuple[str, dict]:
+    """
+    Prepare the build of the slm project in folder: run `slm clean` when build_mode() says
+    it is a clean build, then seed the pkg-cache with the compiled packages the dependencies
+    ship.  The pkg-cache is only seeded after the clean, which deletes it.
+
+    Parameters:
+        folder: the source folder of the project
+        toolchain: the versions of the tools and the settings the build uses, see build_fingerprint()
+        package_folders: the package folders of the conan dependencies
+        run: runs a shell command in folder, like the run() of the recipe
+        clean: True to always build from scratch
+        outputs: files the build produces, relative to folder
+
+    Returns: the build_mode(), and the build_fingerprint() after the clean, to record with
+        write_build_stamp() after the build
+    """
+    fingerprint = build_fingerprint(folder, toolchain)
+    mode = build_mode(folder, fingerprint, clean, outputs)
+    if mode == "clean":
+        run("bash -c '[ ! -d .slm ] || slm clean'")
+        # slm clean deletes slm.lock, so record the tree the next build starts from
+        fingerprint = build_fingerprint(folder, toolchain)
+    if mode != "up-to-date":
+        for package_folder in package_folders:
+            seed_pkg_cache(os.path.join(package_folder, PACKAGED_PKGS_DIRECTORY), os.path.join(folder, PKG_CACHE_DIRECTORY))
+    return mode, fingerprint
+
+
+### Tests ######################################################################
+
+class TestSlmBuild(unittest.TestCase):
+    TOOLCHAIN = {"stanza": "0.18.78", "slm": "0.6.25", "os": "Linux", "arch": "x86_64"}
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.folder = self.tmpdir.name
+        for relpath, content in (("slm.toml", "name = \"x\"\n"), ("stanza.proj", "packages x/* defined-in \"src/\"\n"),
+                                 ("stanza-x.proj", "package x requires :\n"), ("src/main.stanza", "defpackage x :\n"),
+                                 (".slm/pkgs/x.pkg", "compiled"), ("build/test", "binary"), ("README.md", "docs")):
+            self.write(relpath, content)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, relpath: str, content: str):
+        path = os.path.join(self.folder, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def fingerprint(self, **toolchain):
+        return build_fingerprint(self.folder, dict(self.TOOLCHAIN, **toolchain))
+
+    def test_fingerprint(self):
+        before = self.fingerprint()
+        self.assertEqual(self.fingerprint(), before)
+        # outputs, caches and files that aren't sources don't count
+        for relpath in (".slm/pkgs/x.pkg", "build/test", "README.md"):
+            self.write(relpath, "changed")
+        self.assertEqual(self.fingerprint(), before)
+
+        self.write("src/main.stanza", "defpackage x :\n  import core\n")
+        after = self.fingerprint()
+        self.assertNotEqual(after["sources"], before["sources"])
+        self.assertEqual({k: after[k] for k in ("lock", "toolchain")}, {k: before[k] for k in ("lock", "toolchain")})
+        self.write("stanza-x.proj", "package x requires :\n  ccflags: \"-lz\"\n")
+        self.assertNotEqual(self.fingerprint()["lock"], after["lock"])
+        self.assertNotEqual(self.fingerprint(stanza="0.18.79")["toolchain"], after["toolchain"])
+
+    def test_build_mode(self):
+        fingerprint = self.fingerprint()
+        self.assertEqual(build_mode(self.folder, fingerprint), "clean")
+        write_build_stamp(self.folder, fingerprint)
+        self.assertEqual(build_mode(self.folder, fingerprint, outputs=["build/test"]), "up-to-date")
+        self.assertEqual(build_mode(self.folder, fingerprint, clean=True), "clean")
+        self.assertEqual(build_mode(self.folder, fingerprint, outputs=["slm"]), "incremental")
+
+        self.write("src/main.stanza", "defpackage x :\n  import core\n")
+        self.assertEqual(build_mode(self.folder, self.fingerprint()), "incremental")
+        self.assertEqual(build_mode(self.folder, self.fingerprint(stanza="0.18.79")), "clean")
+        self.write("slm.lock", "[dependencies]\n")
+        self.assertEqual(build_mode(self.folder, self.fingerprint()), "clean")
+
+    def test_consecutive_builds_are_incremental(self):
+        self.write("slm.lock", "[dependencies]\n")
+        runs = []
+        def run(cmd):
+            # what `slm clean` deletes
+            runs.append(cmd)
+            os.remove(os.path.join(self.folder, "slm.lock"))
+            shutil.rmtree(os.path.join(self.folder, PKG_CACHE_DIRECTORY), ignore_errors=True)
+        mode, fingerprint = prepare_build(self.folder, self.TOOLCHAIN, [], run)
+        self.assertEqual((mode, len(runs)), ("clean", 1))
+        write_build_stamp(self.folder, fingerprint)
+        self.write("src/main.stanza", "defpackage x :\n  import core\n")
+        mode, fingerprint = prepare_build(self.folder, self.TOOLCHAIN, [], run)
+        self.assertEqual((mode, len(runs)), ("incremental", 1))
+
+    def test_package_compiled_pkgs(self):
+        self.write("src/utils.stanza", "#use-added-syntax(tests)\ndefpackage x/utils:\n  import core\n")
+        self.write(".slm/pkg-cache/x$utils.fpkg", "compiled")
+        self.write(".slm/pkg-cache/core.pkg", "not ours")
+        self.assertEqual(stanza_package_names(os.path.join(self.folder, "src")), {"x", "x/utils"})
+        destination = os.path.join(self.folder, "package", PACKAGED_PKGS_DIRECTORY)
+        self.assertEqual(package_compiled_pkgs(self.folder, destination), 2)
+        self.assertEqual(sorted(os.listdir(destination)), ["x$utils.fpkg", "x.pkg"])
+
+    def test_seed_pkg_cache(self):
+        pkgs = os.path.join(self.folder, "conan", "p", PACKAGED_PKGS_DIRECTORY)
+        for f in ("dep.pkg", "dep$utils.fpkg", "notes.txt"):
+            self.write(os.path.join(pkgs, f), "packaged")
+        pkg_cache = os.path.join(self.folder, PKG_CACHE_DIRECTORY)
+        self.assertEqual(seed_pkg_cache(pkgs, pkg_cache), 2)
+        self.assertEqual(sorted(os.listdir(pkg_cache)), ["dep$utils.fpkg", "dep.pkg"])
+        self.assertNotEqual(os.stat(os.path.join(pkg_cache, "dep.pkg")).st_ino, os.stat(os.path.join(pkgs, "dep.pkg")).st_ino)
+        self.assertEqual(seed_pkg_cache(pkgs, pkg_cache), 0)
+        # a package stanza compiled since is kept, a newer packaged one replaces it
+        self.write(os.path.join(PKG_CACHE_DIRECTORY, "dep.pkg"), "recompiled")
+        self.assertEqual(seed_pkg_cache(pkgs, pkg_cache), 0)
+        os.utime(os.path.join(pkgs, "dep.pkg"), (time.time() + 10, time.time() + 10))
+        self.assertEqual(seed_pkg_cache(pkgs, pkg_cache), 1)
+        self.assertEqual(seed_pkg_cache(os.path.join(self.folder, "missing"), pkg_cache), 0)
+
+    def test_write_if_changed(self):
+        path = os.path.join(self.folder, "stanza-y.proj")
+        self.assertTrue(write_if_changed(path, "package y requires :\n"))
+        os.utime(path, ns=(10**9, 10**9))
+        self.assertFalse(write_if_changed(path, "package y requires :\n"))
+        self.assertEqual(os.stat(path).st_mtime_ns, 10**9)
+        self.assertTrue(write_if_changed(path, "package y requires :\n  ccflags: \"-lz\"\n"))
+        self.assertNotEqual(os.stat(path).st_mtime_ns, 10**9)
+        self.assertEqual([f for f in os.listdir(self.folder) if ".tmp" in f], [])
+
+    def test_runtime_env(self):
+        conan = os.path.join(self.folder, "conan", "zlib", "lib")
+        os.makedirs(conan)
+        write_runtime_env(self.folder, [conan, conan, os.path.join(self.folder, "missing")])
+        self.assertEqual(runtime_library_dirs(self.folder), [conan.replace("\\", "/")])
+        mtime = os.stat(os.path.join(self.folder, RUNTIME_ENV)).st_mtime_ns
+        os.utime(os.path.join(self.folder, RUNTIME_ENV), ns=(mtime - 10**9, mtime - 10**9))
+        write_runtime_env(self.folder, [conan, os.path.join(self.folder, "missing")])
+        self.assertEqual(os.stat(os.path.join(self.folder, RUNTIME_ENV)).st_mtime_ns, mtime - 10**9)
+
+        self.write("lib/libx.dylib", "library")
+        self.assertEqual(runtime_library_dirs(self.folder)[-1], os.path.join(self.folder, "lib").replace("\\", "/"))
+        os.remove(os.path.join(self.folder, RUNTIME_ENV))
+        self.assertEqual(len(runtime_library_dirs(self.folder)), 1)
+
+
+if __name__ == "__main__":
+    # self-test
+    unittest.main()
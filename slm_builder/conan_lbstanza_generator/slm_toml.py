@@ -0,0 +1,245 @@
+# slm.toml project model
+# Shared by the conan recipes (through lbstanzagenerator_pyreq), bootstrap.py and
+# bootstrap_conan_utils.py, so slm.toml is parsed and validated the same way everywhere.
+# Only depends on the Python standard library, so it can be imported without conan.
+
+import hashlib
+import platform
+import threading
+import tomllib
+import unittest
+from dataclasses import dataclass, field
+
+# the platform sections of conan options, like options.linux.fPIC = "True"
+PLATFORMS = ("linux", "macos", "windows")
+
+class SlmTomlError(Exception):
+    pass
+
+def current_platform() -> str:
+    """Returns the platform of the conan options sections that apply here: "linux", "macos" or "windows" """
+    p = platform.system().lower()
+    return "macos" if p == "darwin" else p
+
+def platform_options(options: dict, plat: str = None) -> dict:
+    """
+    Returns conan options for a platform: the top level options, overridden by the ones in
+    the section of the platform, without the sections of any platform
+
+        platform_options({"shared": "False", "linux": {"fPIC": "True"}, "windows": {...}}, "linux")
+          => {"shared": "False", "fPIC": "True"}
+    """
+    plat = plat or current_platform()
+    merged = {k: v for k, v in options.items() if k not in PLATFORMS}
+    merged.update(options.get(plat, {}))
+    return merged
+
+
+@dataclass(frozen=True)
+class GitDependency:
+    """A dependency fetched from a git repository, like { git = "StanzaOrg/semver", version = "0.1.8" }"""
+    name: str
+    git: str
+    version: str
+
+    def specifier(self) -> dict:
+        return {"git": self.git, "version": self.version}
+
+
+@dataclass(frozen=True)
+class PathDependency:
+    """A dependency in a local directory, like { path = "../semver" }"""
+    name: str
+    path: str
+
+    def specifier(self) -> dict:
+        return {"path": self.path}
+
+
+@dataclass(frozen=True)
+class ConanDependency:
+    """
+    A conan package dependency, like:
+
+        [dependencies.zlib]
+        pkg = "zlib"
+        version = "1.3.1"
+        type = "conan"
+        options.shared = "False"
+        options.linux.fPIC = "True"
+
+    all_options has the options as written, with their platform sections, and options
+    has the ones that apply to the current platform.
+    """
+    name: str
+    pkg: str
+    version: str
+    all_options: dict = field(default_factory=dict, hash=False)
+
+    @property
+    def options(self) -> dict:
+        return platform_options(self.all_options)
+
+    def options_for(self, plat: str) -> dict:
+        return platform_options(self.all_options, plat)
+
+    def specifier(self) -> dict:
+        return {"pkg": self.pkg, "version": self.version, "type": "conan", "options": self.all_options}
+
+
+def parse_dependency(name: str, specifier) -> object:
+    """
+    Returns the GitDependency, PathDependency or ConanDependency of a slm.toml [dependencies] entry,
+    including the legacy "org/repo|version" strings
+
+    throws SlmTomlError if the entry is invalid
+    """
+    if isinstance(specifier, str):
+        git, sep, version = specifier.partition("|")
+        if not sep or not git or not version:
+            raise SlmTomlError(f"dependency \"{name}\": expected \"org/repo|version\", got \"{specifier}\"")
+        return GitDependency(name, git, version)
+    if not isinstance(specifier, dict):
+        raise SlmTomlError(f"dependency \"{name}\": expected a table, got \"{specifier}\"")
+
+    def required(key):
+        value = specifier.get(key)
+        if not isinstance(value, str) or not value:
+            raise SlmTomlError(f"dependency \"{name}\": missing \"{key}\"")
+        return value
+
+    if "git" in specifier:
+        return GitDependency(name, required("git"), required("version"))
+    if "path" in specifier:
+        return PathDependency(name, required("path"))
+    if "pkg" in specifier:
+        if specifier.get("type") != "conan":
+            raise SlmTomlError(f"dependency \"{name}\": unknown package type \"{specifier.get('type')}\"")
+        options = specifier.get("options", {})
+        if not isinstance(options, dict) or any(isinstance(v, dict) and k not in PLATFORMS for k, v in options.items()):
+            raise SlmTomlError(f"dependency \"{name}\": invalid options \"{options}\"")
+        return ConanDependency(name, required("pkg"), required("version"), options)
+    raise SlmTomlError(f"dependency \"{name}\": unknown dependency type \"{specifier}\"")
+
+
+@dataclass(frozen=True)
+class SlmProject:
+    """The name, version and dependencies of a slm.toml"""
+    name: str
+    version: str
+    dependencies: dict = field(hash=False)
+
+    def git_dependencies(self) -> list:
+        return [d for d in self.dependencies.values() if isinstance(d, GitDependency)]
+
+    def conan_dependencies(self) -> list:
+        return [d for d in self.dependencies.values() if isinstance(d, ConanDependency)]
+
+    def specifiers(self) -> dict:
+        """Returns the dependencies as slm.toml tables, with legacy strings converted to tables"""
+        return {name: d.specifier() for name, d in self.dependencies.items()}
+
+
+def parse_slm_toml(content: bytes, path: str = "slm.toml") -> SlmProject:
+    """
+    Returns the SlmProject of the contents of a slm.toml
+
+    throws SlmTomlError if it isn't valid
+    """
+    try:
+        data = tomllib.loads(content.decode("utf-8"))
+    except (UnicodeDecodeError, tomllib.TOMLDecodeError) as e:
+        raise SlmTomlError(f"failed parsing \"{path}\": {e}") from e
+    for key in ("name", "version"):
+        if not isinstance(data.get(key), str):
+            raise SlmTomlError(f"\"{path}\": missing \"{key}\"")
+    try:
+        dependencies = {name: parse_dependency(name, s) for name, s in data.get("dependencies", {}).items()}
+    except SlmTomlError as e:
+        raise SlmTomlError(f"\"{path}\": {e}") from None
+    return SlmProject(data["name"], data["version"], dependencies)
+
+
+# parsed projects by the sha256 of their slm.toml contents
+_projects = {}
+_projects_lock = threading.Lock()
+
+def load_slm_toml(path: str) -> SlmProject:
+    """
+    Returns the SlmProject of a slm.toml file, parsing each distinct content only once per
+    process, however many times and from wherever it is loaded
+
+    throws OSError if the file can't be read
+    throws SlmTomlError if it isn't valid
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    with _projects_lock:
+        project = _projects.get(digest)
+    if project is None:
+        project = parse_slm_toml(content, path)
+        with _projects_lock:
+            _projects[digest] = project
+    return project
+
+
+### Tests ######################################################################
+
+class TestSlmToml(unittest.TestCase):
+    TOML = b'''
+name = "slm"
+version = "0.6.25"
+
+[dependencies]
+semver = { git = "StanzaOrg/semver", version = "0.1.8" }
+legacy = "StanzaOrg/legacy|0.0.1"
+local = { path = "../local" }
+
+[dependencies.zlib]
+pkg = "zlib"
+version = "1.3.1"
+type = "conan"
+options.shared = "False"
+options.linux.fPIC = "True"
+options.windows.shared = "True"
+'''
+
+    def test_parse(self):
+        project = parse_slm_toml(self.TOML)
+        self.assertEqual((project.name, project.version), ("slm", "0.6.25"))
+        self.assertEqual(project.dependencies["semver"], GitDependency("semver", "StanzaOrg/semver", "0.1.8"))
+        self.assertEqual(project.dependencies["legacy"].specifier(), {"git": "StanzaOrg/legacy", "version": "0.0.1"})
+        self.assertEqual(project.dependencies["local"], PathDependency("local", "../local"))
+        [zlib] = project.conan_dependencies()
+        self.assertEqual(zlib.options_for("linux"), {"shared": "False", "fPIC": "True"})
+        self.assertEqual(zlib.options_for("windows"), {"shared": "True"})
+        self.assertEqual(zlib.options_for("macos"), {"shared": "False"})
+        self.assertEqual(zlib.specifier()["options"]["linux"], {"fPIC": "True"})
+
+    def test_invalid(self):
+        for toml in (b'version = "1"', b'name = "x"\nversion = "1"\n[dependencies]\na = "no-version"',
+                     b'name = "x"\nversion = "1"\n[dependencies]\na = { git = "org/a" }',
+                     b'name = "x"\nversion = "1"\n[dependencies.a]\npkg = "a"\nversion = "1"\ntype = "pip"',
+                     b'name = "x"\nversion = "1"\n[dependencies]\na = { pkg = "a", version = "1", type = "conan", options = { bsd = { a = "1" } } }',
+                     b'name = "x" version'):
+            with self.assertRaises(SlmTomlError):
+                parse_slm_toml(toml)
+
+    def test_load_is_memoized_by_content(self):
+        import os
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            paths = [os.path.join(d, n) for n in ("a.toml", "b.toml")]
+            for p in paths:
+                with open(p, "wb") as f:
+                    f.write(self.TOML)
+            self.assertIs(load_slm_toml(paths[0]), load_slm_toml(paths[1]))
+            with open(paths[1], "ab") as f:
+                f.write(b"\n")
+            self.assertIsNot(load_slm_toml(paths[0]), load_slm_toml(paths[1]))
+
+
+if __name__ == "__main__":
+    # self-test
+    unittest.main()